@@ -2,6 +2,7 @@ from libc.stdint cimport uint64_t, uint32_t
 from cython.operator cimport dereference as deref, preincrement as inc
 from libcpp.vector cimport vector
 from libcpp.string cimport string
+from heapq import heapify, heappush, heappop
 
 IF UNAME_MACHINE != "x86_64":
     ctypedef uint32_t uint_t
@@ -30,6 +31,7 @@ cdef extern from "ewah.h":
         bint get(size_t i) nogil
         void logicaland(EWAHBoolArray&, EWAHBoolArray&) nogil
         void logicalor(EWAHBoolArray&, EWAHBoolArray&) nogil
+        void logicalxor(EWAHBoolArray&, EWAHBoolArray&) nogil
         void logicalnot(EWAHBoolArray&) nogil
         size_t sizeInBytes() nogil
         void write(stringstream &, bint) nogil
@@ -113,6 +115,26 @@ cdef class BitSet:
     def __or__(self, other):
         return self.lor(other)
 
+    cpdef BitSet lxor(self, BitSet other):
+        cdef BitSet s = BitSet()
+
+        self.thisptr.logicalxor(deref(other.thisptr), deref(s.thisptr))
+        return s
+
+    def __xor__(self, other):
+        return self.lxor(other)
+
+    cpdef BitSet land_not(self, BitSet other):
+        """
+        Return self & ~other, without needing a universe size for the negation.
+        """
+        cdef BitSet a = BitSet()
+        cdef BitSet s = BitSet()
+
+        self.thisptr.logicaland(deref(other.thisptr), deref(a.thisptr))
+        self.thisptr.logicalxor(deref(a.thisptr), deref(s.thisptr))
+        return s
+
     cpdef BitSet lnot(self):
         cdef BitSet s = BitSet()
 
@@ -164,3 +186,44 @@ cdef class BitSet:
             self.updated = False
 
         return binary_search(self.indexes.begin(), self.indexes.end(), v)
+
+
+cpdef BitSet lor_all(bitmaps):
+    """
+    Union of any number of bitmaps, given either as BitSets or as serialized
+    strings (as stored in the index DBs); None entries are skipped.
+
+    Bitmaps are merged smallest first with a heap, so the union of n bitmaps
+    costs O(N log n) in their total compressed size N, instead of the O(n * N)
+    of OR-ing them into an accumulator one at a time.
+    """
+    cdef list heap = []
+    cdef BitSet a, b, s
+    cdef size_t n = 0
+
+    for bm in bitmaps:
+        if bm is None:
+            continue
+        if isinstance(bm, BitSet):
+            a = bm
+        else:
+            a = BitSet()
+            a.loads(bm)
+        heap.append((a.thisptr.sizeInBytes(), n, a))
+        n += 1
+
+    if not heap:
+        return BitSet()
+    elif len(heap) == 1:
+        # always hand back a fresh bitmap, never one owned by the caller
+        return heap[0][2].lor(BitSet())
+
+    heapify(heap)
+    while len(heap) > 1:
+        _, _, a = heappop(heap)
+        _, _, b = heappop(heap)
+        s = BitSet()
+        a.thisptr.logicalor(deref(b.thisptr), deref(s.thisptr))
+        heappush(heap, (s.thisptr.sizeInBytes(), n, s))
+        n += 1
+    return heap[0][2]
@@ -1,5 +1,5 @@
 import unittest
-from pyebset import BitSet
+from pyebset import BitSet, lor_all
 
 
 class BitSetTest(unittest.TestCase):
@@ -68,6 +68,18 @@ class BitSetTest(unittest.TestCase):
         self.assertEqual(len(ln), 2)
         self.assertEqual(len(ll), 3)
 
+    def test_xor_and_not(self):
+        b = BitSet()
+        for i in [0, 1, 4, 8, 16]:
+            b.set(i)
+        bb = BitSet()
+        for i in [1, 4, 9]:
+            bb.set(i)
+        self.assertListEqual(list(b ^ bb), [0, 8, 9, 16])
+        self.assertListEqual(list(b.land_not(bb)), [0, 8, 16])
+        self.assertListEqual(list(bb.land_not(b)), [9])
+        self.assertListEqual(list(b.land_not(BitSet())), [0, 1, 4, 8, 16])
+
     def test_logical_not(self):
         b = BitSet()
         b.set(0)
@@ -127,3 +139,27 @@ class BitSetTest(unittest.TestCase):
         cc.set(3)
         self.assertTrue(b == bb)
         self.assertTrue(bb != cc)
+
+    def test_lor_all(self):
+        bitmaps = []
+        expected = set()
+        for i in range(50):
+            b = BitSet()
+            for j in range(i, 5000, 37 + i):
+                b.set(j)
+                expected.add(j)
+            bitmaps.append(b)
+        # mix BitSets, serialized bitmaps and missing values
+        inputs = [b if i % 2 else b.dumps() for i, b in enumerate(bitmaps)]
+        inputs.append(None)
+        self.assertListEqual(list(lor_all(inputs)), sorted(expected))
+
+    def test_lor_all_trivial(self):
+        self.assertEqual(len(lor_all([])), 0)
+        self.assertEqual(len(lor_all([None])), 0)
+        b = BitSet()
+        b.set(3)
+        u = lor_all([b])
+        self.assertListEqual(list(u), [3])
+        u.set(5)
+        self.assertListEqual(list(b), [3])
@@ -3,8 +3,12 @@ from libc.stdint cimport uint8_t, int8_t, uint16_t, int16_t, uint32_t, \
     int32_t, uint64_t, int64_t
 from cpython.int cimport PyInt_FromLong
 from cpython.long cimport PyLong_FromLongLong, PyLong_FromUnsignedLongLong
+from libc.string cimport memcpy
 from sys import maxint
 
+cdef extern from "Python.h":
+    int PyObject_AsWriteBuffer(object obj, void **buffer, Py_ssize_t *buffer_len) except -1
+
 
 # env creation flags
 MDB_FIXEDMAP = 0x01
@@ -169,6 +173,15 @@ cdef size_t _size_int(uint32_t t):
     else:
         return sizeof(int64_t)
 
+cdef inline int64_t _read_int(void *p, size_t size, bint signed):
+    if size == sizeof(int32_t):
+        return (<int32_t *>p)[0] if signed else (<uint32_t *>p)[0]
+    elif size == sizeof(int16_t):
+        return (<int16_t *>p)[0] if signed else (<uint16_t *>p)[0]
+    elif size == sizeof(int8_t):
+        return (<int8_t *>p)[0] if signed else (<uint8_t *>p)[0]
+    return (<int64_t *>p)[0]
+
 
 class KeyExistError(Exception):
     pass
@@ -1953,6 +1966,157 @@ cdef class IntIntDB(DB):
         finally:
             cmdb.mdb_cursor_close(cursor)
 
+    def remap_values(self, Txn txn, remap):
+        """
+        Replace every value v with remap[v] in place, walking the database
+        with a cursor.  Only the keys with a value that remap changes are
+        rewritten.  remap is indexed by value, like the array returned by
+        Trie.sort().  Returns the number of keys rewritten.
+        """
+        cdef cmdb.MDB_cursor *cursor
+        cdef cmdb.MDB_val api_key
+        cdef cmdb.MDB_val api_value
+        cdef uint64_t key_copy
+        cdef int64_t svalue
+        cdef uint64_t uvalue
+        cdef size_t count
+        cdef int rc
+        cdef int rewritten = 0
+
+        err = cmdb.mdb_cursor_open(txn.txn, self.dbi, &cursor)
+        if err:
+            raise Exception("Error creating Cursor: %s"
+                    % cmdb.mdb_strerror(err))
+        try:
+            rc = cmdb.mdb_cursor_get(cursor, &api_key, &api_value, MDB_FIRST)
+            while not rc:
+                err = cmdb.mdb_cursor_count(cursor, &count)
+                if err:
+                    raise Exception("Error counting Cursor: %s"
+                            % cmdb.mdb_strerror(err))
+                values = [self.value_caster(api_value.mv_data)]
+                while len(values) < count and not cmdb.mdb_cursor_get(
+                        cursor, &api_key, &api_value, MDB_NEXT_DUP):
+                    values.append(self.value_caster(api_value.mv_data))
+                new_values = [remap[value] for value in values]
+                if new_values != values:
+                    # the key's page may change once its values are deleted
+                    key_copy = 0
+                    memcpy(&key_copy, api_key.mv_data, self.keysize)
+                    api_key.mv_data = &key_copy
+                    err = cmdb.mdb_cursor_del(cursor, MDB_NODUPDATA)
+                    if err:
+                        raise Exception("Error deleting data: %s"
+                                % cmdb.mdb_strerror(err))
+                    api_value.mv_size = self.valuesize
+                    for value in new_values:
+                        if self.value_signed:
+                            svalue = value
+                            api_value.mv_data = &svalue
+                        else:
+                            uvalue = value
+                            api_value.mv_data = &uvalue
+                        err = cmdb.mdb_cursor_put(cursor, &api_key, &api_value, 0)
+                        if err == cmdb.MDB_MAP_FULL:
+                            raise MapFullError("Error putting data: %s"
+                                               % cmdb.mdb_strerror(err))
+                        elif err == cmdb.MDB_TXN_FULL:
+                            raise TxnFullError("Error putting data: %s"
+                                               % cmdb.mdb_strerror(err))
+                        elif err:
+                            raise Exception("Error putting data: %s"
+                                            % cmdb.mdb_strerror(err))
+                    rewritten += 1
+                rc = cmdb.mdb_cursor_get(cursor, &api_key, &api_value, MDB_NEXT_NODUP)
+        finally:
+            cmdb.mdb_cursor_close(cursor)
+        return rewritten
+
+    def mgetex_into(self, Txn txn, keys, buffer):
+        """
+        Like mgetex(), but writes the values into buffer instead of yielding
+        them.  buffer is a writable buffer of 64-bit integers, such as an
+        array.array('l') where a C long is 64 bits, and is filled from the start.
+        Returns the number of values written, which is at most the number of
+        items buffer holds.  Like mgetex(), a key that isn't in the database
+        gets the value of the closest key before it, so keys after the last one
+        repeat its value.  Only an empty database gives 0.  Raises ValueError
+        if the items of buffer aren't 64 bits.
+        """
+        cdef cmdb.MDB_cursor *cursor
+        cdef cmdb.MDB_val api_key
+        cdef cmdb.MDB_val api_value
+        cdef void *data
+        cdef void *out_data
+        cdef int64_t *out
+        cdef Py_ssize_t out_len
+        cdef Py_ssize_t i = 0
+        cdef int64_t skey
+        cdef uint64_t ukey
+        cdef object lower = maxint
+        cdef object upper = - maxint - 1
+        cdef int64_t l_val = 0
+        cdef int64_t r_val = 0
+
+        if getattr(buffer, 'itemsize', sizeof(int64_t)) != sizeof(int64_t):
+            raise ValueError("mgetex_into() needs a buffer of 64-bit integers.")
+        PyObject_AsWriteBuffer(buffer, &out_data, &out_len)
+        if out_len % sizeof(int64_t):
+            raise ValueError("mgetex_into() needs a buffer of 64-bit integers.")
+        out = <int64_t *>out_data
+        out_len /= sizeof(int64_t)
+
+        err = cmdb.mdb_cursor_open(txn.txn, self.dbi, &cursor)
+        if err:
+            raise Exception("Error creating Cursor: %s"
+                    % cmdb.mdb_strerror(err))
+        try:
+            for key in keys:
+                if i >= out_len:
+                    break
+                if key < upper:
+                    out[i] = l_val
+                elif key == upper:
+                    out[i] = r_val
+                else:
+                    if self.key_signed:
+                        skey = key
+                        data = &skey
+                    else:
+                        ukey = key
+                        data = &ukey
+                    api_key.mv_size = self.keysize
+                    api_key.mv_data = data
+                    api_value.mv_size = 0
+                    api_value.mv_data = NULL
+
+                    if not cmdb.mdb_cursor_get(cursor, &api_key, &api_value, MDB_SET_RANGE):
+                        key_ = self.key_caster(api_key.mv_data)
+                        r_val = _read_int(api_value.mv_data, self.valuesize, self.value_signed)
+                        upper = key_
+                        if key == key_:
+                            lower = key_
+                            l_val = r_val
+                        else:
+                            cmdb.mdb_cursor_get(cursor, &api_key, &api_value, MDB_PREV)
+                            lower = self.key_caster(api_key.mv_data)
+                            l_val = _read_int(api_value.mv_data, self.valuesize, self.value_signed)
+                    else:
+                        # special case if MDB_SET_RANGE fails, try to get the last one
+                        if not cmdb.mdb_cursor_get(cursor, &api_key, &api_value, MDB_LAST):
+                            upper = lower = self.key_caster(api_key.mv_data)
+                            l_val = r_val = _read_int(api_value.mv_data, self.valuesize,
+                                                      self.value_signed)
+                        else:
+                            upper = maxint
+                            lower = -maxint - 1
+                            l_val = r_val = 0
+                    out[i] = l_val
+                i += 1
+        finally:
+            cmdb.mdb_cursor_close(cursor)
+        return i
+
     def get_gt(self, Txn txn, key):
         cdef cmdb.MDB_cursor *cursor
         cdef cmdb.MDB_val api_key
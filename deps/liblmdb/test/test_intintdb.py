@@ -107,6 +107,30 @@ class TestDB(TestCase):
                          ((8, 5), (8, 5)))
         self.assertListEqual(list(db.mgetex(txn, range(10))),
                              [1, 1, 1, 1, 1, 2, 2, 3, 5, 5])
+        from array import array
+        buf = array('l', [0]) * 10
+        self.assertEqual(db.mgetex_into(txn, range(10), buf), 10)
+        self.assertListEqual(list(buf), [1, 1, 1, 1, 1, 2, 2, 3, 5, 5])
+        buf = array('l', [0]) * 4
+        self.assertEqual(db.mgetex_into(txn, range(3, 10), buf), 4)
+        self.assertListEqual(list(buf), [1, 1, 2, 2])
+        self.assertRaises(ValueError, db.mgetex_into, txn, range(10), array('i', [0]) * 10)
+
+    def test_remap_values(self):
+        self.drop_mdb()
+        txn = self.env.begin_txn()
+        db = self.env.open_db(txn, 'test_db',
+                              flags=mdb.MDB_CREATE|mdb.MDB_DUPSORT|mdb.MDB_INTEGERKEY|mdb.MDB_INTEGERDUP,
+                              key_inttype=mdb.MDB_UINT_32, value_inttype=mdb.MDB_UINT_32)
+        for key, value in [(1, 0), (2, 3), (3, 1), (4, 2), (5, 2), (5, 3), (6, 1)]:
+            db.put(txn, key, value)
+        remap = [0, 3, 1, 2]
+        self.assertEqual(db.remap_values(txn, remap), 5)
+        self.assertListEqual(list(db.dup_items(txn)),
+                             [(1, 0), (2, 2), (3, 3), (4, 1), (5, 1), (5, 2), (6, 3)])
+        self.assertEqual(db.remap_values(txn, range(4)), 0)
+        txn.commit()
+        db.close()
 
     def test_contains(self):
         # all keys must be sorted
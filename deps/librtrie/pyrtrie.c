@@ -8,8 +8,10 @@
 
 #if PY_MAJOR_VERSION >= 3
     #define PYSTR_CREATE PyBytes_FromStringAndSize
+    #define PYINT_ASLONG PyLong_AsLong
 #else
     #define PYSTR_CREATE PyString_FromStringAndSize
+    #define PYINT_ASLONG PyInt_AsLong
 #endif
 
 #if PY_VERSION_HEX < 0x02050000 && !defined(PY_SSIZE_T_MIN)
@@ -79,6 +81,73 @@ py_value_for_vid(PyObject *self, PyObject *args)
     return Py_None;
 }
 
+/* Decode a sequence of VIDs into a list of values, each distinct VID once,
+ * so that repeated VIDs share the same value object */
+static PyObject *
+py_values_for_vids(PyObject *self, PyObject *args)
+{
+    uint64_t node_ptr, kid_ptr;
+    uint32_t *nodes;
+    uint32_t *kids;
+    PyObject *vids, *seq, *cache = NULL, *result = NULL, *key, *value;
+    Py_ssize_t i, n;
+    long vid;
+    char res[8092];
+    size_t rlen;
+
+    if (!PyArg_ParseTuple(args, "KKO", &node_ptr, &kid_ptr, &vids))
+        return NULL;
+
+    nodes = (uint32_t *)node_ptr;
+    kids = (uint32_t *)kid_ptr;
+
+    seq = PySequence_Fast(vids, "vids must be a sequence");
+    if (seq == NULL)
+        return NULL;
+    n = PySequence_Fast_GET_SIZE(seq);
+    result = PyList_New(n);
+    cache = PyDict_New();
+    if (result == NULL || cache == NULL)
+        goto error;
+
+    for (i = 0; i < n; i++) {
+        key = PySequence_Fast_GET_ITEM(seq, i);
+        value = PyDict_GetItem(cache, key);
+        if (value == NULL) {
+            vid = PYINT_ASLONG(key);
+            if (vid == -1 && PyErr_Occurred())
+                goto error;
+            if (!value_for_vid(nodes, kids, (uint32_t)vid, res, &rlen)) {
+                value = PYSTR_CREATE(res, rlen);
+                if (value == NULL)
+                    goto error;
+            }
+            else {
+                value = Py_None;
+                Py_INCREF(value);
+            }
+            if (PyDict_SetItem(cache, key, value) < 0) {
+                Py_DECREF(value);
+                goto error;
+            }
+            /* the cache holds the reference now */
+            Py_DECREF(value);
+        }
+        Py_INCREF(value);
+        PyList_SET_ITEM(result, i, value);
+    }
+
+    Py_DECREF(cache);
+    Py_DECREF(seq);
+    return result;
+
+error:
+    Py_XDECREF(cache);
+    Py_XDECREF(result);
+    Py_DECREF(seq);
+    return NULL;
+}
+
 //TODO: these routines should return 0 on not found
 // int vid_for_value(uint32_t *nodes, uint32_t *kids, char *key, uint16_t key_len, uint32_t *vid);
 static PyObject *
@@ -113,6 +182,8 @@ static PyMethodDef rtrie_methods[] = {
         "Get Value based on VID"},
     {"vid_for_value", py_vid_for_value, METH_VARARGS,
         "Get VID based on Value"},
+    {"values_for_vids", py_values_for_vids, METH_VARARGS,
+        "Get a list of Values based on a sequence of VIDs"},
     {"print_it", py_print_it, METH_VARARGS,
         "Print rtrie"},
     {"summarize", py_summarize, METH_VARARGS,
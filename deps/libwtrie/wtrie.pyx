@@ -233,6 +233,52 @@ cdef class Trie(object):
             kidsize += (4 - (kidsize % 4)) % 4
         return nodesize, kidsize
 
+    def sort(self):
+        """
+        Renumber the nodes so that VIDs are in the lexicographic order of their values, ie. comparing two VIDs
+        gives the same result as comparing the strings they stand for.  Return an array mapping every old VID
+        to its new one, so that data already encoded with the old VIDs can be rewritten.
+        """
+        cdef Node *node
+        cdef Node *new_nodes
+        cdef size_t capacity = self.size + self.rest
+        cdef int i, c, kid
+        cdef uint32_t new_index
+
+        # a pre-order walk visiting kids in selector order yields the nodes in sorted order,
+        # as a node's value is a prefix of all of its descendants' values
+        order = []
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            order.append(i)
+            node = self.nodes + i
+            for c in range(255, -1, -1):
+                kid = node.knodes[c]
+                if kid:
+                    stack.append(kid)
+
+        remap = array('I', [0]) * self.size
+        for c, i in enumerate(order):
+            remap[i] = c
+
+        new_nodes = <Node *> malloc(capacity * sizeof(Node))
+        if new_nodes == NULL:
+            raise MemoryError()
+        for i in range(self.size):
+            new_index = remap[i]
+            node = new_nodes + new_index
+            node[0] = self.nodes[i]
+            node.parent_index = remap[node.parent_index]
+            for c in range(256):
+                kid = node.knodes[c]
+                if kid:
+                    node.knodes[c] = remap[kid]
+        # the keys now belong to new_nodes, so don't destroy the old ones
+        free(self.nodes)
+        self.nodes = new_nodes
+        return remap
+
     def serialize(self):
         """Return a tuple (nodes, kids, size) of arrays packed into C readable format.  This is for the 'rtrie' functions"""
 
@@ -18,7 +18,7 @@ __version__ = '0.2.6'
 
 from disco.core import Job, Disco
 from disco.error import CommError
-from hustle.core.marble import Aggregation, Marble, json_decoder, Column, Expr, check_query
+from hustle.core.marble import Aggregation, Marble, json_decoder, Column, Expr, check_query, dump_blooms
 
 import os
 import sys
@@ -26,6 +26,13 @@ import ujson
 
 
 _TAG_PREFIX = 'hustle:'
+# the tag attributes holding the zone maps and the columns with Bloom filters of a marble, by the name it was
+# pushed under
+_ZONES_ATTR = '_zones_:'
+_BLOOMS_ATTR = '_blooms_:'
+# the filters themselves are too big for the partition tags, which every query reads, so they are kept in the
+# attributes of a sidecar tag per partition, by marble name, read only by the queries that can use them
+_BLOOMS_TAG_PREFIX = 'hustle-blooms:'
 _ALG_RIGHT, _ALG_LEFT, _ALG_CENTER = 0x01, 0x10, 0x20
 
 
@@ -62,11 +69,13 @@ class Table(Marble):
         :param name: the name of the table
         """
         from hustle.core.settings import Settings
+        from hustle.core.catalog import get_catalog
         settings = Settings(**kwargs)
-        ddfs = settings['ddfs']
+        catalog = get_catalog(settings)
         try:
-            partition = ujson.loads(ddfs.getattr(cls.base_tag(name), '_partition_'))
-            fields = ujson.loads(ddfs.getattr(cls.base_tag(name), '_fields_'))
+            attrs = catalog.attrs(cls.base_tag(name))
+            partition = ujson.loads(attrs['_partition_'])
+            fields = ujson.loads(attrs['_fields_'])
             return cls(name=name, fields=fields, partition=partition)
         except:
             return None
@@ -112,6 +121,7 @@ class Table(Marble):
             For detailed schema design docs look no further than :ref:`schemadesign`
         """
         from hustle.core.settings import Settings
+        from hustle.core.catalog import get_catalog
         settings = Settings(**kwargs)
         ddfs = settings['ddfs']
 
@@ -127,6 +137,7 @@ class Table(Marble):
 
         ddfs.setattr(cls.base_tag(name), '_fields_', ujson.dumps(fields))
         ddfs.setattr(cls.base_tag(name), '_partition_', ujson.dumps(partition))
+        get_catalog(settings).invalidate(cls.base_tag(name))
         return cls(name=name, fields=fields, partition=partition)
 
     @classmethod
@@ -137,6 +148,7 @@ class Table(Marble):
             words = column.split(' ')
             column_name = words[-1]
             index = ''
+            ordered = ''
             typ = ''
             size = ''
             for word in words[:-1]:
@@ -150,6 +162,15 @@ class Table(Marble):
                     if not len(index):
                         index = '+'
 
+                elif word == 'bsi':
+                    if index:
+                        raise ValueError("Index already specified on: %s" % column)
+                    else:
+                        index = '^'
+
+                elif word == 'ordered':
+                    ordered = '<'
+
                 elif len(typ):
                     raise ValueError("Too many types specified on: %s" % column)
 
@@ -185,7 +206,13 @@ class Table(Marble):
                 elif len(size):
                     size = sizes[size]
 
-            newtype = index + typ + size + column_name
+            if index == '^' and typ not in ('#', '@'):
+                raise ValueError("Bit-sliced index requires an integer type on: %s" % column)
+
+            if ordered and typ not in ('', '%'):
+                raise ValueError("Ordered requires a trie type on: %s" % column)
+
+            newtype = index + ordered + typ + size + column_name
             fields.append(newtype)
         return fields
 
@@ -229,6 +256,7 @@ class Table(Marble):
 
     def tag(self, **kwargs):
         from hustle.core.settings import Settings
+        from hustle.core.catalog import get_catalog
         if not self.tagged:
             settings = Settings(**kwargs)
             ddfs = settings['ddfs']
@@ -236,6 +264,7 @@ class Table(Marble):
             t = self.create(self._name, fields=self._fields, force=False, **kwargs)
             try:
                 ddfs.tag(self.base_tag(self._name), self._blobs or [])
+                get_catalog(settings).invalidate(self.base_tag(self._name))
                 self.tagged = True
             except Exception:
                 print('Error tagging result %s', self._name)
@@ -245,7 +274,7 @@ class Table(Marble):
 
 def insert(table, File=None, streams=None, preprocess=None,
            maxsize=100 * 1024 * 1024, tmpdir='/tmp', decoder=None,
-           lru_size=10000, header=False, partition_filter=None, purge_local=True, **kwargs):
+           lru_size=10000, header=False, partition_filter=None, purge_local=True, bloom=(), **kwargs):
     """
     Insert data into a Hustle :class:`Table <hustle.Table>`.
 
@@ -321,8 +350,18 @@ def insert(table, File=None, streams=None, preprocess=None,
         will not be automatically cleaned up after successful insertion.
         Setting this to False will also return the partition file information.
 
+    :type bloom: sequence of string
+    :param bloom: the names of the columns to build a Bloom filter of in each marble
+
+        :func:`select() <hustle.select>` skips the marbles whose Bloom filters show that they hold none of the values
+        that the *==* and *<<* expressions of its where clause look for.  This helps with high cardinality columns,
+        like user ids or tokens, whose value ranges tell little about which marbles hold a value.  Only indexed
+        columns can have one, except partition, boolean, lz4 and binary columns, and neither do the marbles with too many distinct values
+        of a column for a filter of :data:`BLOOM_MAX_BYTES <hustle.core.marble.BLOOM_MAX_BYTES>`.
+
     """
     from hustle.core.settings import Settings
+    from hustle.core.catalog import get_catalog
     settings = Settings(**kwargs)
     ddfs = settings['ddfs']
 
@@ -339,16 +378,30 @@ def insert(table, File=None, streams=None, preprocess=None,
     lines, partition_files = table._insert(streams, preprocess=preprocess,
                                            maxsize=maxsize, tmpdir=tmpdir,
                                            decoder=decoder, lru_size=lru_size,
-                                           header=header, partition_filter=partition_filter)
+                                           header=header, partition_filter=partition_filter,
+                                           bloom=bloom)
     if partition_files is not None:
-        for part, pfile in partition_files.iteritems():
-            tag = part_tag(table._name, part)
-            st = os.stat(pfile)
-            ddfs.push(tag, [pfile])
-            print 'pushed %s(%.2fG), %s to %s' % \
-                (part, st.st_size * 1.0 / 1073741824, tag, ddfs)
-            if purge_local:
-                os.unlink(pfile)
+        try:
+            for part, pfile in partition_files.iteritems():
+                tag = part_tag(table._name, part)
+                st = os.stat(pfile)
+                ddfs.push(tag, [pfile])
+                zones = Marble.zone_maps(pfile)
+                if zones:
+                    ddfs.setattr(tag, _ZONES_ATTR + os.path.basename(pfile), ujson.dumps(zones))
+                blooms = Marble.bloom_filters(pfile) if bloom else None
+                if blooms:
+                    # the filters first, so that the columns named in the partition tag always have them
+                    ddfs.setattr(_bloom_tag(tag), os.path.basename(pfile), dump_blooms(blooms))
+                    ddfs.setattr(tag, _BLOOMS_ATTR + os.path.basename(pfile), ujson.dumps(sorted(blooms)))
+                print 'pushed %s(%.2fG), %s to %s' % \
+                    (part, st.st_size * 1.0 / 1073741824, tag, ddfs)
+                if purge_local:
+                    os.unlink(pfile)
+        finally:
+            # the partitions pushed before a failure are visible too
+            get_catalog(settings).invalidate(part_tag(table._name))
+            get_catalog(settings).invalidate(_bloom_tag(part_tag(table._name)))
     return table._name, lines, partition_files
 
 
@@ -513,12 +566,31 @@ def select(*project, **kwargs):
     :type purge: boolean (default = True)
     :param purge: specify whether purge the query related data. This only works when "dump = True" and "profile = False".
 
+    :type hash_join: boolean (default = False)
+    :param hash_join: join with a hash table built from the *where clause* with the fewest *Marbles*, instead of
+        sorting both sides on the join column.  The table is partitioned to disk if it gets too big
+
+    :type broadcast_rows: int (default = 0)
+    :param broadcast_rows: if the *where clause* of a join with the fewest *Marbles* has no more than this many
+        rows, query it first and send its rows to every task, which joins them with the other table as it is read.
+        This saves shuffling both tables to the join stage.  0 disables broadcast joins
+
+    :type semi_join: boolean (default = False)
+    :param semi_join: query the distinct join values of the *where clause* of a join with the fewest *Marbles*
+        first, and only read the rows of the other table that match one of them.  If its join column is an index,
+        this is done with its index as if the where clause had a ``<<`` on it, otherwise as the rows are read
+
+    :type agg_buffer_size: int | string (default = '5%')
+    :param agg_buffer_size: the memory each task may use for the groups of a *group by*, in bytes or as a
+        percentage of physical memory like '5%'.  Past it, groups are passed on to the next stage or spilled to disk
+
     :type kwargs: dict
     :param kwargs: custom settings for this query see :mod:`hustle.core.settings`
 
     """
 
     from hustle.core.settings import Settings
+    from hustle.core.catalog import get_catalog
     from hustle.core.pipeline import SelectPipe
     from hustle.core.util import ensure_list
 
@@ -536,11 +608,15 @@ def select(*project, **kwargs):
     block = settings.pop('block', True)
     autodump = settings.pop('dump', False)
     pre_order_stage = settings.pop('pre_order_stage', ())
-    ddfs = settings['ddfs']
+    catalog = get_catalog(settings)
     partition = settings.pop('partition', 0)
     max_cores = settings.pop('max_cores', 0)
     profile = settings.pop('profile', False)
     purge = settings.pop('purge', True)
+    hash_join = settings.pop('hash_join', False)
+    broadcast_rows = settings.pop('broadcast_rows', 0)
+    semi_join = settings.pop('semi_join', False)
+    agg_buffer_size = settings.pop('agg_buffer_size', '5%')
     if partition < 0:
         partition = 0
     if tag:
@@ -560,9 +636,38 @@ def select(*project, **kwargs):
         return None
 
     name = '-'.join([where._name for where in wheres])[:64]
-    job_blobs = set()
-    for where in wheres:
-        job_blobs.update(tuple(sorted(w)) for w in _get_blobs(where, ddfs))
+    blobs = [_get_blobs(where, catalog) for where in wheres]
+    marbles = [len(b) for b in blobs]
+
+    # join a small enough table with the other one as it is read
+    broadcast = None
+    if join and not full_join and broadcast_rows:
+        small = marbles.index(min(marbles))
+        if _count_rows(wheres[small], blobs[small], settings) <= broadcast_rows:
+            broadcast = (join[1 - small],
+                         _broadcast_table(project, wheres[small], blobs[small], join[small], settings))
+            wheres, blobs, marbles, join = [wheres[1 - small]], [blobs[1 - small]], [], ()
+
+    # only read the rows of the other table that can be joined with the smaller one
+    semi_join_keys = None
+    if join and not full_join and semi_join:
+        small = marbles.index(min(marbles))
+        other = 1 - small
+        keys = _join_keys(wheres[small], blobs[small], join[small], settings)
+        column = join[other]
+        if column.is_index and not column.column_fn:
+            keys_expr = column << keys
+            wheres = list(wheres)
+            wheres[other] = keys_expr if isinstance(wheres[other], Marble) else wheres[other] & keys_expr
+            blobs[other] = _get_blobs(wheres[other], catalog)
+            marbles[other] = len(blobs[other])
+        else:
+            semi_join_keys = (other, keys)
+
+    job_blobs = set(tuple(sorted(w)) for b in blobs for w in b)
+
+    # build the hash join's table from the side with the fewest marbles
+    join_build = marbles.index(min(marbles)) if hash_join and join else 0
 
     job = SelectPipe(settings['server'],
                      wheres=wheres,
@@ -579,7 +684,12 @@ def select(*project, **kwargs):
                      tag=tag,
                      pre_order_stage=pre_order_stage,
                      max_cores=max_cores,
-                     profile=profile)
+                     profile=profile,
+                     hash_join=hash_join,
+                     join_build=join_build,
+                     broadcast=broadcast,
+                     semi_join=semi_join_keys,
+                     agg_buffer_size=agg_buffer_size)
 
     job.run(name='select_from_%s' % name, input=job_blobs, **settings)
     if block:
@@ -618,13 +728,13 @@ def stat(where, limit=16, **kwargs):
     Return a dict of column key cardinalities [0-100] for indexed columns in a table
     """
     from hustle.core.settings import Settings
+    from hustle.core.catalog import get_catalog
     from hustle.core.stat import StatPipe
     from disco.core import result_iterator
     from collections import defaultdict
 
     settings = Settings(**kwargs)
-    ddfs = settings['ddfs']
-    job_blobs = set(tuple(sorted(w)) for w in _get_blobs(where, ddfs, limit))
+    job_blobs = set(tuple(sorted(w)) for w in _get_blobs(where, get_catalog(settings), limit))
     # print job_blobs
     job = StatPipe(settings['server'])
     job.run(name="stat_" + where._name, input=job_blobs, **settings)
@@ -666,7 +776,9 @@ def h_sum(col):
                        col,
                        f=lambda a, v: a + v,
                        default=lambda: 0,
-                       result_spec=Column('_sum_type', type_indicator=mdb.MDB_INT_32))
+                       result_spec=Column('_sum_type', type_indicator=mdb.MDB_INT_32),
+                       ix=lambda stream, name, bitmap: stream.index_sum(name, bitmap)[0],
+                       batch=lambda a, vs: a + sum(vs))
 
 
 def h_count():
@@ -682,7 +794,10 @@ def h_count():
                        Column(name='_count', type_indicator=1),
                        f=lambda a, v: a + v,
                        default=lambda: 0,
-                       result_spec=Column('_count_type', type_indicator=mdb.MDB_UINT_32))
+                       result_spec=Column('_count_type', type_indicator=mdb.MDB_UINT_32),
+                       ix=lambda stream, name, bitmap: len(bitmap) if bitmap is not None
+                       else stream.number_rows - 1,
+                       batch=lambda a, vs: a + sum(vs))
 
 
 def h_max(col):
@@ -703,13 +818,16 @@ def h_max(col):
                            col,
                            f=lambda a, v: a if a > v else v,
                            default=lambda: -9223372036854775808,
-                           result_spec=Column('_max_type', type_indicator=mdb.MDB_INT_32))
+                           result_spec=Column('_max_type', type_indicator=mdb.MDB_INT_32),
+                           ix=lambda stream, name, bitmap: stream.index_max(name, bitmap),
+                           batch=lambda a, vs: max(a, max(vs)))
     else:
         return Aggregation("max",
                            col,
                            f=lambda a, v: a if a > v else v,
                            default=lambda: unichr(0x00),
-                           result_spec=Column('_max_type', type_indicator=mdb.MDB_STR))
+                           result_spec=Column('_max_type', type_indicator=mdb.MDB_STR),
+                           batch=lambda a, vs: max(a, max(vs)))
 
 
 def h_min(col):
@@ -730,13 +848,16 @@ def h_min(col):
                            col,
                            f=lambda a, v: a if a < v else v,
                            default=lambda: 9223372036854775807,
-                           result_spec=Column('_min_type', type_indicator=mdb.MDB_INT_32))
+                           result_spec=Column('_min_type', type_indicator=mdb.MDB_INT_32),
+                           ix=lambda stream, name, bitmap: stream.index_min(name, bitmap),
+                           batch=lambda a, vs: min(a, min(vs)))
     else:
         return Aggregation("min",
                            col,
                            f=lambda a, v: a if a < v else v,
                            default=lambda: unichr(0xFFFF),
-                           result_spec=Column('_min_type', type_indicator=mdb.MDB_STR))
+                           result_spec=Column('_min_type', type_indicator=mdb.MDB_STR),
+                           batch=lambda a, vs: min(a, min(vs)))
 
 
 def h_avg(col):
@@ -754,10 +875,27 @@ def h_avg(col):
 
     return Aggregation("avg",
                        col,
-                       f=lambda (a, c), v: (a + v, c + 1),
+                       f=_h_avg,
                        g=lambda (a, c): float(a) / c,
                        default=lambda: (0, 0),
-                       result_spec=Column('_avg_type', type_indicator=mdb.MDB_INT_32))
+                       result_spec=Column('_avg_type', type_indicator=mdb.MDB_INT_32),
+                       ix=lambda stream, name, bitmap: stream.index_sum(name, bitmap),
+                       batch=_h_avg_batch)
+
+
+def _h_avg((a, c), v):
+    # v is either a value, or a (sum, count) computed from an index
+    if type(v) is tuple:
+        return a + v[0], c + v[1]
+    return a + v, c + 1
+
+
+def _h_avg_batch((a, c), vs):
+    # like _h_avg() for each of vs, which are either all values or all (sum, count)s
+    if type(vs[0]) is tuple:
+        sums, counts = zip(*vs)
+        return a + sum(sums), c + sum(counts)
+    return a + sum(vs), c + len(vs)
 
 
 def _h_combine(a, v, separator):
@@ -834,8 +972,9 @@ def get_tables(**kwargs):
     :param kwargs: custom settings for this query see :mod:`hustle.core.settings`
     """
     from hustle.core.settings import Settings
+    from hustle.core.catalog import get_catalog
     settings = Settings(**kwargs)
-    tags = settings["ddfs"].list(_TAG_PREFIX)
+    tags = get_catalog(settings).list(_TAG_PREFIX)
     uniqs = set()
     for tag in tags:
         l = tag.find(':')
@@ -891,15 +1030,15 @@ def get_partitions(table, **kwargs):
     :param kwargs: custom settings for this query see :mod:`hustle.core.settings`
     """
     from hustle.core.settings import Settings
+    from hustle.core.catalog import get_catalog
     settings = Settings(**kwargs)
-    ddfs = settings["ddfs"]
 
     if isinstance(table, Marble):
         tablename = table._name
     else:
         tablename = table
 
-    tags = ddfs.list(Table.base_tag(tablename) + ":")
+    tags = get_catalog(settings).list(Table.base_tag(tablename) + ":")
     uniqs = set()
     for tag in tags:
         l = tag.find(':')
@@ -922,7 +1061,7 @@ def partitions(table, **kwargs):
                 alignments=[_ALG_LEFT] * len(partitions))
 
 
-def _get_tags(table_or_expr, ddfs):
+def _get_tags(table_or_expr, catalog):
     # assume a table is being passed in
     table = table_or_expr
     where = None
@@ -933,11 +1072,11 @@ def _get_tags(table_or_expr, ddfs):
 
     basetag = table.base_tag(table._name) + ':'
     if where and table._partition:
-        tags = [tag[len(basetag):] for tag in ddfs.list(basetag)]
+        tags = [tag[len(basetag):] for tag in catalog.list(basetag)]
         seltags = [table.base_tag(table._name, part)
                    for part in where.partition(tags)]
     else:
-        seltags = ddfs.list(basetag)
+        seltags = catalog.list(basetag)
     return seltags
 
 
@@ -956,8 +1095,10 @@ def delete(table_or_expr, **kwargs):
         a specific range of partitions, e.g. 'impression.date < 2014-01-01'.
     """
     from hustle.core.settings import Settings
+    from hustle.core.catalog import get_catalog
     settings = Settings(**kwargs)
     ddfs = settings["ddfs"]
+    catalog = get_catalog(settings)
 
     if not isinstance(table_or_expr, (Expr, Table)):
         raise ValueError("The first argument must be a table or an exprssion.")
@@ -965,9 +1106,15 @@ def delete(table_or_expr, **kwargs):
     if isinstance(table_or_expr, Expr) and not table_or_expr.is_partition:
         raise ValueError("Column in the expression must be a partition column.")
 
-    tags = _get_tags(table_or_expr, ddfs)
+    table = getattr(table_or_expr, 'table', table_or_expr)
+    tags = _get_tags(table_or_expr, catalog)
+    sidecars = set(ddfs.list(_bloom_tag(Table.base_tag(table._name)))) if tags else ()
     for tag in tags:
         ddfs.delete(tag)
+        if _bloom_tag(tag) in sidecars:
+            ddfs.delete(_bloom_tag(tag))
+    catalog.invalidate(Table.base_tag(table._name))
+    catalog.invalidate(_bloom_tag(Table.base_tag(table._name)))
 
 
 def drop(table, **kwargs):
@@ -981,6 +1128,7 @@ def drop(table, **kwargs):
     :param kwargs: custom settings for this query see :mod:`hustle.core.settings`
     """
     from hustle.core.settings import Settings
+    from hustle.core.catalog import get_catalog
     settings = Settings(**kwargs)
     ddfs = settings["ddfs"]
 
@@ -989,6 +1137,7 @@ def drop(table, **kwargs):
 
     delete(table, **kwargs)
     ddfs.delete(Table.base_tag(table._name))
+    get_catalog(settings).invalidate(Table.base_tag(table._name))
 
 
 def _query_iterator(blobs):
@@ -1042,7 +1191,7 @@ def _print_line(items, width=80, cols=3, alignments=None):
     print line
 
 
-def _get_blobs(table_or_expr, ddfs, limit=sys.maxint):
+def _get_blobs(table_or_expr, catalog, limit=sys.maxint):
     # assume a table is being passed in
     table = table_or_expr
     where = None
@@ -1056,24 +1205,65 @@ def _get_blobs(table_or_expr, ddfs, limit=sys.maxint):
     elif where and table._partition:
         # collect the blobs
         basetag = table.base_tag(table._name) + ':'
-        tags = [tag[len(basetag):] for tag in ddfs.list(basetag)]
+        tags = [tag[len(basetag):] for tag in catalog.list(basetag)]
         seltags = [table.base_tag(table._name, part)
                    for part in where.partition(tags)]
-        rval = list()
-        for tag in seltags:
-            rval.extend(ddfs.blobs(tag))
-            if len(rval) >= limit:
-                return rval[:limit]
-        return rval
     else:
-        tags = ddfs.list(table.base_tag(table._name))
-        blobs = []
-        for tag in tags:
-            replicas = list(ddfs.blobs(tag))
-            blobs.extend(replicas)
-            if len(blobs) >= limit:
-                return blobs[:limit]
+        seltags = catalog.list(table.base_tag(table._name))
+
+    blobs = []
+    step = max(catalog.threads, 1)
+    for i, tag in enumerate(seltags):
+        if not i % step:
+            # fetch the next few tags at once
+            catalog.prefetch(seltags[i:i + step])
+        blobs.extend(_prune_blobs(catalog, tag, where))
+        if len(blobs) >= limit:
+            return blobs[:limit]
+    return blobs
+
+
+def _blob_name(url):
+    # the name a blob was pushed under, from the url of one of its replicas: .../<name>$<timestamp>
+    return url.rsplit('/', 1)[-1].split('$', 1)[0]
+
+
+def _bloom_tag(tag):
+    # the sidecar tag holding the Bloom filters of the marbles of a partition tag
+    return _BLOOMS_TAG_PREFIX + tag[len(_TAG_PREFIX):]
+
+
+def _can_prune(where):
+    # only the columns that aren't partitions have zone maps and Bloom filters
+    return where is not None and where.f is not None and not where.is_partition
+
+
+def _prune_blobs(catalog, tag, where):
+    """
+    Return the blobs of tag, less the marbles whose zone maps and Bloom filters, published by :func:`insert`,
+    tell that none of their rows can match where.  The sidecar tag of the filters is only read when a marble has
+    one for a column that where looks values up in.
+    """
+    from hustle.core.marble import zone_match, load_blooms, bloom_columns
+
+    blobs = catalog.blobs(tag)
+    if not _can_prune(where) or not blobs:
         return blobs
+    attrs = catalog.attrs(tag)
+    lookups = bloom_columns(where.f)
+    sidecar = None
+    rval = []
+    for replicas in blobs:
+        name = _blob_name(replicas[0])
+        zones = ujson.loads(attrs.get(_ZONES_ATTR + name, '{}'))
+        blooms = None
+        if lookups.intersection(ujson.loads(attrs.get(_BLOOMS_ATTR + name, '[]'))):
+            if sidecar is None:
+                sidecar = catalog.attrs(_bloom_tag(tag))
+            blooms = load_blooms(sidecar.get(name, '{}'))
+        if zone_match(zones, where.f, blooms=blooms):
+            rval.append(replicas)
+    return rval
 
 
 def _resolve_join(wheres, joins):
@@ -1107,6 +1297,66 @@ def _resolve_join(wheres, joins):
     return join_cols
 
 
+def _count_rows(where, blobs, settings):
+    """
+    Return the number of rows in the *Marbles* of a where clause, from their '_total_rows'.  This doesn't
+    apply the where clause, so it is the most rows the where clause could select.
+    """
+    from hustle.core.stat import StatPipe
+    from disco.core import result_iterator
+
+    job = StatPipe(settings['server'])
+    job.run(name="stat_" + where._name, input=set(tuple(sorted(w)) for w in blobs), **settings)
+    res = job.wait()
+    rows = sum(cols['_'] for _, cols in result_iterator(res))
+    settings['server'].purge(_safe_str(job.name))
+    return rows
+
+
+def _broadcast_table(project, where, blobs, join, settings):
+    """
+    Select the join column and the columns in project from the table of a where clause, and return the
+    rows keyed by join value for :func:`_broadcast_join() <hustle.core.pipeline._broadcast_join>`.
+    Each row holds the join value, then a value for every column in project, None for the other table's.
+    """
+    from hustle.core.pipeline import SelectPipe
+
+    table_name = join.table._name
+    columns = [i for i, c in enumerate(project)
+               if c.table is not None and c.table._name == table_name]
+    job = SelectPipe(settings['server'],
+                     wheres=[where],
+                     project=[join] + [project[i].column for i in columns])
+    job.run(name='broadcast_from_%s' % where._name[:64],
+            input=set(tuple(sorted(w)) for w in blobs), **settings)
+
+    rows = {}
+    for values in _query_iterator(job.wait()):
+        row = [values[0]] + [None] * len(project)
+        for i, value in zip(columns, values[1:]):
+            row[i + 1] = value
+        rows.setdefault(values[0], []).append(tuple(row))
+    settings['server'].purge(_safe_str(job.name))
+    return rows
+
+
+def _join_keys(where, blobs, join, settings):
+    """
+    Return the set of distinct values of the join column in the rows a where clause selects.
+    """
+    from hustle.core.pipeline import SelectPipe
+
+    job = SelectPipe(settings['server'],
+                     wheres=[where],
+                     project=[join],
+                     distinct=True)
+    job.run(name='join_keys_from_%s' % where._name[:64],
+            input=set(tuple(sorted(w)) for w in blobs), **settings)
+    keys = set(values[0] for values in _query_iterator(job.wait()))
+    settings['server'].purge(_safe_str(job.name))
+    return keys
+
+
 class QueryResult(object):
     def __init__(self, job_name, blobs, server):
         self.job_name = job_name
@@ -0,0 +1,142 @@
+"""
+:mod:`hustle.core.catalog` -- Client side cache of the DDFS catalog
+===================================================================
+
+Planning a query asks *DDFS* for the tags of a table, for the blobs of each of its selected partition tags and
+for their attributes, which takes seconds on tables with thousands of partitions.  The :class:`Catalog` caches
+these answers for a while, so that the queries, :func:`stat() <hustle.stat>`, :func:`delete() <hustle.delete>`
+and the shell calls of a client share them.
+"""
+from threading import Lock
+
+import time
+
+
+class Catalog(object):
+    """
+    A cache of the tag lists and tags of a *DDFS* server, each kept for ttl seconds, that reads like a
+    :class:`DDFS <disco.ddfs.DDFS>` client.  The blobs and the attributes of a tag come from the same request.
+    :meth:`prefetch` fetches many tags at once, with up to threads requests at a time.
+
+    Writes through :func:`insert() <hustle.insert>`, :func:`delete() <hustle.delete>`,
+    :func:`drop() <hustle.drop>` and :meth:`Table.create() <hustle.Table.create>` :meth:`invalidate` the tags of
+    their table, but writes by other clients are only seen once the entries expire.
+
+    :type ddfs: :class:`DDFS <disco.ddfs.DDFS>`
+    :param ddfs: the client to fetch what isn't cached with
+
+    :type ttl: float
+    :param ttl: the number of seconds to keep the entries, 0 to cache nothing
+
+    :type threads: int
+    :param threads: the most requests :meth:`prefetch` makes at a time
+    """
+    def __init__(self, ddfs, ttl=60, threads=8):
+        self.ddfs = ddfs
+        self.ttl = ttl
+        self.threads = threads
+        self._lock = Lock()
+        # (kind, tag) -> (expiry time, value)
+        self._entries = {}
+        # counts the calls to invalidate(), so that fetches they overlap aren't kept
+        self._generation = 0
+
+    def _cached(self, kind, tag, fetch):
+        key = (kind, tag)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            generation = self._generation
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        value = fetch(tag)
+        if self.ttl > 0:
+            with self._lock:
+                # the value may predate a write invalidated while it was fetched
+                if self._generation == generation:
+                    self._entries[key] = (now + self.ttl, value)
+        return value
+
+    def list(self, prefix):
+        return self._cached('list', prefix, lambda prefix: list(self.ddfs.list(prefix)))
+
+    def get(self, tag):
+        return self._cached('get', tag, self.ddfs.get)
+
+    def blobs(self, tag, _seen=None):
+        # like DDFS.blobs(), the blobs of the tags that tag refers to are its blobs too, and the tags that are
+        # referred to but missing are skipped
+        seen = _seen if _seen is not None else set()
+        seen.add(tag)
+        rval = []
+        for urls in self.get(tag).get('urls', []):
+            if urls and urls[0].startswith('tag://'):
+                ref = urls[0][len('tag://'):]
+                if ref not in seen:
+                    try:
+                        rval.extend(self.blobs(ref, seen))
+                    except Exception as e:
+                        if getattr(e, 'code', None) != 404:
+                            raise
+            else:
+                rval.append(urls)
+        return rval
+
+    def attrs(self, tag):
+        return self.get(tag).get('user-data', {})
+
+    def getattr(self, tag, attr):
+        return self.attrs(tag).get(attr)
+
+    def prefetch(self, tags):
+        """
+        Fetch the tags that aren't cached, with their blobs and attributes, up to threads at a time.
+        """
+        from multiprocessing.pool import ThreadPool
+
+        if self.ttl <= 0:
+            # nothing would be kept
+            return
+        now = time.time()
+        with self._lock:
+            tags = [tag for tag in tags if self._entries.get(('get', tag), (0, ))[0] <= now]
+        if len(tags) < 2 or self.threads < 2:
+            for tag in tags:
+                self.get(tag)
+            return
+        pool = ThreadPool(min(self.threads, len(tags)))
+        try:
+            pool.map(self.get, tags)
+        finally:
+            pool.close()
+            pool.join()
+
+    def invalidate(self, prefix=''):
+        """
+        Forget the entries of the tags, and the lists of the prefixes, that start with prefix, or that prefix
+        starts with, so that lists including them are forgotten too.
+        """
+        with self._lock:
+            self._generation += 1
+            for key in [key for key in self._entries
+                        if key[1].startswith(prefix) or prefix.startswith(key[1])]:
+                del self._entries[key]
+
+
+_catalogs = {}
+
+
+def get_catalog(settings):
+    """
+    Return the :class:`Catalog` of the *DDFS* server of settings, shared by all the calls for that server.
+    """
+    ddfs = settings['ddfs']
+    key = getattr(ddfs, 'master', None) or id(ddfs)
+    catalog = _catalogs.get(key)
+    if catalog is None:
+        catalog = _catalogs[key] = Catalog(ddfs, settings.get('catalog_ttl', 60),
+                                           settings.get('catalog_threads', 8))
+    else:
+        catalog.ttl = settings.get('catalog_ttl', catalog.ttl)
+        catalog.threads = settings.get('catalog_threads', catalog.threads)
+    return catalog
@@ -78,7 +78,7 @@ class ColumnFn(object):
             new_column = Column(column.name, column.table, index_indicator,
                                 column.partition, type_indicator, compression_indicator,
                                 rtrie_indicator, alias=column.alias, boolean=is_boolean,
-                                column_fn=fn)
+                                column_fn=fn, ordered=column.is_ordered)
             return new_column
         return wrap
 
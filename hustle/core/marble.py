@@ -6,10 +6,12 @@
 """
 from collections import defaultdict
 from functools import partial
-from pyebset import BitSet
+from pyebset import BitSet, lor_all
 
+import array
 import clz4
 import mdb
+import operator
 import os
 import rtrie
 import tempfile
@@ -17,6 +19,24 @@ import time
 import ujson
 import sys
 
+# the most values of each trie column that MarbleStream.mget() keeps by VID
+VID_CACHE_SIZE = 10000
+
+# the most MarbleStreams that stream_cache keeps open, and the most bytes of marble files they may map
+STREAM_CACHE_SIZE = 64
+STREAM_CACHE_BYTES = 8 * 1024 * 1024 * 1024
+
+# the most bytes of the bitmaps of where clause predicates that bitmap_cache keeps
+BITMAP_CACHE_BYTES = 256 * 1024 * 1024
+
+# the false positive rate of the Bloom filters built by Marble._insert()
+BLOOM_ERROR_RATE = 0.01
+# the most bytes of a Bloom filter, about 55000 distinct values at BLOOM_ERROR_RATE, columns that need more get none
+BLOOM_MAX_BYTES = 64 * 1024
+
+# whether an array('l') holds the 64-bit integers that IntIntDB.mgetex_into() writes, see MarbleStream.fetch_batch()
+_MGETEX_INTO = array.array('l').itemsize == 8
+
 
 class Marble(object):
     """
@@ -60,7 +80,7 @@ class Marble(object):
 
         for field in fields:
             field, type_indicator, compression_indicator, rtrie_indicator, \
-                index_indicator, boolean = self._parse_index_type(field)
+                index_indicator, boolean, ordered = self._parse_index_type(field)
             part = field == partition
             col = Column(field,
                          self,
@@ -69,7 +89,8 @@ class Marble(object):
                          type_indicator=type_indicator,
                          compression_indicator=compression_indicator,
                          rtrie_indicator=rtrie_indicator,
-                         boolean=boolean)
+                         boolean=boolean,
+                         ordered=ordered)
             self._columns[field] = col
             self.__dict__[field] = col
 
@@ -101,13 +122,23 @@ class Marble(object):
         MDB_UINT_32 - 32 bit VID
         MDB_UINT_16 - 16 bit VID
 
+        The index_indicator:
+        0 - no index
+        1 - bitmap index (+)
+        2 - wide bitmap index (=)
+        3 - bit-sliced index (^), integer types only
+
         The boolean - used to indicate that this field is a boolean type
+
+        The ordered - used only for 0 (rtrie) compression_indicators, the VIDs of the
+        column are assigned in lexicographic order so it supports range queries (<)
         """
         type_indicator = mdb.MDB_STR
         compression_indicator = 0
         rtrie_indicator = mdb.MDB_UINT_32
         index_indicator = 0
         boolean = False
+        ordered = False
 
         nx = ix
         while True:
@@ -162,8 +193,16 @@ class Marble(object):
                     index_indicator = 2
                     ix = nx
                     continue
+                elif ind == '^':
+                    index_indicator = 3
+                    ix = nx
+                    continue
+                elif ind == '<':
+                    ordered = True
+                    ix = nx
+                    continue
             break
-        return nx, type_indicator, compression_indicator, rtrie_indicator, index_indicator, boolean
+        return nx, type_indicator, compression_indicator, rtrie_indicator, index_indicator, boolean, ordered
 
     @classmethod
     def from_file(cls, filename):
@@ -174,12 +213,44 @@ class Marble(object):
                                            False, False,
                                            mdb.MDB_NOSUBDIR | mdb.MDB_NOLOCK)
         try:
-            vals = {k: ujson.loads(v) for k, v in db.items(txn) if not k.startswith('_')}
-            return cls(**vals)
+            return cls._from_meta(txn, db)
+        finally:
+            txn.commit()
+            env.close()
+
+    @classmethod
+    def zone_maps(cls, filename):
+        """
+        Return the zone maps of the columns of a *Marble* file, see :func:`zone_match`.
+        """
+        env, txn, db = mdb.mdb_read_handle(filename, '_meta_', False,
+                                           False, False,
+                                           mdb.MDB_NOSUBDIR | mdb.MDB_NOLOCK)
+        try:
+            return ujson.loads(db.get(txn, '_zones', '{}'))
         finally:
             txn.commit()
             env.close()
 
+    @classmethod
+    def bloom_filters(cls, filename):
+        """
+        Return the :class:`BloomFilters <hustle.core.marble.BloomFilter>` of the columns of a *Marble* file.
+        """
+        env, txn, db = mdb.mdb_read_handle(filename, '_meta_', False,
+                                           False, False,
+                                           mdb.MDB_NOSUBDIR | mdb.MDB_NOLOCK)
+        try:
+            return load_blooms(db.get(txn, '_blooms', '{}'))
+        finally:
+            txn.commit()
+            env.close()
+
+    @classmethod
+    def _from_meta(cls, txn, meta):
+        vals = {k: ujson.loads(v) for k, v in meta.items(txn) if not k.startswith('_')}
+        return cls(**vals)
+
     @classmethod
     def _open_env(cls, filename, maxsize, write):
         # Always open env without locking, since readers and writers never show up
@@ -208,16 +279,24 @@ class Marble(object):
         env = self._open_env(filename, maxsize, write)
         env, txn, dbs, meta = self._open_dbs(env, write, lru_size)
         if not write:
-            partition = ujson.loads(meta.get(txn, 'partition', 'null'))
-            if partition:
-                pdata = ujson.loads(meta.get(txn, '_pdata', 'null'))
-                if pdata is None:
-                    raise ValueError("Can't load partition information from meta table.")
-                db, _, _, _, _ = dbs[partition]
-                db.echome = pdata
+            self._load_partition(txn, dbs, meta)
         return env, txn, dbs, meta
 
-    def _open_dbs(self, env, write, lru_size):
+    def _load_partition(self, txn, dbs, meta):
+        partition = ujson.loads(meta.get(txn, 'partition', 'null'))
+        if partition:
+            pdata = ujson.loads(meta.get(txn, '_pdata', 'null'))
+            if pdata is None:
+                raise ValueError("Can't load partition information from meta table.")
+            db, _, _, _, _ = dbs[partition]
+            db.echome = pdata
+
+    def _open_dbs(self, env, write, lru_size, txn=None, lazy=False):
+        """
+        Open the meta DB and the DBs of every column, in txn if given, else in a new transaction.  If lazy,
+        which is only for reading, the DBs of a column are only opened when it is first looked up in the
+        returned dbs (see :class:`LazyDBs`).
+        """
         from pylru import LRUDict
         from itertools import repeat
 
@@ -330,24 +409,30 @@ class Marble(object):
                 bitmap.lnot_inplace()
                 return bitmap.dumps()
 
-        if write:
-            txn = env.begin_txn()
-        else:
-            txn = env.begin_txn(flags=mdb.MDB_RDONLY)
+        if txn is None:
+            if write:
+                txn = env.begin_txn()
+            else:
+                txn = env.begin_txn(flags=mdb.MDB_RDONLY)
 
         meta = env.open_db(txn, name='_meta_', flags=mdb.MDB_CREATE)
         number_rows = ujson.loads(meta.get(txn, '_total_rows', "0"))
 
-        if not write:
-            dbs = {'_count': (CountDB(number_rows), None, None,
-                              Column('_count', None, type_indicator=1), None)}
-        else:
-            dbs = {}
-        for index, column in self._columns.iteritems():
+        def open_column(index, column):
             subindexdb = None
             bitmap_dict = _dummy
             last = None  # to record the last inserted value
-            if column.index_indicator:
+            if column.is_bsi:
+                # a bit-sliced index is keyed by the slice number
+                subindexdb = env.open_db(txn,
+                                         name="ix:%s" % index,
+                                         flags=mdb.MDB_CREATE | mdb.MDB_INTEGERKEY,
+                                         key_inttype=mdb.MDB_UINT_8)
+                if write:
+                    bitmap_dict = BitSlicedIndex(column)
+                else:
+                    subindexdb = BitSlicedIX(subindexdb, column)
+            elif column.index_indicator:
                 # create an index for this column
                 flags = mdb.MDB_CREATE
                 if column.is_int:
@@ -386,12 +471,23 @@ class Marble(object):
                                     key_inttype=mdb.MDB_UINT_32,
                                     value_inttype=column.get_effective_inttype())
 
-            dbs[index] = (subdb, subindexdb, bitmap_dict, column, last)
+            return subdb, subindexdb, bitmap_dict, column, last
+
+        if not write:
+            dbs = {'_count': (CountDB(number_rows), None, None,
+                              Column('_count', None, type_indicator=1), None)}
+        else:
+            dbs = {}
+        if lazy:
+            dbs = LazyDBs(self._columns, open_column, dbs)
+        else:
+            for index, column in self._columns.iteritems():
+                dbs[index] = open_column(index, column)
         return env, txn, dbs, meta
 
     def _insert(self, streams, preprocess=None, maxsize=1024 * 1024 * 1024,
                 tmpdir='/tmp', decoder=None, lru_size=10000, header=False,
-                verbose=True, partition_filter=None):
+                verbose=True, partition_filter=None, bloom=()):
         """insert a file into the hustle table."""
         from wtrie import Trie
         from collections import Iterable
@@ -401,6 +497,13 @@ class Marble(object):
         if not decoder:
             decoder = json_decoder
 
+        for name in bloom:
+            # where clauses can only look values up in indexed columns
+            column = self._columns.get(name)
+            if column is None or not column.is_index or column.partition or column.is_boolean \
+                    or column.is_lz4 or column.is_binary:
+                raise ValueError("Column %s can't have a Bloom filter." % name)
+
         partitions = {}
         counters = {}
         autoincs = {}
@@ -485,8 +588,8 @@ class Marble(object):
                             txn = env.begin_txn()
                         #TODO: a bit a hack - need to reset txns and dbs for all of our indexes
                         #  (iff they are LRUDicts)
-                        for index, (_, subindexdb, bitmap_dict, _, _) in dbs.iteritems():
-                            if bitmap_dict is not _dummy and type(bitmap_dict) is not defaultdict:
+                        for index, (_, subindexdb, bitmap_dict, column, _) in dbs.iteritems():
+                            if column.is_wide:
                                 lru_evict = bitmap_dict._Evict
                                 lru_fetch = bitmap_dict._Fetch
                                 lru_evict.txn = lru_fetch.txn = txn
@@ -496,6 +599,9 @@ class Marble(object):
 
                     updated_dbs = _insert_row(data, txn, dbs, autoincs[pdata],
                                               vid_tries[pdata], vid16_tries[pdata])
+                    if updated_dbs is False:
+                        # the row was rejected, its RID goes to the next one
+                        continue
                     autoincs[pdata] += 1
                     counters[pdata] += 1
                     if updated_dbs:
@@ -507,16 +613,6 @@ class Marble(object):
                 try:
                     meta.put(txn, '_total_rows', str(autoincs[pdata]))
                     total_records += autoincs[pdata] - 1
-                    vid_nodes, vid_kids, _ = vid_tries[pdata].serialize()
-                    vid16_nodes, vid16_kids, _ = vid16_tries[pdata].serialize()
-                    vn_ptr, vn_len = vid_nodes.buffer_info()
-                    vk_ptr, vk_len = vid_kids.buffer_info()
-                    vn16_ptr, vn16_len = vid16_nodes.buffer_info()
-                    vk16_ptr, vk16_len = vid16_kids.buffer_info()
-                    meta.put_raw(txn, '_vid_nodes', vn_ptr, vn_len)
-                    meta.put_raw(txn, '_vid_kids', vk_ptr, vk_len)
-                    meta.put_raw(txn, '_vid16_nodes', vn16_ptr, vn16_len)
-                    meta.put_raw(txn, '_vid16_kids', vk16_ptr, vk16_len)
                     meta.put(txn, 'name', ujson.dumps(self._name))
                     meta.put(txn, 'fields', ujson.dumps(self._fields))
                     meta.put(txn, 'partition', ujson.dumps(self._partition))
@@ -531,6 +627,22 @@ class Marble(object):
                                     subindexdb.put(txn, val, bitmap.dumps())
                         # insert a sentinel row to value table
                         subdb.put(txn, autoincs[pdata], last)
+                    _order_tries(txn, dbs, meta, vid_tries[pdata], vid16_tries[pdata])
+                    vid_nodes, vid_kids, _ = vid_tries[pdata].serialize()
+                    vid16_nodes, vid16_kids, _ = vid16_tries[pdata].serialize()
+                    vn_ptr, vn_len = vid_nodes.buffer_info()
+                    vk_ptr, vk_len = vid_kids.buffer_info()
+                    vn16_ptr, vn16_len = vid16_nodes.buffer_info()
+                    vk16_ptr, vk16_len = vid16_kids.buffer_info()
+                    meta.put_raw(txn, '_vid_nodes', vn_ptr, vn_len)
+                    meta.put_raw(txn, '_vid_kids', vk_ptr, vk_len)
+                    meta.put_raw(txn, '_vid16_nodes', vn16_ptr, vn16_len)
+                    meta.put_raw(txn, '_vid16_kids', vk16_ptr, vk16_len)
+                    meta.put(txn, '_zones', ujson.dumps(_zone_maps(txn, dbs, vn_ptr, vk_ptr,
+                                                                   vn16_ptr, vk16_ptr)))
+                    if bloom:
+                        meta.put(txn, '_blooms', dump_blooms(_bloom_filters(txn, dbs, bloom, vn_ptr, vk_ptr,
+                                                                            vn16_ptr, vk16_ptr)))
                     txn.commit()
                 except Exception as e:
                     print "Error writing to MDB: %s" % e
@@ -563,25 +675,115 @@ class Marble(object):
 class MarbleStream(object):
     def __init__(self, local_file):
         import socket
-        self.marble = Marble.from_file(local_file)
-        self.env, self.txn, self.dbs, self.meta = self.marble._open(local_file, write=False)
+        st = os.stat(local_file)
+        self.path = local_file
+        self.identity = (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+        # open the env once, for both the schema and the data, and only open the DBs of the columns used
+        self.env = Marble._open_env(local_file, 100 * 1024 * 1024, False)
+        self.txn = self.env.begin_txn(flags=mdb.MDB_RDONLY)
+        self.marble = Marble._from_meta(self.txn, self.env.open_db(self.txn, name='_meta_'))
+        _, _, self.dbs, self.meta = self.marble._open_dbs(self.env, False, 10000, txn=self.txn, lazy=True)
+        self.marble._load_partition(self.txn, self.dbs, self.meta)
         self.number_rows = ujson.loads(self.meta.get(self.txn, '_total_rows'))
-        self.vid_nodes, _ = self.meta.get_raw(self.txn, '_vid_nodes')
+        self.vid_nodes, vid_len = self.meta.get_raw(self.txn, '_vid_nodes')
         self.vid_kids, _ = self.meta.get_raw(self.txn, '_vid_kids')
-        self.vid16_nodes, _ = self.meta.get_raw(self.txn, '_vid16_nodes', (None, 0))
+        self.vid16_nodes, vid16_len = self.meta.get_raw(self.txn, '_vid16_nodes', (None, 0))
         self.vid16_kids, _ = self.meta.get_raw(self.txn, '_vid16_kids', (None, 0))
+        # the node arrays hold 4 bytes per node, ie. per VID
+        self.vid_size = vid_len / 4
+        self.vid16_size = vid16_len / 4
+        self.vid_sorted = ujson.loads(self.meta.get(self.txn, '_vid_sorted', 'false'))
+        self.vid16_sorted = ujson.loads(self.meta.get(self.txn, '_vid16_sorted', 'false'))
         self.partition = ujson.loads(self.meta.get(self.txn, 'partition', 'null'))
         self.pdata = ujson.loads(self.meta.get(self.txn, '_pdata', 'null'))
         self.host = socket.gethostname()
+        self._vid_caches = {}
 
     def iter_all(self):
         return xrange(1, self.number_rows)
 
+    def _trie(self, column):
+        if column.rtrie_indicator == mdb.MDB_UINT_16:
+            return self.vid16_nodes, self.vid16_kids
+        return self.vid_nodes, self.vid_kids
+
+    def _vid_cache(self, column):
+        """
+        Return the LRU cache of the values of a trie column by VID, of up to VID_CACHE_SIZE values,
+        which decodes the ones it doesn't have.  Repeated VIDs then get the same value object.
+        """
+        from pylru import LRUDict
+
+        cache = self._vid_caches.get(column.name)
+        if cache is None:
+            nodes, kids = self._trie(column)
+            cache = LRUDict.getDict(VID_CACHE_SIZE,
+                                    lambda vid: rtrie.value_for_vid(nodes, kids, vid),
+                                    lambda vid, value: None,
+                                    True)
+            self._vid_caches[column.name] = cache
+        return cache
+
     def mget(self, column_name, keys):
         db, _, _, column, _ = self.dbs[column_name]
-        for data in db.mgetex(self.txn, keys):
-            yield column.fetcher(data, self.vid16_nodes, self.vid16_kids,
-                                 self.vid_nodes, self.vid_kids)
+        if column.is_trie:
+            cache = self._vid_cache(column)
+            for vid in db.mgetex(self.txn, keys):
+                yield cache.get(vid)
+        else:
+            for data in db.mgetex(self.txn, keys):
+                yield column.fetcher(data, self.vid16_nodes, self.vid16_kids,
+                                     self.vid_nodes, self.vid_kids)
+
+    def fetch_batch(self, column_names, rids, decode=True):
+        """
+        Return a sequence of values for each of the columns, for rids, an ascending list of RIDs.
+
+        Integer columns are read by :meth:`IntIntDB.mgetex_into` into an ``array('l')``.  So are trie
+        columns, as VIDs, and then unless decode is False, decoded into a list by ``rtrie.values_for_vids``,
+        which decodes each distinct VID once.  Where a C long isn't 64 bits, they are read into lists by
+        :meth:`IntIntDB.mgetex` instead.  The other columns are read into lists by :meth:`mget`.
+        """
+        from array import array
+
+        rval = []
+        for column_name in column_names:
+            db, _, _, column, _ = self.dbs[column_name]
+            if isinstance(db, mdb.IntIntDB) and column.get_effective_inttype() != mdb.MDB_UINT_64:
+                if _MGETEX_INTO:
+                    values = array('l', [0]) * len(rids)
+                    db.mgetex_into(self.txn, rids, values)
+                else:
+                    values = list(db.mgetex(self.txn, rids))
+                if column.is_trie and decode:
+                    nodes, kids = self._trie(column)
+                    values = rtrie.values_for_vids(nodes, kids, values)
+            else:
+                values = list(self.mget(column_name, rids))
+            rval.append(values)
+        return rval
+
+    def vid_decoder(self, column_name):
+        """
+        Return a function that returns the value for a VID of a trie column, like its fetcher.  It decodes
+        from a copy of the trie, so it still works after the stream is closed.
+        """
+        from array import array
+        from ctypes import string_at
+
+        _, _, _, column, _ = self.dbs[column_name]
+        if column.rtrie_indicator == mdb.MDB_UINT_16:
+            names = ('_vid16_nodes', '_vid16_kids')
+        else:
+            names = ('_vid_nodes', '_vid_kids')
+        nodes, kids = (array('c', string_at(*self.meta.get_raw(self.txn, name))) for name in names)
+        nodes_ptr, _ = nodes.buffer_info()
+        kids_ptr, _ = kids.buffer_info()
+
+        def decode(vid):
+            # keep the arrays alive as long as the function
+            return rtrie.value_for_vid(nodes_ptr, kids_ptr, vid) if nodes and kids else None
+        return decode
 
     def get(self, column_name, key):
         """
@@ -594,6 +796,63 @@ class MarbleStream(object):
         return column.fetcher(lower[1], self.vid16_nodes, self.vid16_kids,
                               self.vid_nodes, self.vid_kids)
 
+    def group_counts(self, column_name, bitmap=None):
+        """
+        Generate (value, count) for every distinct value of an indexed column, counting only the rows in
+        bitmap (all rows if None).  The counts come from the index bitmaps, so no rows are read and each
+        value is decoded only once.
+        """
+        _, idb, _, column, _ = self.dbs[column_name]
+        for key, data in idb.items(self.txn):
+            bm = BitSet()
+            bm.loads(data)
+            if bitmap is not None:
+                bm = bm & bitmap
+            count = len(bm)
+            if count:
+                yield column.fetcher(key, self.vid16_nodes, self.vid16_kids,
+                                     self.vid_nodes, self.vid_kids), count
+
+    def index_sum(self, column_name, bitmap=None):
+        """
+        Return the (sum, count) of an indexed integer column over the rows in bitmap (all rows if None),
+        computed from the index alone.
+        """
+        _, idb, _, column, _ = self.dbs[column_name]
+        if column.is_bsi:
+            return idb.sum(self.txn, bitmap if bitmap is not None else idb.slices(self.txn)[0])
+        total = count = 0
+        for value, n in self.group_counts(column_name, bitmap):
+            total += value * n
+            count += n
+        return total, count
+
+    def _index_extreme(self, column_name, bitmap, largest):
+        _, idb, _, column, _ = self.dbs[column_name]
+        if column.is_bsi:
+            if bitmap is None:
+                bitmap = idb.slices(self.txn)[0]
+            return idb.max(self.txn, bitmap) if largest else idb.min(self.txn, bitmap)
+        # signed 32 and 64 bit keys aren't stored in numeric order, so look at all of them
+        values = [value for value, _ in self.group_counts(column_name, bitmap)]
+        if not values:
+            return None
+        return max(values) if largest else min(values)
+
+    def index_min(self, column_name, bitmap=None):
+        """
+        Return the smallest value of an indexed column over the rows in bitmap (all rows if None),
+        computed from the index alone.  Returns None if there are no such rows.
+        """
+        return self._index_extreme(column_name, bitmap, False)
+
+    def index_max(self, column_name, bitmap=None):
+        """
+        Return the largest value of an indexed column over the rows in bitmap (all rows if None),
+        computed from the index alone.  Returns None if there are no such rows.
+        """
+        return self._index_extreme(column_name, bitmap, True)
+
     def _vid_for_value(self, column, key):
         if column.is_trie:
             if column.rtrie_indicator == mdb.MDB_UINT_16:
@@ -606,6 +865,8 @@ class MarbleStream(object):
 
     def bit_eq(self, ix, key):
         _, idb, _, column, _ = self.dbs[ix]
+        if column.is_bsi:
+            return idb.eq(self.txn, key)
         rval = BitSet()
         zkey = self._vid_for_value(column, key)
         if zkey is not None:
@@ -616,6 +877,8 @@ class MarbleStream(object):
 
     def bit_ne(self, ix, key):
         _, idb, _, column, _ = self.dbs[ix]
+        if column.is_bsi:
+            return idb.ne(self.txn, key)
         rval = BitSet()
         key = self._vid_for_value(column, key)
         if key is not None:
@@ -627,71 +890,113 @@ class MarbleStream(object):
                 rval.lnot_inplace()
         return rval
 
-    def bit_eq_ex(self, ix, keys):
+    def _flat_keys(self, keys):
         from collections import Iterable
-        _, idb, _, column, _ = self.dbs[ix]
-        rval = BitSet()
         for key in keys:
             if isinstance(key, Iterable) and not isinstance(key, (basestring, unicode)):
                 # in case the key is a composite object, just grab the first one
                 key = key[0]
+            yield key
+
+    def _bitmaps_for_keys(self, ix, keys):
+        _, idb, _, column, _ = self.dbs[ix]
+        for key in self._flat_keys(keys):
             zkey = self._vid_for_value(column, key)
             if zkey is not None:
-                val = idb.get(self.txn, zkey)
-                if val is not None:
-                    bitset = BitSet()
-                    bitset.loads(val)
-                    rval |= bitset
-        return rval
+                yield idb.get(self.txn, zkey)
+
+    def bit_eq_ex(self, ix, keys):
+        _, idb, _, column, _ = self.dbs[ix]
+        if column.is_bsi:
+            return idb.eq_ex(self.txn, self._flat_keys(keys))
+        return lor_all(self._bitmaps_for_keys(ix, keys))
 
     def bit_ne_ex(self, ix, keys):
-        from collections import Iterable
         _, idb, _, column, _ = self.dbs[ix]
-        rval = BitSet()
-        for key in keys:
-            if isinstance(key, Iterable) and not isinstance(key, (basestring, unicode)):
-                # in case the key is a composite object, just grab the first one
-                key = key[0]
-            zkey = self._vid_for_value(column, key)
-            if zkey is not None:
-                val = idb.get(self.txn, zkey)
-                if val is not None:
-                    bitset = BitSet()
-                    bitset.loads(val)
-                    rval |= bitset
+        if column.is_bsi:
+            return idb.ne_ex(self.txn, self._flat_keys(keys))
+        rval = lor_all(self._bitmaps_for_keys(ix, keys))
         rval |= ZERO_BS
         rval.set(self.number_rows)
         rval.lnot_inplace()
         return rval
 
     def _bit_op(self, val, op):
-        rval = BitSet()
-        it = op(self.txn, val)
-        for _, v in it:
-            if v is None:
-                continue
-            bitset = BitSet()
-            bitset.loads(v)
-            rval |= bitset
-        return rval
+        # union all of the bitmaps in the key range at once, see lor_all()
+        return lor_all(v for _, v in op(self.txn, val))
+
+    def _trie_bit_op(self, column, idb, val, op):
+        """
+        Range queries on ordered trie columns.  The VIDs of an ordered trie sort like their values, so
+        we find the first VID not less than val and run the range over the VIDs in the index instead.
+        """
+        if column.rtrie_indicator == mdb.MDB_UINT_16:
+            nodes, kids = self.vid16_nodes, self.vid16_kids
+            size, is_sorted = self.vid16_size, self.vid16_sorted
+        else:
+            nodes, kids = self.vid_nodes, self.vid_kids
+            size, is_sorted = self.vid_size, self.vid_sorted
+        val = _convert_str(val)
+
+        if not is_sorted:
+            # the column was declared ordered after this marble was written, so decode every value
+            return lor_all(v for vid, v in idb.items(self.txn)
+                           if op(rtrie.value_for_vid(nodes, kids, vid), val))
+
+        lo, hi = 0, size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if rtrie.value_for_vid(nodes, kids, mid) < val:
+                lo = mid + 1
+            else:
+                hi = mid
+        exact = lo < size and rtrie.value_for_vid(nodes, kids, lo) == val
+
+        if op in (operator.lt, operator.le):
+            if lo >= size:
+                return lor_all(v for _, v in idb.items(self.txn))
+            cursor = idb.get_le if op is operator.le and exact else idb.get_lt
+        else:
+            if lo >= size:
+                return BitSet()
+            cursor = idb.get_gt if op is operator.gt and exact else idb.get_ge
+        return self._bit_op(lo, cursor)
 
     def bit_lt(self, ix, val):
-        _, idb, _, _, _ = self.dbs[ix]
+        _, idb, _, column, _ = self.dbs[ix]
+        if column.is_bsi:
+            return idb.lt(self.txn, val)
+        elif column.is_trie:
+            return self._trie_bit_op(column, idb, val, operator.lt)
         return self._bit_op(val, idb.get_lt)
 
     def bit_gt(self, ix, val):
-        _, idb, _, _, _ = self.dbs[ix]
+        _, idb, _, column, _ = self.dbs[ix]
+        if column.is_bsi:
+            return idb.gt(self.txn, val)
+        elif column.is_trie:
+            return self._trie_bit_op(column, idb, val, operator.gt)
         return self._bit_op(val, idb.get_gt)
 
     def bit_le(self, ix, val):
-        _, idb, _, _, _ = self.dbs[ix]
+        _, idb, _, column, _ = self.dbs[ix]
+        if column.is_bsi:
+            return idb.le(self.txn, val)
+        elif column.is_trie:
+            return self._trie_bit_op(column, idb, val, operator.le)
         return self._bit_op(val, idb.get_le)
 
     def bit_ge(self, ix, val):
-        _, idb, _, _, _ = self.dbs[ix]
+        _, idb, _, column, _ = self.dbs[ix]
+        if column.is_bsi:
+            return idb.ge(self.txn, val)
+        elif column.is_trie:
+            return self._trie_bit_op(column, idb, val, operator.ge)
         return self._bit_op(val, idb.get_ge)
 
     def close(self):
+        # the caches' decoders refer to the trie in the closing environment
+        self._vid_caches = {}
         try:
             self.txn.commit()
             self.env.close()
@@ -699,6 +1004,194 @@ class MarbleStream(object):
             pass
 
 
+class MarbleStreamCache(object):
+    """
+    An LRU cache of open, read only :class:`MarbleStreams <hustle.core.marble.MarbleStream>` by local file, so
+    that the queries of a long lived worker process reuse the environments, and the warm mmaps and decoded
+    VIDs, of the marbles they share.  A stream is reopened if its file is replaced, as told by its device,
+    inode, mtime and size.
+
+    At most max_open streams are kept open, with files of at most max_bytes in all.  A stream evicted while
+    it is in use is closed when it is released.
+
+    :type max_open: int
+    :param max_open: the most streams, and so LMDB environments and file descriptors, to keep open
+
+    :type max_bytes: int
+    :param max_bytes: the most bytes of marble files, and so of memory maps, to keep open
+    """
+    def __init__(self, max_open=STREAM_CACHE_SIZE, max_bytes=STREAM_CACHE_BYTES):
+        from collections import OrderedDict
+        from threading import Lock
+
+        self.max_open = max_open
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        # local file -> [identity, stream, size, users], least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # id(stream) -> entry, of the streams that are in use
+        self._in_use = {}
+
+    def open(self, local_file):
+        """
+        Return a :class:`MarbleStream <hustle.core.marble.MarbleStream>` of local_file, which must be given
+        back to :meth:`release` instead of being closed.
+        """
+        st = os.stat(local_file)
+        identity = (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+        with self._lock:
+            entry = self._entries.pop(local_file, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+                if entry[0] != identity:
+                    self._discard(entry)
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                entry = [identity, MarbleStream(local_file), st.st_size, 0]
+            else:
+                self.hits += 1
+            entry[3] += 1
+            self._in_use[id(entry[1])] = entry
+            self._entries[local_file] = entry
+            self._bytes += entry[2]
+            self._evict()
+            return entry[1]
+
+    def release(self, stream):
+        """
+        Give back a stream returned by :meth:`open`.
+        """
+        with self._lock:
+            entry = self._in_use[id(stream)]
+            entry[3] -= 1
+            if not entry[3]:
+                del self._in_use[id(stream)]
+                if entry[0] is None:
+                    # it was evicted while in use
+                    stream.close()
+
+    def clear(self):
+        """
+        Close all the streams that are not in use, and those that are when they are released.
+        """
+        with self._lock:
+            while self._entries:
+                self._discard(self._entries.popitem(last=False)[1])
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_open or self._bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry[2]
+            self._discard(entry)
+
+    def _discard(self, entry):
+        if entry[3]:
+            entry[0] = None
+        else:
+            entry[1].close()
+
+
+# the streams of the marbles read by this process
+stream_cache = MarbleStreamCache()
+
+
+class BitmapCache(object):
+    """
+    An LRU cache of the bitmaps of the column predicates of where clauses, like :code:`date == today` or
+    :code:`ad_id << ids`, by marble file, column, operator and operand, so that queries repeating a predicate
+    over the same marbles don't read and load its bitmap from the index again.  Marbles never change once
+    written, and a file replaced under the same path has another identity, so entries are never invalidated.
+
+    The cached bitmaps are shared, so they must not be modified.
+
+    :type max_bytes: int
+    :param max_bytes: the most bytes of bitmaps to keep
+    """
+    def __init__(self, max_bytes=BITMAP_CACHE_BYTES):
+        from collections import OrderedDict
+        from threading import Lock
+
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        # key -> (bitmap, size), least recently used first
+        self._bitmaps = OrderedDict()
+        self._bytes = 0
+
+    def get(self, tablet, invert, f):
+        """
+        Return f(tablet, invert) for f, the function of a column predicate, a partial of one of the
+        :code:`in_*` functions, from the cache if it's there.
+        """
+        key = self._key(tablet, invert, f)
+        if key is None:
+            return f(tablet, invert)
+
+        with self._lock:
+            entry = self._bitmaps.pop(key, None)
+            if entry is not None:
+                self.hits += 1
+                self._bitmaps[key] = entry
+                return entry[0]
+            self.misses += 1
+
+        bitmap = f(tablet, invert)
+        if type(bitmap) is BitSet:
+            size = bitmap.size_in_bytes()
+            with self._lock:
+                if key not in self._bitmaps:
+                    self._bitmaps[key] = (bitmap, size)
+                    self._bytes += size
+                while self._bitmaps and self._bytes > self.max_bytes:
+                    _, (_, size) = self._bitmaps.popitem(last=False)
+                    self._bytes -= size
+        return bitmap
+
+    def peek(self, tablet, invert, f):
+        """
+        Return the cached f(tablet, invert), or None if it isn't cached, without counting a hit or a miss.
+        """
+        key = self._key(tablet, invert, f)
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._bitmaps.get(key)
+        return entry[0] if entry is not None else None
+
+    @staticmethod
+    def _key(tablet, invert, f):
+        try:
+            other = f.keywords['other']
+            if isinstance(other, (list, set, tuple)):
+                other = frozenset(other)
+            key = (tablet.path, tablet.identity, f.keywords['col'], f.func.__name__, invert, other)
+            hash(key)
+            return key
+        except (AttributeError, KeyError, TypeError):
+            return None
+
+    def clear(self):
+        with self._lock:
+            self._bitmaps.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._bitmaps)
+
+
+# the bitmaps of the predicates evaluated by this process
+bitmap_cache = BitmapCache()
+
+
 class Column(object):
     """
     A *Column* is the named, typed field of a :class:`Marble <hustle.core.marble.Marble>`.   *Columns* are typically
@@ -729,7 +1222,7 @@ class Column(object):
     """
     def __init__(self, name, table=None, index_indicator=0, partition=False, type_indicator=0,
                  compression_indicator=0, rtrie_indicator=mdb.MDB_UINT_32, alias=None, boolean=False,
-                 column_fn=None):
+                 column_fn=None, ordered=False):
         self.name = name
         self.fullname = "%s.%s" % (table._name, name) if hasattr(table, '_name') else name
         self.table = table
@@ -747,6 +1240,8 @@ class Column(object):
         self.is_numeric = self.type_indicator > 0
         self.is_index = self.index_indicator > 0
         self.is_wide = self.index_indicator == 2
+        self.is_bsi = self.index_indicator == 3
+        self.is_ordered = self.is_trie and ordered
         self.column_fn = column_fn
 
         # use dictionary (trie) compression if required
@@ -780,7 +1275,7 @@ class Column(object):
         newcol = Column(self.name, self.table, self.index_indicator, self.partition,
                         self.type_indicator, self.compression_indicator,
                         self.rtrie_indicator, alias, boolean = self.is_boolean,
-                        column_fn=self.column_fn)
+                        column_fn=self.column_fn, ordered=self.is_ordered)
         return newcol
 
     @property
@@ -793,12 +1288,14 @@ class Column(object):
         result, so we need to use the alias.
         """
         rval = self.alias or self.name or ''
-        indexes = ['', '+', '=']
+        indexes = ['', '+', '=', '^']
         prefix = indexes[self.index_indicator]
         lookup = ['', '#4', '@4', '#2', '@2', '#1', '@1', '#8', '@8']
 
         if self.type_indicator == mdb.MDB_STR:
             if self.compression_indicator == 0:
+                if self.is_ordered:
+                    prefix += '<'
                 prefix += '%'
                 if self.rtrie_indicator == mdb.MDB_UINT_32:
                     prefix += '4'
@@ -824,7 +1321,7 @@ class Column(object):
                        'uint8', 'int64', 'uint64']
         dict_lookup = ['', '', '32', '', '16', '', '']
         string_lookup = ['trie', 'string', 'lz4', 'binary']
-        index_lookup = ['', 'index', 'wide index']
+        index_lookup = ['', 'index', 'wide index', 'bsi']
 
         rval = type_lookup[self.type_indicator]
         if not self.type_indicator:
@@ -836,10 +1333,20 @@ class Column(object):
         inds = [rval, name]
         if self.is_boolean:
             inds = ['bit', name]
-        elif self.index_indicator:
-            inds.insert(0, index_lookup[self.index_indicator])
+        else:
+            if self.is_ordered:
+                inds.insert(0, 'ordered')
+            if self.index_indicator:
+                inds.insert(0, index_lookup[self.index_indicator])
         return ' '.join(inds)
 
+    @property
+    def bit_width(self):
+        """
+        The number of bits in the integer representation of this column.
+        """
+        return [0, 32, 32, 16, 16, 8, 8, 64, 64][self.get_effective_inttype()]
+
     def get_effective_inttype(self):
         if self.type_indicator == mdb.MDB_STR and self.compression_indicator == 0:
             return self.rtrie_indicator
@@ -848,7 +1355,7 @@ class Column(object):
     def _get_expr(self, op, part_op, other):
         if not self.partition \
                 and op in [in_lt, in_gt, in_ge, in_le] \
-                and (self.is_trie or self.is_lz4 or self.is_binary):
+                and ((self.is_trie and not self.is_ordered) or self.is_lz4 or self.is_binary):
             raise TypeError("Column %s doesn't support range query."
                             % self.fullname)
         if not self.is_index:
@@ -909,6 +1416,13 @@ def dflt_f(a, v):
     return v
 
 
+def dflt_batch(a, vs):
+    """
+    Default 'batch' function for group by columns, like dflt_f() for the last of the values
+    """
+    return vs[-1]
+
+
 class Aggregation(object):
     """
     An *Aggregation* is a Column Function that represents some aggregating computation over the values of that
@@ -935,6 +1449,16 @@ class Aggregation(object):
     :type name: basestring
     :param name: the unique name of the aggregator.  Used to assign a column name to the result
 
+    :type ix: func(stream, column_name, bitmap)
+    :param ix: optional, computes a value for the rows of a :class:`MarbleStream` in *bitmap* (all rows if None)
+        from the *column's* index alone, such that passing it to *f()* once gives the same accumulator as passing
+        every row's value.  If all of the *Aggregations* of a query have one, rows are never read
+
+    :type batch: func(accumulator, values)
+    :param batch: optional, returns the same accumulator as calling *f()* for each of a sequence of values in turn,
+        usually with a builtin like sum() that loops in C.  If all of the *Aggregations* of a query have one,
+        rows are aggregated in batches instead of one *f()* call per *Aggregation* per row
+
     .. note::
 
         Here is the actual implementation of the h_avg() *Aggregation* which will give us the average value
@@ -974,13 +1498,15 @@ class Aggregation(object):
 
     """
     def __init__(self, name, column, f=None, g=dflt_gh, h=dflt_gh,
-                 default=dflt_default, result_spec=None):
+                 default=dflt_default, result_spec=None, ix=None, batch=None):
 
         self.column = column
         self.f = f
         self.g = g
         self.h = h
         self.default = default
+        self.ix = ix
+        self.batch = batch
         self.name = "%s(%s)" % (name, column.name if column else '')
         self.fullname = "%s(%s)" % (name, column.fullname if column else '')
         self.result_spec = result_spec
@@ -994,7 +1520,8 @@ class Aggregation(object):
 
     def named(self, alias):
         newag = Aggregation(self.name, self.column.named(alias), self.f,
-                            self.g, self.h, self.default, self.result_spec)
+                            self.g, self.h, self.default, self.result_spec, self.ix,
+                            self.batch)
         return newag
 
     def schema_string(self):
@@ -1185,7 +1712,7 @@ class Expr(object):
                         self.is_partition)
 
     def __call__(self, tablet, invert=False):
-        return self.f(tablet, invert)
+        return _evaluate(tablet, invert, self.f)
 
     def partition(self, tags, invert=False):
         return self.part_f(tags, invert)
@@ -1246,10 +1773,17 @@ def _fetch_me(data, vid16_nodes, vid16_kids, vid_nodes, vid_kids):
     return data
 
 
+def _evaluate(tablet, invert, expr):
+    # the bitmaps of column predicates come from bitmap_cache
+    if type(expr) is partial and expr.func in _PREDICATES:
+        return bitmap_cache.get(tablet, invert, expr)
+    return expr(tablet, invert)
+
+
 def in_not(obj, invert, expr):
     if expr is None:
         return BitSet()
-    return expr(obj, not invert)
+    return _evaluate(obj, not invert, expr)
 
 
 def part_all(tags, invert=False):
@@ -1275,19 +1809,68 @@ def part_conditional(obj, invert, op, l_expr, r_expr):
                 yield uid
 
 
+def _is_and(op, invert):
+    return (op == 'and' and not invert) or (op == 'or' and invert)
+
+
+def _and_legs(invert, expr):
+    # the legs of expr, flattened through its nested ands
+    if type(expr) is partial and expr.func is in_conditional and _is_and(expr.keywords['op'], invert):
+        return [leg for e in (expr.keywords['l_expr'], expr.keywords['r_expr']) if e is not None
+                for leg in _and_legs(invert, e)]
+    return [expr]
+
+
+def _estimate(tablet, invert, expr):
+    """
+    Estimate the number of rows of tablet that match expr, without reading any bitmap.  It is exact for
+    the predicates in bitmap_cache.  Otherwise (in)equalities assume every distinct value of the index
+    (its ms_entries) has as many rows, and ranges match a third of the rows.
+    """
+    rows = float(tablet.number_rows)
+    if type(expr) is not partial:
+        return rows
+    elif expr.func in _PREDICATES:
+        bitmap = bitmap_cache.peek(tablet, invert, expr)
+        if bitmap is not None:
+            return len(bitmap)
+        op = _INVERSES[expr.func] if invert else expr.func
+        _, idb, _, column, _ = tablet.dbs[expr.keywords['col']]
+        if column.is_bsi or op not in (in_eq, in_ne, in_in, in_not_in):
+            return rows / 3
+        matches = rows / max(idb.stat(tablet.txn)['ms_entries'], 1)
+        if op in (in_in, in_not_in):
+            matches = min(rows, matches * len(expr.keywords['other']))
+        return matches if op in (in_eq, in_in) else rows - matches
+    elif expr.func is in_conditional:
+        legs = [_estimate(tablet, invert, e) if e is not None else rows
+                for e in (expr.keywords['l_expr'], expr.keywords['r_expr'])]
+        return min(legs) if _is_and(expr.keywords['op'], invert) else min(rows, sum(legs))
+    elif expr.func is in_not:
+        return rows - _estimate(tablet, not invert, expr.keywords['expr'])
+    return rows
+
+
 def in_conditional(tablet, invert, op, l_expr, r_expr):
-    if (op == 'and' and not invert) or (op == 'or' and invert):
-        # and
-        if l_expr is None:
-            return r_expr(tablet, invert)
-        elif r_expr is None:
-            return l_expr(tablet, invert)
-        return l_expr(tablet, invert) & r_expr(tablet, invert)
+    if _is_and(op, invert):
+        # and: evaluate the most selective legs first, and stop once no row is left
+        legs = [leg for e in (l_expr, r_expr) if e is not None for leg in _and_legs(invert, e)]
+        try:
+            legs.sort(key=lambda leg: _estimate(tablet, invert, leg))
+        except (AttributeError, KeyError, TypeError):
+            # not a MarbleStream, or the leg has no index, keep the order of the where clause
+            pass
+        rval = _evaluate(tablet, invert, legs[0])
+        for leg in legs[1:]:
+            if not len(rval):
+                break
+            rval = rval & _evaluate(tablet, invert, leg)
+        return rval
     else:
         # or
         if l_expr is None or r_expr is None:
             return None
-        return l_expr(tablet, invert) | r_expr(tablet, invert)
+        return _evaluate(tablet, invert, l_expr) | _evaluate(tablet, invert, r_expr)
 
 
 def in_in(tablet, invert, col, other):
@@ -1410,6 +1993,11 @@ def part_le(tags, invert, other):
     return (t for t in tags if t <= other)
 
 
+_PREDICATES = frozenset([in_in, in_not_in, in_eq, in_ne, in_lt, in_gt, in_ge, in_le])
+_INVERSES = {in_in: in_not_in, in_not_in: in_in, in_eq: in_ne, in_ne: in_eq,
+             in_lt: in_ge, in_ge: in_lt, in_gt: in_le, in_le: in_gt}
+
+
 def check_query(select, join, order_by, limit, wheres):
     """Query checker for hustle."""
 
@@ -1492,6 +2080,74 @@ def mdb_evict(key, bitset, txn=None, ixdb=None):
     ixdb.put(txn, key, bitset.dumps())
 
 
+class LazyDBs(dict):
+    """
+    The dbs of a marble opened for reading, which opens the DBs of a column, with open_column(name, column),
+    when it is first looked up.  Iterating it opens the DBs of all the columns.
+
+    The streams of :data:`stream_cache` are shared by threads, and LMDB doesn't allow opening DBs of an
+    environment concurrently, so the DBs are opened under a lock.
+    """
+    def __init__(self, columns, open_column, dbs=()):
+        from threading import Lock
+
+        super(LazyDBs, self).__init__(dbs)
+        self._columns = columns
+        self._open_column = open_column
+        self._lock = Lock()
+
+    def __missing__(self, key):
+        if key not in self._columns:
+            raise KeyError(key)
+        with self._lock:
+            # another thread may have opened it while this one waited
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+            rval = self[key] = self._open_column(key, self._columns[key])
+        return rval
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._columns
+
+    def _open_all(self):
+        for key in self._columns:
+            self[key]
+
+    def __iter__(self):
+        self._open_all()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._open_all()
+        return dict.__len__(self)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        self._open_all()
+        return dict.keys(self)
+
+    def values(self):
+        self._open_all()
+        return dict.values(self)
+
+    def items(self):
+        self._open_all()
+        return dict.items(self)
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        self._open_all()
+        return dict.itervalues(self)
+
+    def iteritems(self):
+        self._open_all()
+        return dict.iteritems(self)
+
+
 class DUMMY(object):
     tobj = None
 
@@ -1537,6 +2193,267 @@ def fixed_width_decoder(line, indexes=((0, '_'),)):
     return rval
 
 
+class BloomFilter(object):
+    """
+    A Bloom filter of the values of a column, integers if numeric, else strings, which are hashed as their
+    utf-8 encoding.  The k bit positions of a value are derived from the two halves of its 128 bit murmur3
+    hash.
+
+    :type capacity: int
+    :param capacity: the number of distinct values the filter is sized for
+
+    :type error_rate: float
+    :param error_rate: the false positive rate once the filter holds capacity values
+
+    :type numeric: bool
+    :param numeric: whether the values are integers
+    """
+    _HEADER = '<IB?'
+
+    def __init__(self, capacity=1, error_rate=BLOOM_ERROR_RATE, numeric=False):
+        import math
+        capacity = max(capacity, 1)
+        self.bits = bytearray(self.nbytes(capacity, error_rate))
+        self.size = len(self.bits) * 8
+        self.hashes = max(1, int(round(float(self.size) / capacity * math.log(2))))
+        self.numeric = numeric
+
+    @staticmethod
+    def nbytes(capacity, error_rate=BLOOM_ERROR_RATE):
+        """
+        Return the number of bytes of the bits of a filter of capacity values at error_rate.
+        """
+        import math
+        size = int(math.ceil(-max(capacity, 1) * math.log(error_rate) / math.log(2) ** 2))
+        return (size + 7) / 8
+
+    @classmethod
+    def capacity_for(cls, nbytes, error_rate=BLOOM_ERROR_RATE):
+        """
+        Return the most values that a filter of at most nbytes holds at error_rate.
+        """
+        import math
+        capacity = int(nbytes * 8 * math.log(2) ** 2 / -math.log(error_rate))
+        while capacity > 0 and cls.nbytes(capacity, error_rate) > nbytes:
+            capacity -= 1
+        return capacity
+
+    def _key(self, value):
+        if self.numeric:
+            if isinstance(value, (int, long)):
+                return str(value)
+        elif isinstance(value, unicode):
+            return value.encode('utf-8')
+        elif isinstance(value, str):
+            return value
+        return None
+
+    def _positions(self, key):
+        from scamurmur3 import murmur3_x86_128
+        h = murmur3_x86_128(key)
+        h1, h2 = h & 0xffffffffffffffff, (h >> 64) | 1
+        return [(h1 + i * h2) % self.size for i in xrange(self.hashes)]
+
+    def add(self, value):
+        key = self._key(value)
+        if key is None:
+            return
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def may_contain(self, value):
+        """
+        Return False if value was never added, and True if it may have been, as well as for values of
+        another type than the filter's.
+        """
+        key = self._key(value)
+        if key is None:
+            return True
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    __contains__ = may_contain
+
+    def dumps(self):
+        import struct
+        return struct.pack(self._HEADER, self.size, self.hashes, self.numeric) + str(self.bits)
+
+    @classmethod
+    def loads(cls, data):
+        import struct
+        offset = struct.calcsize(cls._HEADER)
+        bloom = cls.__new__(cls)
+        bloom.size, bloom.hashes, bloom.numeric = struct.unpack(cls._HEADER, data[:offset])
+        bloom.bits = bytearray(data[offset:])
+        return bloom
+
+
+class BitSlicedIndex(object):
+    """
+    Build a bit-sliced index for an integer column.  This replaces the
+    {value: bitmap} dict used by regular indexes at insert time: *_insert_row()*
+    calls :code:`bsi[value].set(row_id)` and the finished slices are written out
+    by :meth:`iteritems`.
+
+    Slice 0 is the existence bitmap, slice i + 1 holds bit i of every value.
+    Signed values are stored with their sign bit flipped, so that the slices
+    compare in the same order as the values themselves.
+    """
+    def __init__(self, column):
+        self.width = column.bit_width
+        self.offset = 1 << (self.width - 1) if column.type_indicator % 2 else 0
+        self.slices = [BitSet() for _ in xrange(self.width + 1)]
+        self._bits = 0
+
+    def fits(self, val):
+        """
+        Return whether val is in the range of the index, which *_insert_row()* checks before writing a row.
+        """
+        bits = val + self.offset
+        return not (bits < 0 or bits >> self.width)
+
+    def __getitem__(self, val):
+        # stash the encoded value for the set() call that immediately follows
+        if not self.fits(val):
+            raise ValueError("Value %s out of range for a %d bit index." % (val, self.width))
+        self._bits = val + self.offset
+        return self
+
+    def set(self, row_id):
+        bits = self._bits
+        slices = self.slices
+        slices[0].set(row_id)
+        i = 1
+        while bits:
+            if bits & 1:
+                slices[i].set(row_id)
+            bits >>= 1
+            i += 1
+
+    def iteritems(self):
+        return enumerate(self.slices)
+
+
+class BitSlicedIX(object):
+    """
+    Read side of a :class:`BitSlicedIndex`.  Answers identity and range
+    predicates with O(bit width) bitmap operations, independent of the number
+    of distinct values in the column.
+    """
+    def __init__(self, subindexdb, column):
+        self.subindexdb = subindexdb
+        self.width = column.bit_width
+        self.offset = 1 << (self.width - 1) if column.type_indicator % 2 else 0
+        self._slices = None
+
+    def close(self):
+        self.subindexdb.close()
+
+    def stat(self, txn):
+        return self.subindexdb.stat(txn)
+
+    def slices(self, txn):
+        if self._slices is None:
+            slices = []
+            for i in xrange(self.width + 1):
+                bitset = BitSet()
+                data = self.subindexdb.get(txn, i)
+                if data is not None:
+                    bitset.loads(data)
+                slices.append(bitset)
+            self._slices = slices
+        return self._slices
+
+    def _compare(self, txn, val):
+        """
+        Return the (less than, equal to) bitmaps for the given value.
+        """
+        slices = self.slices(txn)
+        bits = val + self.offset
+        if bits < 0:
+            return BitSet(), BitSet()
+        elif bits >> self.width:
+            return slices[0].lor(BitSet()), BitSet()
+
+        lt = BitSet()
+        eq = slices[0]
+        for i in xrange(self.width, 0, -1):
+            if (bits >> (i - 1)) & 1:
+                lt = lt | eq.land_not(slices[i])
+                eq = eq & slices[i]
+            else:
+                eq = eq.land_not(slices[i])
+        if eq is slices[0]:
+            eq = eq.lor(BitSet())
+        return lt, eq
+
+    def eq(self, txn, val):
+        return self._compare(txn, val)[1]
+
+    def ne(self, txn, val):
+        return self.slices(txn)[0].land_not(self.eq(txn, val))
+
+    def lt(self, txn, val):
+        return self._compare(txn, val)[0]
+
+    def le(self, txn, val):
+        lt, eq = self._compare(txn, val)
+        return lt | eq
+
+    def gt(self, txn, val):
+        return self.slices(txn)[0].land_not(self.le(txn, val))
+
+    def ge(self, txn, val):
+        return self.slices(txn)[0].land_not(self.lt(txn, val))
+
+    def eq_ex(self, txn, vals):
+        return lor_all(self.eq(txn, val) for val in vals)
+
+    def ne_ex(self, txn, vals):
+        return self.slices(txn)[0].land_not(self.eq_ex(txn, vals))
+
+    def sum(self, txn, bitmap):
+        """
+        Return the (sum, count) of the values of the rows in the given bitmap,
+        computed from the slices alone.
+        """
+        slices = self.slices(txn)
+        count = len(slices[0] & bitmap)
+        total = 0
+        for i in xrange(1, self.width + 1):
+            total += len(slices[i] & bitmap) << (i - 1)
+        return total - self.offset * count, count
+
+    def _extreme(self, txn, bitmap, largest):
+        # walk the slices from the top bit down, keeping the rows that have the
+        # preferred bit whenever there are any
+        slices = self.slices(txn)
+        rows = slices[0] & bitmap
+        if not len(rows):
+            return None
+        bits = 0
+        for i in xrange(self.width, 0, -1):
+            ones = rows & slices[i]
+            zeros = rows.land_not(slices[i])
+            if largest and len(ones) or not largest and not len(zeros):
+                rows = ones
+                bits |= 1 << (i - 1)
+            else:
+                rows = zeros
+        return bits - self.offset
+
+    def min(self, txn, bitmap):
+        """
+        Return the smallest value of the rows in the given bitmap, or None.
+        """
+        return self._extreme(txn, bitmap, False)
+
+    def max(self, txn, bitmap):
+        """
+        Return the largest value of the rows in the given bitmap, or None.
+        """
+        return self._extreme(txn, bitmap, True)
+
+
 class Victor(object):
     def __init__(self, fn, txn, db):
         self.fn = fn
@@ -1550,13 +2467,264 @@ class Victor(object):
             return self.fn(args[0], txn=self.txn, ixdb=self.db)
 
 
+def _order_tries(txn, dbs, meta, vid_trie, vid16_trie):
+    """
+    Renumber the tries used by ordered columns so that their VIDs sort like the strings they stand for, and
+    rewrite all of the column and index DBs encoded with them to match.  The tries are shared by all of the
+    trie columns of the same size, so all of those have to be rewritten, in place and only where a VID changes.
+    This has to run after the bitmap indexes are written, but before the tries are serialized.
+    """
+    tries = ((mdb.MDB_UINT_32, vid_trie, '_vid_sorted'),
+             (mdb.MDB_UINT_16, vid16_trie, '_vid16_sorted'))
+    for rtrie_indicator, trie, flag in tries:
+        columns = [(subdb, subindexdb, column)
+                   for subdb, subindexdb, _, column, _ in dbs.itervalues()
+                   if column.is_trie and column.rtrie_indicator == rtrie_indicator]
+        if not any(column.is_ordered for _, _, column in columns):
+            continue
+
+        remap = trie.sort()
+        for subdb, subindexdb, column in columns:
+            if not column.partition:
+                subdb.remap_values(txn, remap)
+            if subindexdb:
+                _remap_keys(txn, subindexdb, remap)
+        meta.put(txn, flag, 'true')
+
+
+def _remap_keys(txn, db, remap):
+    """
+    Move the value of every key k of db to remap[k], where remap is a permutation like the one returned by
+    *Trie.sort()*.  The values are moved along the cycles of the permutation, so that only the keys that move
+    are rewritten, and only a couple of values are held at a time.
+    """
+    pending = set(key for key, _ in db.items(txn))
+    for start in sorted(pending):
+        if start not in pending:
+            continue
+        pending.discard(start)
+        dest = remap[start]
+        if dest == start:
+            continue
+        value = db.get(txn, start)
+        db.delete(txn, start)
+        # each slot has a single key moving into it, so a slot that isn't pending is free
+        while dest in pending:
+            pending.discard(dest)
+            displaced = db.get(txn, dest)
+            db.put(txn, dest, value)
+            value, dest = displaced, remap[dest]
+        db.put(txn, dest, value)
+
+
+def _zone_maps(txn, dbs, vid_nodes, vid_kids, vid16_nodes, vid16_kids):
+    """
+    Return the zone map of every indexed column of a marble, ie. the min and max of its values, the number of
+    its distinct values and the number of rows holding its default value, which is also how missing and null
+    values are stored.  It reads the index DBs, so it has to run after they are written and the tries ordered.
+    Partition, boolean and bit-sliced columns, and lz4 and binary columns that have no order, get none.
+
+    Zone maps are only an optimization, so a column whose zone map can't be built, or serialized to JSON (like
+    strings that aren't utf-8), gets none instead of failing the write of the marble.
+    """
+    zones = {}
+    for index, (_, subindexdb, _, column, _) in dbs.iteritems():
+        if not subindexdb or column.partition or column.is_boolean or column.is_bsi \
+                or column.is_lz4 or column.is_binary:
+            continue
+        if column.is_trie:
+            if column.rtrie_indicator == mdb.MDB_UINT_16:
+                nodes, kids = vid16_nodes, vid16_kids
+            else:
+                nodes, kids = vid_nodes, vid_kids
+            fetch = partial(rtrie.value_for_vid, nodes, kids)
+        else:
+            fetch = None
+        try:
+            zone = _zone_map(txn, subindexdb, column, fetch)
+            if zone is not None:
+                ujson.dumps(zone)
+                zones[index] = zone
+        except Exception as e:
+            print "Skipping the zone map of %s: %s" % (index, e)
+    return zones
+
+
+def _zone_map(txn, subindexdb, column, fetch):
+    low = high = None
+    distinct = nulls = 0
+    for key, data in subindexdb.items(txn):
+        value = fetch(key) if fetch else key
+        if value == column.default_value:
+            bitmap = BitSet()
+            bitmap.loads(data)
+            nulls = len(bitmap)
+        if not distinct or value < low:
+            low = value
+        if not distinct or value > high:
+            high = value
+        distinct += 1
+    if distinct:
+        return {'min': low, 'max': high, 'distinct': distinct, 'nulls': nulls}
+    return None
+
+
+def _zone_value(value):
+    # strings are compared as utf-8, which orders like their code points, everything else as is
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def _zone_comparable(a, b):
+    numbers = (int, long, float)
+    return (isinstance(a, numbers) and isinstance(b, numbers)) or (type(a) is str and type(b) is str)
+
+
+def zone_match(zones, expr, invert=False, blooms=None):
+    """
+    Return False if no row of a marble with the zone maps zones can match expr, the function of a where
+    clause :class:`Expr <hustle.core.marble.Expr>`, and True if some may.  Equality and membership
+    predicates are also checked against the marble's :class:`BloomFilters <hustle.core.marble.BloomFilter>`
+    in blooms, if any.  Predicates on columns without either, or with operands of another type than the
+    column, may always match.
+    """
+    if type(expr) is not partial:
+        return True
+    elif expr.func is in_conditional:
+        legs = [zone_match(zones, e, invert, blooms)
+                for e in (expr.keywords['l_expr'], expr.keywords['r_expr']) if e is not None]
+        return all(legs) if _is_and(expr.keywords['op'], invert) else any(legs)
+    elif expr.func is in_not:
+        return zone_match(zones, expr.keywords['expr'], not invert, blooms)
+    elif expr.func not in _PREDICATES:
+        return True
+
+    col = expr.keywords['col']
+    op = _INVERSES[expr.func] if invert else expr.func
+    other = expr.keywords['other']
+    if op in (in_in, in_not_in):
+        if not isinstance(other, (list, tuple, set, frozenset)):
+            return True
+        # composite keys are looked up by their first item, see MarbleStream._flat_keys()
+        others = [v[0] if isinstance(v, (list, tuple)) else v for v in other]
+    else:
+        others = [other]
+
+    bloom = blooms.get(col) if blooms else None
+    if bloom is not None and op in (in_eq, in_in) and not any(bloom.may_contain(v) for v in others):
+        return False
+    zone = zones.get(col)
+    return not zone or _zone_range_match(zone, op, [_zone_value(v) for v in others])
+
+
+def bloom_columns(expr, invert=False):
+    """
+    Return the set of the columns that the equality and membership predicates of expr, the function of a
+    where clause :class:`Expr <hustle.core.marble.Expr>`, look values up in, the only columns whose
+    :class:`BloomFilters <hustle.core.marble.BloomFilter>` :func:`zone_match` checks.
+    """
+    if type(expr) is not partial:
+        return set()
+    elif expr.func is in_conditional:
+        return set().union(*[bloom_columns(e, invert)
+                             for e in (expr.keywords['l_expr'], expr.keywords['r_expr']) if e is not None])
+    elif expr.func is in_not:
+        return bloom_columns(expr.keywords['expr'], not invert)
+    elif expr.func not in _PREDICATES:
+        return set()
+    op = _INVERSES[expr.func] if invert else expr.func
+    return {expr.keywords['col']} if op in (in_eq, in_in) else set()
+
+
+def _zone_range_match(zone, op, others):
+    low, high = _zone_value(zone['min']), _zone_value(zone['max'])
+    if not all(_zone_comparable(low, v) for v in others):
+        return True
+
+    if op in (in_eq, in_in):
+        return any(low <= v <= high for v in others)
+    elif op in (in_ne, in_not_in):
+        return low != high or low not in others
+    elif op is in_lt:
+        return low < others[0]
+    elif op is in_le:
+        return low <= others[0]
+    elif op is in_gt:
+        return high > others[0]
+    return high >= others[0]
+
+
+def _bloom_filters(txn, dbs, columns, vid_nodes, vid_kids, vid16_nodes, vid16_kids):
+    """
+    Return a :class:`BloomFilter <hustle.core.marble.BloomFilter>` of the distinct values of each of the
+    columns of a marble, read from its index DB if it has one, else from its column DB.  Like
+    :func:`_zone_maps`, it has to run after the DBs are written and the tries ordered.  Columns with too many
+    distinct values for a filter of at most :data:`BLOOM_MAX_BYTES` get none.
+    """
+    capacity = BloomFilter.capacity_for(BLOOM_MAX_BYTES, BLOOM_ERROR_RATE)
+    blooms = {}
+    for index in columns:
+        subdb, subindexdb, _, column, _ = dbs[index]
+        if subindexdb and not column.is_bsi:
+            keys = (key for key, _ in subindexdb.items(txn))
+        else:
+            keys = (value for _, value in subdb.dup_items(txn))
+        # stop reading as soon as there are too many values
+        values = set()
+        for key in keys:
+            values.add(key)
+            if len(values) > capacity:
+                break
+        if len(values) > capacity:
+            continue
+        if column.is_trie:
+            if column.rtrie_indicator == mdb.MDB_UINT_16:
+                nodes, kids = vid16_nodes, vid16_kids
+            else:
+                nodes, kids = vid_nodes, vid_kids
+            values = [rtrie.value_for_vid(nodes, kids, vid) for vid in values]
+        bloom = BloomFilter(len(values), BLOOM_ERROR_RATE, numeric=column.is_int and not column.is_trie)
+        for value in values:
+            bloom.add(value)
+        blooms[index] = bloom
+    return blooms
+
+
+def dump_blooms(blooms):
+    """
+    Serialize a dict of :class:`BloomFilters <hustle.core.marble.BloomFilter>` by column to JSON.
+    """
+    from base64 import b64encode
+    return ujson.dumps({col: b64encode(bloom.dumps()) for col, bloom in blooms.iteritems()})
+
+
+def load_blooms(s):
+    """
+    Load a dict of :class:`BloomFilters <hustle.core.marble.BloomFilter>` by column serialized by
+    :func:`dump_blooms`.
+    """
+    from base64 import b64decode
+    return {col: BloomFilter.loads(b64decode(data)) for col, data in ujson.loads(s).iteritems()}
+
+
 def _insert_row(data, txn, dbs, row_id, vid_trie, vid16_trie):
+    """
+    Write a row at row_id.  Return the dbs if their last values changed, None if not, and False if the row was
+    rejected before anything was written, so that row_id is still free.
+    """
     column = None
-    updated = False
+    updated = checked = False
     try:
-        for col, (subdb, subinxdb, bitmap_dict, column, last) in dbs.iteritems():
+        # convert and check every value before writing any, so that a bad value can't leave half a row
+        values = []
+        for col, (_, _, bitmap_dict, column, _) in dbs.iteritems():
             val = column.converter(data.get(column.name, column.default_value)
                                    or column.default_value, vid_trie, vid16_trie)
+            if column.is_bsi and not bitmap_dict.fits(val):
+                raise ValueError("Value %s out of range for a %d bit index." % (val, column.bit_width))
+            values.append((col, val))
+        checked = True
+        for col, val in values:
+            subdb, subinxdb, bitmap_dict, column, last = dbs[col]
             if val != last:
                 subdb.put(txn, row_id, val)
                 updated = True
@@ -1564,6 +2732,8 @@ def _insert_row(data, txn, dbs, row_id, vid_trie, vid16_trie):
             bitmap_dict[val].set(row_id)
     except Exception as e:
         print "Can't INSERT: %s %s: %s" % (repr(data), column, e)
+        if not checked:
+            return False
 
     if updated:
         return dbs
@@ -2,7 +2,7 @@ from disco.core import Job
 from disco.worker.task_io import task_input_stream
 from functools import partial
 from hustle.core.marble import Marble, Column, Aggregation,\
-    dflt_f, dflt_gh, dflt_default
+    dflt_f, dflt_gh, dflt_default, dflt_batch
 from hustle.core.pipeworker import HustleStage
 
 import sys
@@ -21,6 +21,8 @@ GROUP_NODE = "group_node"
 _POOL = 'abcdefghijklmnopqrstuvwxyz0123456789'
 # default number of partitions, users can set this in the settings.yaml
 _NPART = 16
+# the number of rows aggregated at once by the Aggregations' batch() functions
+_BATCH_SIZE = 1024
 
 
 def hustle_output_stream(stream, partition, url, params, result_table):
@@ -51,6 +53,9 @@ def hustle_output_stream(stream, partition, url, params, result_table):
             #print "BOZAK! adding %s %s %s" % (self.result_columns, k, v)
             updated_dbs = _insert_row(data, self.txn, self.dbs, self.autoinc,
                                       self.vid_trie, self.vid16_trie)
+            if updated_dbs is False:
+                # the row was rejected, its RID goes to the next one
+                return
             if updated_dbs:
                 self.dbs = updated_dbs
             self.autoinc += 1
@@ -59,18 +64,9 @@ def hustle_output_stream(stream, partition, url, params, result_table):
             import os
             import ujson
             from disco import util
+            from hustle.core.marble import _order_tries, _zone_maps
 
             self.meta.put(self.txn, '_total_rows', str(self.autoinc))
-            vid_nodes, vid_kids, _ = self.vid_trie.serialize()
-            vid16_nodes, vid16_kids, _ = self.vid16_trie.serialize()
-            vn_ptr, vn_len = vid_nodes.buffer_info()
-            vk_ptr, vk_len = vid_kids.buffer_info()
-            vn16_ptr, vn16_len = vid16_nodes.buffer_info()
-            vk16_ptr, vk16_len = vid16_kids.buffer_info()
-            self.meta.put_raw(self.txn, '_vid_nodes', vn_ptr, vn_len)
-            self.meta.put_raw(self.txn, '_vid_kids', vk_ptr, vk_len)
-            self.meta.put_raw(self.txn, '_vid16_nodes', vn16_ptr, vn16_len)
-            self.meta.put_raw(self.txn, '_vid16_kids', vk16_ptr, vk16_len)
             self.meta.put(self.txn, 'name', ujson.dumps(self.result_table._name))
             self.meta.put(self.txn, 'fields', ujson.dumps(self.result_table._fields))
             for index, (subdb, subindexdb, bitmap_dict, column, last) in self.dbs.iteritems():
@@ -83,6 +79,19 @@ def hustle_output_stream(stream, partition, url, params, result_table):
                             subindexdb.put(self.txn, val, bitmap.dumps())
                 # insert a sentinel row to value table
                 subdb.put(self.txn, self.autoinc + 1, last)
+            _order_tries(self.txn, self.dbs, self.meta, self.vid_trie, self.vid16_trie)
+            vid_nodes, vid_kids, _ = self.vid_trie.serialize()
+            vid16_nodes, vid16_kids, _ = self.vid16_trie.serialize()
+            vn_ptr, vn_len = vid_nodes.buffer_info()
+            vk_ptr, vk_len = vid_kids.buffer_info()
+            vn16_ptr, vn16_len = vid16_nodes.buffer_info()
+            vk16_ptr, vk16_len = vid16_kids.buffer_info()
+            self.meta.put_raw(self.txn, '_vid_nodes', vn_ptr, vn_len)
+            self.meta.put_raw(self.txn, '_vid_kids', vk_ptr, vk_len)
+            self.meta.put_raw(self.txn, '_vid16_nodes', vn16_ptr, vn16_len)
+            self.meta.put_raw(self.txn, '_vid16_kids', vk16_ptr, vk16_len)
+            self.meta.put(self.txn, '_zones', ujson.dumps(_zone_maps(self.txn, self.dbs, vn_ptr, vk_ptr,
+                                                                     vn16_ptr, vk16_ptr)))
             self.txn.commit()
 
             try:
@@ -100,10 +109,12 @@ def hustle_output_stream(stream, partition, url, params, result_table):
     return HustleOutputStream(stream, url, params)
 
 
-def hustle_input_stream(fd, size, url, params, wheres, gen_where_index, key_names, limit):
+def hustle_input_stream(fd, size, url, params, wheres, gen_where_index, key_names, limit,
+                        count_only=False, index_group=False, index_aggs=(), broadcast=None,
+                        semi_join=None, late_columns=()):
     from disco import util
-    from hustle.core.marble import Expr, MarbleStream
-    from itertools import izip, repeat, islice, imap
+    from hustle.core.marble import Expr, stream_cache
+    from itertools import repeat, islice
     from sys import maxint
     from pyebset import BitSet
 
@@ -120,7 +131,7 @@ def hustle_input_stream(fd, size, url, params, wheres, gen_where_index, key_name
 
     otab = None
     try:
-        otab = MarbleStream(fle)
+        otab = stream_cache.open(fle)
         bitmaps = {}
 
         for index, where in enumerate(wheres):
@@ -147,27 +158,66 @@ def hustle_input_stream(fd, size, url, params, wheres, gen_where_index, key_name
                         bitmaps[index] = (otab.iter_all(), otab.number_rows)
 
         for index, (bitmap, blen) in bitmaps.iteritems():
-            prefix_gen = [repeat(index, blen)] if gen_where_index else []
-
-            # row_iter = prefix_gen + \
-                # [otab.mget(col, bitmap) if col is not None else repeat(None, blen)
-                 # for col in key_names[index]]
-            row_creators = []
-            for col, column_fn in key_names[index]:
-                if col is not None:
-                    if column_fn is None:
-                        row_creators.append(otab.mget(col, bitmap))
-                    else:
-                        row_creators.append(imap(column_fn, otab.mget(col, bitmap)))
+            if count_only:
+                # every column is a h_count(), so a single row holding the size of
+                # the bitmap aggregates to the same result as one row per RID
+                count = len(bitmap)
+                if count:
+                    yield (count, ) * len(key_names[index]), empty
+                continue
+
+            if index_aggs:
+                # every column is an aggregation that can be computed from the index,
+                # so a single row of partial results replaces one row per RID
+                if len(bitmap):
+                    where = bitmap if type(bitmap) is BitSet else None
+                    yield tuple(ix(otab, col, where) for ix, (col, _)
+                                in zip(index_aggs, key_names[index])), empty
+                continue
+
+            if index_group:
+                # the only column is indexed and the rest (if any) are h_count()s, so
+                # emit its distinct values with their counts straight from the index
+                # bitmaps instead of reading the rows
+                group = next(i for i, (col, _) in enumerate(key_names[index])
+                             if col != '_count')
+                col, column_fn = key_names[index][group]
+                if col is None:
+                    groups = [(None, len(bitmap))] if len(bitmap) else []
                 else:
-                    row_creators.append(repeat(None, blen))
-            row_iter = prefix_gen + row_creators
-
-            for row in izip(*row_iter):
-                yield row, empty
+                    groups = otab.group_counts(col, bitmap if type(bitmap) is BitSet else None)
+                for value, count in groups:
+                    row = [count] * len(key_names[index])
+                    row[group] = column_fn(value) if column_fn else value
+                    yield tuple(row), empty
+                continue
+
+            # the trie columns in late_columns are left as VIDs, and the functions to
+            # decode them are passed along with the rows, see _aggregate()
+            decoders = {}
+            for i in late_columns:
+                col, column_fn = key_names[index][i]
+                if col is not None:
+                    decoders[i] = otab.vid_decoder(col)
+                    if column_fn is not None:
+                        decoders[i] = _compose(column_fn, decoders[i])
+            value = decoders or empty
+
+            prefix = (index, ) if gen_where_index else ()
+            rows = _read_rows(otab, bitmap, key_names[index], prefix, late=decoders)
+            if semi_join is not None and semi_join[0] == index:
+                # drop the rows whose join column, which follows the where_index,
+                # has no match in the other where clause
+                keys = semi_join[1]
+                rows = (row for row in rows if row[1] in keys)
+            if broadcast is not None:
+                rows = _broadcast_join(rows, broadcast)
+
+            for row in rows:
+                yield row, value
     finally:
         if otab:
-            otab.close()
+            stream_cache.release(otab)
 
 
 class SelectPipe(Job):
@@ -253,7 +303,12 @@ class SelectPipe(Job):
                  pre_order_stage=(),
                  tag=None,
                  max_cores=0,
-                 profile=False):
+                 profile=False,
+                 hash_join=False,
+                 join_build=0,
+                 broadcast=None,
+                 semi_join=None,
+                 agg_buffer_size='5%'):
         from hustle.core.pipeworker import Worker
 
         super(SelectPipe, self).__init__(master=master, worker=Worker())
@@ -283,34 +338,87 @@ class SelectPipe(Job):
                 need_agg = True
             else:
                 all_agg = False
+        # if every aggregation has a batch function, rows are aggregated in batches
+        bfs = ()
+        if all(c.batch for c in project if isinstance(c, Aggregation)):
+            bfs = tuple(c.batch if isinstance(c, Aggregation) else dflt_batch
+                        for c in project)
+        # a joined row holds columns of two marbles, otherwise the rows that the restrict stage
+        # aggregates all come from one, so it can group on the VIDs of trie columns
+        joined = join or full_join or broadcast is not None
+        late_columns = ()
+        if need_agg and not all_agg and not wide and not joined:
+            late_columns = tuple(i for i, c in enumerate(project)
+                                 if isinstance(c, Column) and c.is_trie)
+
         if all_agg:
-            _agg_fn = _aggregate_fast
+            _agg_fn = partial(_aggregate_fast, batchfuncs=bfs)
         else:
-            _agg_fn = _aggregate
+            _agg_fn = partial(_aggregate, agg_buffer_size=agg_buffer_size, batchfuncs=bfs,
+                              late=bool(late_columns))
+
+        # if we are only counting, the restrict stage doesn't need to read any rows
+        count_only = all_agg and not joined and \
+            all(c.name == 'count(_count)' for c in project)
+
+        # if all of the aggregations can be computed from the indexes of the numeric columns of
+        # a single table, don't read the rows
+        index_aggs = ()
+        if all_agg and not count_only and not joined and len(self.wheres) == 1 and \
+                all(c.ix and (c.column.name == '_count' or
+                              c.column.is_index and c.column.is_numeric and not c.column.is_boolean and
+                              not c.column.column_fn and not c.column.partition)
+                    for c in project):
+            index_aggs = tuple(c.ix for c in project)
+
+        # if we are counting by, or selecting the distinct values of, a single indexed
+        # column, take the values and counts from its index instead
+        group_cols = [c for c in project if isinstance(c, Column)]
+        index_group = (need_agg or distinct) and not joined and len(group_cols) == 1 and \
+            group_cols[0].is_index and not (group_cols[0].is_bsi or group_cols[0].is_boolean) and \
+            all(isinstance(c, Column) or c.name == 'count(_count)' for c in project)
 
         # build the pipeline
         select_hash_cols = ()
         sort_range = _get_sort_range(0, project, self.order_by)
 
+        # with an order_by and a limit, the stage feeding the order stages only has to
+        # pass on the first 'limit' rows in sort order, see _top_k(), unless pre_order_stage,
+        # which may drop or change rows, comes in between
+        top_k = limit if self.order_by and limit and not distinct and not pre_order_stage else 0
+
         join_stage = []
         if join or full_join:
             joinbins = [i + 2 for i in binaries]
-            join_stage = [
-                (GROUP_LABEL,
-                 HustleStage('join',
-                             sort=(1, 0),
-                             binaries=joinbins,
-                             process=partial(process_join,
-                                             full_join=full_join,
-                                             ffuncs=efs,
-                                             ghfuncs=ehches,
-                                             deffuncs=dflts,
-                                             wide=wide,
-                                             need_agg=need_agg,
-                                             agg_fn=_agg_fn,
-                                             label_fn=partial(_tuple_hash,
-                                                              cols=sort_range,
-                                                              p=partition))))]
+            join_fn = partial(process_join,
+                              full_join=full_join,
+                              ffuncs=efs,
+                              ghfuncs=ehches,
+                              deffuncs=dflts,
+                              wide=wide,
+                              need_agg=need_agg,
+                              agg_fn=_agg_fn,
+                              label_fn=partial(_tuple_hash,
+                                               cols=sort_range,
+                                               p=partition))
+            if hash_join:
+                # the hash join needs no sorted input, but it does need all of the
+                # inputs with the same label at once, see the 'group-reduce' stage
+                join_stage = [
+                    (GROUP_LABEL,
+                     HustleStage('join',
+                                 combine=True,
+                                 binaries=joinbins,
+                                 process=partial(join_fn,
+                                                 hash_join=True,
+                                                 build=join_build)))]
+            else:
+                join_stage = [
+                    (GROUP_LABEL,
+                     HustleStage('join',
+                                 sort=(1, 0),
+                                 binaries=joinbins,
+                                 process=join_fn))]
             select_hash_cols = (1,)
 
         group_by_stage = []
@@ -318,12 +426,16 @@ class SelectPipe(Job):
             # If all columns in project are aggregations, use process_skip_group
             # to skip the internal groupby
             if all_agg:
-                process_group_fn = process_skip_group
-                group_by_range = []
+                process_group_fn = partial(process_skip_group,
+                                           batchfuncs=bfs)
             else:
-                process_group_fn = process_group
-                group_by_range = [i for i, c in enumerate(project)
-                                  if isinstance(c, Column)]
+                # groups are hashed rather than sorted, see process_group()
+                process_group_fn = partial(process_group,
+                                           hfuncs=ehches,
+                                           agg_buffer_size=agg_buffer_size,
+                                           batchfuncs=bfs)
+            group_by_range = [i for i, c in enumerate(project)
+                              if isinstance(c, Column)]
 
             # build the pipeline
             group_by_stage = []
@@ -331,7 +443,6 @@ class SelectPipe(Job):
                 group_by_stage = [
                     (GROUP_LABEL_NODE,
                      HustleStage('group-combine',
-                                 sort=group_by_range,
                                  binaries=binaries,
                                  process=partial(process_group_fn,
                                                  ffuncs=efs,
@@ -340,18 +451,22 @@ class SelectPipe(Job):
                                                  label_fn=partial(_tuple_hash,
                                                                   cols=group_by_range,
                                                                   p=partition))))]
+            group_reduce_fn = partial(process_group_fn,
+                                      ffuncs=efs,
+                                      ghfuncs=gees,
+                                      deffuncs=dflts)
+            if not all_agg and top_k:
+                group_reduce_fn = partial(group_reduce_fn,
+                                          top_k=top_k,
+                                          sort_range=sort_range,
+                                          desc=desc)
             # A Hack here that overrides disco stage's default option 'combine'.
             # Hustle needs all inputs with the same label to be combined.
             group_by_stage.append((GROUP_LABEL,
                                    HustleStage('group-reduce',
                                                combine=True,
-                                               input_sorted=wide,
-                                               sort=group_by_range,
                                                binaries=binaries,
-                                               process=partial(process_group_fn,
-                                                               ffuncs=efs,
-                                                               ghfuncs=gees,
-                                                               deffuncs=dflts))))
+                                               process=group_reduce_fn)))
 
         # process the order_by/distinct stage
         order_stage = []
@@ -392,7 +507,12 @@ class SelectPipe(Job):
         if not select_hash_cols:
             select_hash_cols = sort_range
 
-        key_names = self._get_key_names(project, join)
+        broadcast_rows = None
+        if broadcast is not None:
+            join_column, broadcast_rows = broadcast
+            key_names = self._get_key_names(project, [join_column])
+        else:
+            key_names = self._get_key_names(project, join)
 
         restrict_distinct = False
         restrict_limit = 0
@@ -402,7 +522,7 @@ class SelectPipe(Job):
             restrict_limit = limit or 0
         # check whether need to do a limit in the hustle_input stream
         input_stream_limit = 0
-        if not (join or full_join) and not need_agg and not self.order_by and not distinct:
+        if not joined and not need_agg and not self.order_by and not distinct:
             input_stream_limit = limit or 0
         pipeline = [(SPLIT,
                      HustleStage('restrict-select',
@@ -416,6 +536,9 @@ class SelectPipe(Job):
                                                  agg_fn=_agg_fn,
                                                  distinct=restrict_distinct,
                                                  limit=restrict_limit or sys.maxint,
+                                                 top_k=0 if need_agg or join or full_join else top_k,
+                                                 sort_range=sort_range,
+                                                 desc=desc,
                                                  label_fn=partial(_tuple_hash,
                                                                   cols=select_hash_cols,
                                                                   p=partition)),
@@ -424,7 +547,13 @@ class SelectPipe(Job):
                                                       wheres=wheres,
                                                       gen_where_index=join or full_join,
                                                       key_names=key_names,
-                                                      limit=input_stream_limit or sys.maxint)]))
+                                                      limit=input_stream_limit or sys.maxint,
+                                                      count_only=count_only,
+                                                      index_group=index_group,
+                                                      index_aggs=index_aggs,
+                                                      broadcast=broadcast_rows,
+                                                      semi_join=semi_join,
+                                                      late_columns=late_columns)]))
                     ] + join_stage + group_by_stage + list(pre_order_stage) + order_stage
 
         # determine the style of output (ie. if it is a Hustle Table),
@@ -442,64 +571,149 @@ def _tuple_hash(key, cols, p):
     return r % p
 
 
-def _aggregate(inp, label_fn, ffuncs, ghfuncs, deffuncs):
+def _max_groups(agg_buffer_size, group, accums):
+    """
+    Estimate how many groups like this one, with their accumulators, fit in agg_buffer_size, either a
+    number of bytes or a percentage of physical memory (see :func:`hustle.core.pipeworker._sort_budget`).
+    """
+    from hustle.core.pipeworker import _sort_budget
+    from sys import getsizeof
+
+    # the size of the group's dict entry is a guess
+    size = 64 + getsizeof(group) + getsizeof(accums) + \
+        sum(getsizeof(v) for v in group) + sum(getsizeof(a) for a in accums)
+    return max(1, _sort_budget(agg_buffer_size) // size)
+
+
+def _grouped_records(inp, group_template, batchfuncs=()):
+    """
+    Yield (group, records) for the records of inp.  With batchfuncs, each batch of _BATCH_SIZE records
+    is split by group, so that they can be aggregated a group at a time, see :func:`_accumulate`.
+    Otherwise each record is yielded on its own.
+    """
+    from itertools import islice
+
+    if not batchfuncs:
+        for record, _ in inp:
+            yield tuple(f(e) for e, f in zip(record, group_template)), (record, )
+        return
+
+    inp = iter(inp)
+    while True:
+        batch = list(islice(inp, _BATCH_SIZE))
+        if not batch:
+            break
+        groups = {}
+        for record, _ in batch:
+            group = tuple(f(e) for e, f in zip(record, group_template))
+            if group in groups:
+                groups[group].append(record)
+            else:
+                groups[group] = [record]
+        for group, records in groups.iteritems():
+            yield group, records
+
+
+def _accumulate(accums, records, ffuncs, batchfuncs=()):
+    """
+    Return the accumulators updated with the records, by passing their columns to the batchfuncs
+    all at once if there are any, otherwise each record to the ffuncs in turn.
+    """
+    try:
+        if batchfuncs:
+            return [b(a, vs) for b, a, vs in zip(batchfuncs, accums, zip(*records))]
+        for record in records:
+            accums = [f(a, v) for f, a, v in zip(ffuncs, accums, record)]
+        return accums
+    except Exception as e:
+        print e
+        print "YEEHEQW: f=%s a=%s r=%s" % (ffuncs, accums, records)
+        import traceback
+        print traceback.format_exc(15)
+        raise e
+
+
+def _aggregate(inp, label_fn, ffuncs, ghfuncs, deffuncs, agg_buffer_size='5%',
+               batchfuncs=(), late=False):
     from functools import partial
     """
     General channel for executing aggregate function, would be used if
     columns in project are either aggregation or group by columns
+
+    ghfuncs are the h() functions here, so the keys are partial aggregations that the
+    'group-reduce' stage merges.  So if the groups outgrow agg_buffer_size, they are
+    passed on early and aggregation starts over with no groups.
+
+    If late is set, some group by columns may be VIDs, see hustle_input_stream's late_columns.
+    They are grouped on as they are, and decoded when the groups are passed on.
     """
+    def _flush(vals):
+        for group, accums in vals.iteritems():
+            key = tuple(h(a) for h, a in zip(ghfuncs, accums))
+            if decoders:
+                group = _decode(group, decoders)
+                key = _decode(key, decoders)
+            out_label = label_fn(group)
+            yield out_label, key
+
+    decoders = {}
+    if late:
+        inp = _with_decoders(inp, decoders)
+
     vals = {}
+    max_groups = 0
     # TODO: figure out a way to set __name__ for partial object, update_wrapper
     # didn't work. Then we can get rid of "type(f) != partial"
     group_template = [(lambda a: a) if type(f) != partial and f.__name__ == 'dflt_f' else (lambda a: None)
                       for f in ffuncs]
-    for record, _ in inp:
-        group = tuple(f(e) for e, f in zip(record, group_template))
+    for group, records in _grouped_records(inp, group_template, batchfuncs):
         if group in vals:
             accums = vals[group]
         else:
             accums = [default() for default in deffuncs]
+            if not max_groups:
+                max_groups = _max_groups(agg_buffer_size, group, accums)
+            elif len(vals) >= max_groups:
+                for out_label, key in _flush(vals):
+                    yield out_label, key
+                vals.clear()
 
-        try:
-            accums = [f(a, v) for f, a, v in zip(ffuncs, accums, record)]
-        except Exception as e:
-            print e
-            print "YEEHEQW: f=%s a=%s r=%s g=%s" % (ffuncs, accums, record, group)
-            import traceback
-            print traceback.format_exc(15)
-            raise e
-
-        vals[group] = accums
-
-    for group, accums in vals.iteritems():
-        key = tuple(h(a) for h, a in zip(ghfuncs, accums))
-        out_label = label_fn(group)
+        vals[group] = _accumulate(accums, records, ffuncs, batchfuncs)
+
+    for out_label, key in _flush(vals):
         yield out_label, key
 
 
-def _aggregate_fast(inp, label_fn, ffuncs, ghfuncs, deffuncs):
+def _aggregate_fast(inp, label_fn, ffuncs, ghfuncs, deffuncs, batchfuncs=()):
     """
     Fast channel for executing aggregate function, would be used if
     all columns in project are aggregations
     """
     accums = [default() for default in deffuncs]
-    for record, _ in inp:
-        try:
-            accums = [f(a, v) for f, a, v in zip(ffuncs, accums, record)]
-        except Exception as e:
-            print e
-            print "YEEHEQW: f=%s a=%s r=%s" % (ffuncs, accums, record)
-            import traceback
-            print traceback.format_exc(15)
-            raise e
+    for _, records in _grouped_records(inp, (), batchfuncs):
+        accums = _accumulate(accums, records, ffuncs, batchfuncs)
 
     key = tuple(h(a) for h, a in zip(ghfuncs, accums))
     yield 0, key
 
 
+def _top_k(inp, k, sort_range, desc):
+    """
+    Return the first k (key, value) pairs of inp in the order the order stages would sort them, using a
+    bounded heap of k items instead of sorting them all.  The order stages still merge the results.
+    """
+    from heapq import nlargest, nsmallest
+    from operator import itemgetter
+
+    select = nlargest if desc else nsmallest
+    sort_key = itemgetter(*sort_range)
+    return select(k, inp, key=lambda (key, _): sort_key(key))
+
+
 def process_restrict(interface, state, label, inp, task, label_fn, ffuncs,
                      ghfuncs, deffuncs, agg_fn, wide=False, need_agg=False,
-                     distinct=False, limit=sys.maxint):
+                     distinct=False, limit=sys.maxint, top_k=0, sort_range=(),
+                     desc=False):
     from disco import util
     from itertools import groupby, islice
     empty = ()
@@ -527,13 +741,161 @@ def process_restrict(interface, state, label, inp, task, label_fn, ffuncs,
                 label = label_fn(uniqkey)
                 interface.output(label).add(uniqkey, empty)
         else:
+            if top_k:
+                inp = _top_k(inp, top_k, sort_range, desc)
             for key, value in islice(inp, 0, limit):
                 out_label = label_fn(key)
                 interface.output(out_label).add(key, value)
 
 
+def _merge_record(offset, r1, r2):
+    return [i if i is not None else j for i, j in zip(r1[offset:], r2[offset:])]
+
+
+def _read_rows(otab, rids, key_names, prefix=(), late=()):
+    """
+    Yield the row of the key_names columns (see :meth:`SelectPipe._get_key_names`), after prefix, for each of
+    the rids of a :class:`MarbleStream <hustle.core.marble.MarbleStream>`.  The columns are read
+    _BATCH_SIZE rows at a time by :meth:`MarbleStream.fetch_batch <hustle.core.marble.MarbleStream.fetch_batch>`.
+    The trie columns at the positions in late are left as VIDs, without their column_fn.
+    """
+    from itertools import islice, izip, repeat, imap
+
+    names = list(set(col for i, (col, _) in enumerate(key_names)
+                     if col is not None and i not in late))
+    vid_names = list(set(key_names[i][0] for i in late))
+    rids = iter(rids)
+    while True:
+        batch = list(islice(rids, _BATCH_SIZE))
+        if not batch:
+            break
+        values = dict(zip(names, otab.fetch_batch(names, batch)))
+        vids = dict(zip(vid_names, otab.fetch_batch(vid_names, batch, decode=False)))
+        columns = [repeat(item, len(batch)) for item in prefix]
+        for i, (col, column_fn) in enumerate(key_names):
+            if col is None:
+                columns.append(repeat(None, len(batch)))
+            elif i in late:
+                columns.append(vids[col])
+            elif column_fn is None:
+                columns.append(values[col])
+            else:
+                columns.append(imap(column_fn, values[col]))
+        for row in izip(*columns):
+            yield row
+
+
+def _compose(f, g):
+    return lambda v: f(g(v))
+
+
+def _with_decoders(inp, decoders):
+    # collect the functions to decode the late columns that hustle_input_stream passes with the rows
+    last = None
+    for record, value in inp:
+        if value is not last:
+            decoders.update(value)
+            last = value
+        yield record, value
+
+
+def _decode(values, decoders):
+    return tuple(decoders[i](v) if i in decoders else v for i, v in enumerate(values))
+
+
+def _broadcast_join(rows, broadcast):
+    """
+    Join rows, each starting with its join column, with the rows of a small table that were shipped
+    to every task.  broadcast maps each join value to the small table's rows, organized the same way.
+    Rows without a match are dropped, and the join column is disposed of like in :func:`process_join`.
+    """
+    empty = ()
+    for row in rows:
+        for match in broadcast.get(row[0], empty):
+            yield _merge_record(1, row, match)
+
+
+def _hash_join_input(inp, task, build, join_buffer_size, partitions=16):
+    """
+    Join the records of the two where clauses in 'inp' with a hash table on the join column, built from the
+    records of the 'build' where clause.  The records of the other (probe) side are spilled to disk, then
+    streamed through the table.
+
+    If the table grows past join_buffer_size (see :func:`hustle.core.pipeworker.disk_sort`), both sides are
+    split into partitions on disk by the hash of the join column, and joined a partition at a time.
+    """
+    import marshal
+    import os
+    from collections import defaultdict
+    from hustle.core.pipeworker import _sort_budget, _read_run
+
+    budget = _sort_budget(join_buffer_size)
+    probe_name = task.path('join-probe')
+    build_names = [task.path('join-build-%d' % i) for i in range(partitions)]
+    probe_names = [task.path('join-probe-%d' % i) for i in range(partitions)]
+
+    def _probe(table, probes):
+        for record, value in probes:
+            for match, match_value in table.get(record[1], ()):
+                # the columns of the first where clause win, as in the sort-merge join
+                if build == 0:
+                    yield _merge_record(2, match, record), value
+                else:
+                    yield _merge_record(2, record, match), match_value
+
+    def _split(records, names):
+        fds = [open(name, 'wb', 1 << 16) for name in names]
+        try:
+            for rv in records:
+                marshal.dump(rv, fds[hash(rv[0][1]) % partitions])
+        finally:
+            for fd in fds:
+                fd.close()
+
+    table = defaultdict(list)
+    size = 0
+    spilled = []
+    try:
+        with open(probe_name, 'wb', 1 << 16) as probe_fd:
+            for record, value in inp:
+                if record[0] != build:
+                    marshal.dump((record, value), probe_fd)
+                elif spilled:
+                    marshal.dump((record, value), spilled[hash(record[1]) % partitions])
+                else:
+                    table[record[1]].append((record, value))
+                    size += len(marshal.dumps(record))
+                    if size > budget:
+                        spilled = [open(name, 'wb', 1 << 16) for name in build_names]
+                        for matches in table.itervalues():
+                            for rv in matches:
+                                marshal.dump(rv, spilled[hash(rv[0][1]) % partitions])
+                        table = None
+        for fd in spilled:
+            fd.close()
+
+        if not spilled:
+            for joined in _probe(table, _read_run(probe_name)):
+                yield joined
+        else:
+            _split(_read_run(probe_name), probe_names)
+            for build_name, part_name in zip(build_names, probe_names):
+                table = defaultdict(list)
+                for record, value in _read_run(build_name):
+                    table[record[1]].append((record, value))
+                for joined in _probe(table, _read_run(part_name)):
+                    yield joined
+    finally:
+        for fd in spilled:
+            fd.close()
+        for name in [probe_name] + build_names + probe_names:
+            if os.path.exists(name):
+                os.unlink(name)
+
+
 def process_join(interface, state, label, inp, task, full_join, label_fn,
-                 ffuncs, ghfuncs, deffuncs, agg_fn, wide=False, need_agg=False):
+                 ffuncs, ghfuncs, deffuncs, agg_fn, wide=False, need_agg=False,
+                 hash_join=False, build=0, join_buffer_size='5%'):
     """
     Processor function for the join stage.
 
@@ -543,13 +905,12 @@ def process_join(interface, state, label, inp, task, full_join, label_fn,
     Firstly, all keys are divided into different groups based on the join_column.
     Then the where_index is used to separate keys from different where clauses.
     Finally, merging columns together.
+
+    If hash_join is set, the input is not sorted, and is joined by :func:`_hash_join_input` instead.
     """
     from itertools import groupby
     empty = ()
 
-    def _merge_record(offset, r1, r2):
-        return [i if i is not None else j for i, j in zip(r1[offset:], r2[offset:])]
-
     def _join_input():
         # inp is a list of (key, value) tuples, the join_cloumn is the 2nd item of the key.
         for joinkey, rest in groupby(inp, lambda k: k[0][1]):
@@ -568,11 +929,16 @@ def process_join(interface, state, label, inp, task, full_join, label_fn,
                         newrecord = _merge_record(2, first_record, record)
                         yield newrecord, value
 
+    if hash_join:
+        joined = _hash_join_input(inp, task, build, join_buffer_size)
+    else:
+        joined = _join_input()
+
     if need_agg and not wide:
-        for out_label, key in agg_fn(_join_input(), label_fn, ffuncs, ghfuncs, deffuncs):
+        for out_label, key in agg_fn(joined, label_fn, ffuncs, ghfuncs, deffuncs):
             interface.output(out_label).add(key, empty)
     else:
-        for key, value in _join_input():
+        for key, value in joined:
             out_label = label_fn(key)
             # print "JOIN: %s %s" % (key, value)
             interface.output(out_label).add(key, value)
@@ -592,10 +958,21 @@ def process_order(interface, state, label, inp, task, distinct, limit):
 
 
 def process_group(interface, state, label, inp, task, ffuncs, ghfuncs,
-                  deffuncs, label_fn=None):
-    """Process function of aggregation combine stage."""
+                  deffuncs, label_fn=None, top_k=0, sort_range=(), desc=False,
+                  hfuncs=None, agg_buffer_size='5%', batchfuncs=()):
+    """
+    Process function of aggregation combine stage.
+
+    The input isn't sorted, so the groups are kept in a dict.  If they outgrow agg_buffer_size, they are
+    spilled to a file sorted by group, with their accumulators turned into partial aggregations by hfuncs,
+    and the files are merged at the end, like in :func:`hustle.core.pipeworker.disk_sort`.
+    """
+    import os
     from itertools import groupby
     from functools import partial
+    from heapq import merge
+    from operator import itemgetter
+    from hustle.core.pipeworker import _write_run, _read_run
 
     empty = ()
 
@@ -603,39 +980,65 @@ def process_group(interface, state, label, inp, task, ffuncs, ghfuncs,
     # didn't work. Then we can get rid of "type(f) != partial"
     group_template = [(lambda a: a) if type(f) != partial and f.__name__ == 'dflt_f' else (lambda a: None)
                       for f in ffuncs]
-    # pull the key apart
-    for group, tups in groupby(inp,
-                               lambda (k, _):
-                               tuple(ef(e) for e, ef in zip(k, group_template))):
-        accums = [default() for default in deffuncs]
-        for record, _ in tups:
-            # print "Group: %s, REC: %s" % (group, repr(record))
-            try:
-                accums = [f(a, v) for f, a, v in zip(ffuncs, accums, record)]
-            except Exception as e:
-                print e
-                print "YOLO: f=%s a=%s r=%s g=%s" % (ffuncs, accums, record, group)
-                import traceback
-                print traceback.format_exc(15)
-                raise e
 
-        key = tuple(h(a) for h, a in zip(ghfuncs, accums))
+    def _spill(vals, runs):
+        run = task.path('group-%d' % len(runs))
+        _write_run(((group, tuple(h(a) for h, a in zip(hfuncs, accums)))
+                    for group, accums in sorted(vals.iteritems(), key=itemgetter(0))), run)
+        runs.append(run)
+        vals.clear()
+
+    def _groups():
+        vals = {}
+        runs = []
+        max_groups = 0
+        try:
+            for group, records in _grouped_records(inp, group_template, batchfuncs):
+                accums = vals.get(group)
+                if accums is None:
+                    accums = [default() for default in deffuncs]
+                    if not max_groups:
+                        max_groups = _max_groups(agg_buffer_size, group, accums)
+                    elif len(vals) >= max_groups and hfuncs:
+                        _spill(vals, runs)
+                vals[group] = _accumulate(accums, records, ffuncs, batchfuncs)
+
+            if not runs:
+                for group, accums in vals.iteritems():
+                    yield tuple(h(a) for h, a in zip(ghfuncs, accums)), group
+            else:
+                _spill(vals, runs)
+                # merge the partial aggregations of each group from all of the files
+                for group, partials in groupby(merge(*(_read_run(run) for run in runs)),
+                                               itemgetter(0)):
+                    accums = _accumulate([default() for default in deffuncs],
+                                         [record for _, record in partials],
+                                         ffuncs, batchfuncs)
+                    yield tuple(h(a) for h, a in zip(ghfuncs, accums)), group
+        finally:
+            for run in runs:
+                try:
+                    os.unlink(run)
+                except OSError:
+                    pass
+
+    groups = _groups()
+    if top_k:
+        groups = _top_k(groups, top_k, sort_range, desc)
+    for key, group in groups:
         if label_fn:
             label = label_fn(group)
         interface.output(label).add(key, empty)
 
 
 def process_skip_group(interface, state, label, inp, task, ffuncs,
-                       ghfuncs, deffuncs, label_fn=None):
+                       ghfuncs, deffuncs, label_fn=None, batchfuncs=()):
     """Process function of aggregation combine stage without groupby.
     """
     empty = ()
     accums = [default() for default in deffuncs]
-    for record, _ in inp:
-        try:
-            accums = [f(a, v) for f, a, v in zip(ffuncs, accums, record)]
-        except Exception as e:
-            raise e
+    for _, records in _grouped_records(inp, (), batchfuncs):
+        accums = _accumulate(accums, records, ffuncs, batchfuncs)
 
     key = tuple(h(a) for h, a in zip(ghfuncs, accums))
     interface.output(0).add(key, empty)
@@ -6,7 +6,6 @@ from disco.util import shuffled, chainify
 from disco.worker.pipeline import worker
 from disco.worker.pipeline.worker import Stage
 from heapq import merge
-from itertools import islice
 
 
 # import sys
@@ -14,115 +13,94 @@ from itertools import islice
 # import pydevd
 # pydevd.settrace('localhost', port=12999, stdoutToServer=True, stderrToServer=True)
 
-def sort_reader(fd, fname, read_buffer_size=8192):
-    buf = ""
-    while True:
-        r = fd.read(read_buffer_size)
-        buf += r
+def _sort_budget(sort_buffer_size):
+    """
+    Convert a sort buffer size, either a number of bytes or a percentage of physical memory like '15%',
+    into a number of bytes.
+    """
+    import os
+    if isinstance(sort_buffer_size, basestring) and sort_buffer_size.endswith('%'):
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        return int(total * float(sort_buffer_size[:-1]) / 100)
+    return int(sort_buffer_size)
 
-        kayvees = buf.split('\n')
-        buf = kayvees[-1]
 
-        # the last key/value pair will be truncated except for EOF, in which case it will be empty
-        for kayvee in islice(kayvees, len(kayvees) - 1):
-            raws = kayvee.split(b"\xff")
-            yield islice(raws, len(raws) - 1)
+def _write_run(keys, filename):
+    import marshal
+    with open(filename, 'wb', 1 << 16) as fd:
+        for key in keys:
+            marshal.dump(key, fd)
 
-        if not len(r):
-            if len(buf):
-                print("Couldn't match the last {0} bytes in {1}. "
-                      "Some bytes may be missing from input.".format(len(buf), fname))
-            break
+
+def _read_run(filename, read_buffer_size=1 << 16):
+    import marshal
+    with open(filename, 'rb', read_buffer_size) as fd:
+        while True:
+            try:
+                yield marshal.load(fd)
+            except EOFError:
+                break
 
 
 def disk_sort(input, filename, sort_keys, binaries=(), sort_buffer_size='10%',
               desc=False):
-    import ujson
-    from disco.comm import open_local
-    from disco.fileutils import AtomicFile
-    import base64
-    # import sys
-    # sys.path.append('/Library/Python/2.7/site-packages/pycharm-debug.egg')
-    # import pydevd
-    # pydevd.settrace('localhost', port=12999, stdoutToServer=True, stderrToServer=True)
-    out_fd = AtomicFile(filename)
-    key_types = None
-    MPT = ()
-    # print "SORTKEY: %s" % repr(sort_keys)
-    for key, _ in input:
-        if isinstance(key, (str, unicode)):
-            raise ValueError("Keys must be sequences", key)
-
-        # determine if the key is numeric
-        if key_types is None:
-            key_types = []
-            for kt in key:
-                try:
-                    float(kt)
-                    key_types.append('n')
-                except:
-                    key_types.append('')
-
-        #serialize the key - encoded either as NULL, json, or b64 - note that
-        for i, each_key in enumerate(key):
-            if each_key is None:
-                ukey = b'\x00'
-            elif i in binaries and key_types[i] != 'n':
-                ukey = base64.b64encode(each_key)
-            else:
-                ukey = ujson.dumps(each_key)
-            out_fd.write(ukey)
-            out_fd.write(b'\xff')
-        out_fd.write('\n')
-    out_fd.flush()
-    out_fd.close()
-    unix_sort(filename,
-              [(sk, key_types[sk]) for sk in sort_keys],
-              sort_buffer_size=sort_buffer_size,
-              desc=desc)
-    fd = open_local(filename)
-    for k in sort_reader(fd, fd.url):
-        # yield [ujson.loads(key) if key != b'\x00' else None for key in k], MPT
-
-        rval = []
-        for i, key in enumerate(k):
-            if key == b'\x00':
-                rkey = None
-            elif i in binaries:
-                rkey = base64.b64decode(key)
-            else:
-                rkey = ujson.loads(key)
-            rval.append(rkey)
-        yield rval, MPT
-
+    """
+    An external merge sort of the keys in input on the sort_keys columns.  Keys are sorted in memory in runs of
+    about sort_buffer_size bytes (see :func:`_sort_budget`), which are spilled to files next to filename in
+    marshal's binary format, and then merged.  If the input fits in a single run, it never touches the disk.
+
+    The size of the keys is estimated from the marshalled size of a sample of them.  Keys are yielded as the
+    Python objects they are, whether they were spilled or not, so binary columns need no special encoding.
+    None sorts before any other value.  The binaries argument is deprecated and ignored.
+    """
+    import marshal
+    import os
+    from operator import itemgetter
 
-def sort_cmd(filename, sort_keys, sort_buffer_size, desc=False):
+    MPT = ()
+    # the marshalled size of one in SAMPLE keys is measured
+    SAMPLE = 64
+    budget = _sort_budget(sort_buffer_size)
+    sort_key = itemgetter(*sort_keys)
+    runs = []
     keys = []
-    # print "File %s" % filename
-    for index, typ in sort_keys:
-        keys.append("-k")
-        index += 1
-        if desc:
-            keys.append("%d,%dr%s" % (index, index, typ))
-        else:
-            keys.append("%d,%d%s" % (index, index, typ))
-
-    cmd = ["sort", "-t", '\xff']
-    return (cmd + keys + ["-T", ".", "-S", sort_buffer_size, "-o", filename, filename],
-            False)
-
-
-def unix_sort(filename, sort_keys, sort_buffer_size='10%', desc=False):
-    import subprocess, os.path
-    if not os.path.isfile(filename):
-        raise Exception("Invalid sort input file {0}".format(filename), filename)
+    sampled = sampled_size = 0
     try:
-        env = os.environ.copy()
-        env['LC_ALL'] = 'C'
-        cmd, shell = sort_cmd(filename, sort_keys, sort_buffer_size, desc=desc)
-        subprocess.check_call(cmd, env=env, shell=shell)
-    except subprocess.CalledProcessError as e:
-        raise Exception("Sorting {0} failed: {1}".format(filename, e), filename)
+        for key, _ in input:
+            if isinstance(key, (str, unicode)):
+                raise ValueError("Keys must be sequences", key)
+            if not len(keys) % SAMPLE:
+                sampled += 1
+                sampled_size += len(marshal.dumps(key))
+            keys.append(key)
+            if len(keys) * sampled_size >= budget * sampled:
+                keys.sort(key=sort_key, reverse=desc)
+                run = "%s.%d" % (filename, len(runs))
+                _write_run(keys, run)
+                runs.append(run)
+                keys = []
+
+        keys.sort(key=sort_key, reverse=desc)
+        if not runs:
+            for key in keys:
+                yield key, MPT
+        else:
+            run = "%s.%d" % (filename, len(runs))
+            _write_run(keys, run)
+            runs.append(run)
+            del keys[:]
+            # the wrappers only order the merge, the keys themselves are passed along with them
+            for _, key in merge(*(merge_wrapper(((key, key) for key in _read_run(run)),
+                                                sort_range=sort_keys,
+                                                desc=desc)
+                                  for run in runs)):
+                yield key, MPT
+    finally:
+        for run in runs:
+            try:
+                os.unlink(run)
+            except OSError:
+                pass
 
 
 class _lt_wrapper(tuple):
@@ -228,11 +206,11 @@ class Worker(worker.Worker):
                 for label, inputs in map.iteritems():
 
                     input = chainify(shuffled(inputs))
+                    # the budget is in marshalled bytes, the keys take a few times more as Python objects
                     newmap[label] = [disk_sort(input,
                                                task.path('sort.dl'),
                                                sort_keys=stage.sort,
-                                               sort_buffer_size='15%',
-                                               binaries=stage.binaries,
+                                               sort_buffer_size='5%',
                                                desc=stage.desc)]
             map = newmap
         #print "OUTSIE: %s" % str(map)
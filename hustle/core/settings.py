@@ -18,28 +18,64 @@ defaults = {
     'dump': False,
     'worker_class': 'disco.worker.classic.worker.Worker',
     'partition': 16,
-    'history_size': 1000
+    'history_size': 1000,
+    'catalog_ttl': 60,
+    'catalog_threads': 8
 }
 
 overrides = {}
 
+# the defaults, settings file and overrides merged, by settings file: (its mtime, the overrides, the settings)
+_loaded = {}
+# the DDFS and Disco clients by (class, server, settings file), and the worker classes by name
+_clients = {}
+_worker_classes = {}
+
+
+def _load(path):
+    # the settings file is only read again when it changes, and merged again when the overrides change
+    mtime = os.path.getmtime(path) if path and os.path.exists(path) else None
+    loaded = _loaded.get(path)
+    if loaded is not None and loaded[0] == mtime and loaded[1] == overrides:
+        return loaded[2]
+
+    rval = dict(defaults)
+    if mtime is not None:
+        try:
+            import yaml
+            rval.update(yaml.load(open(path)))
+        except:
+            pass  # if ya can't ya can't
+    rval.update(overrides)
+    _loaded[path] = mtime, dict(overrides), rval
+    return rval
+
+
+def _client(cls, server, path):
+    key = cls, server, path
+    if key not in _clients:
+        _clients[key] = cls(server)
+    return _clients[key]
+
+
+def _worker_class(name):
+    if name not in _worker_classes:
+        worker_mod, _, worker_class = name.rpartition('.')
+        mod = __import__(worker_mod, {}, {}, worker_mod)
+        _worker_classes[name] = getattr(mod, worker_class)
+    return _worker_classes[name]
+
 
 class Settings(dict):
+    """
+    The settings of a call: the defaults, overridden by the settings file, by the module's overrides and by the
+    arguments.  The settings file is only parsed again once it changes, and the DDFS and Disco clients are
+    shared by all the settings with the same server and settings file.
+    """
     def __init__(self, *args, **kwargs):
-        # load the defaults
-        super(Settings, self).update(defaults)
-
-        # override with the settings file
-        path = kwargs.get('settings_file') or self['settings_file']
-        if path and os.path.exists(path):
-            try:
-                import yaml
-                self.update(yaml.load(open(path)))
-            except:
-                pass  # if ya can't ya can't
-
-        # final overrides
-        super(Settings, self).update(overrides)
+        # the defaults, the settings file and the overrides
+        path = kwargs.get('settings_file') or defaults['settings_file']
+        super(Settings, self).update(_load(path))
         super(Settings, self).__init__(*args, **kwargs)
 
         # set up ddfs and disco
@@ -47,11 +83,9 @@ class Settings(dict):
             self['server'] = 'disco://' + self['server']
 
         if 'ddfs' not in self:
-            self['ddfs'] = DDFS(self['server'])
-        self['server'] = Disco(self['server'])
+            self['ddfs'] = _client(DDFS, self['server'], path)
+        self['server'] = _client(Disco, self['server'], path)
 
         # set up worker
         if 'worker' not in self:
-            worker_mod, _, worker_class = self['worker_class'].rpartition('.')
-            mod = __import__(worker_mod, {}, {}, worker_mod)
-            self['worker'] = getattr(mod, worker_class)()
+            self['worker'] = _worker_class(self['worker_class'])()
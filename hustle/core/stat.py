@@ -9,7 +9,7 @@ import hustle.core.marble
 
 def stat_input_stream(fd, size, url, params):
     from disco import util
-    from hustle.core.marble import MarbleStream
+    from hustle.core.marble import stream_cache
 
     try:
         scheme, netloc, rest = util.urlsplit(url)
@@ -23,7 +23,7 @@ def stat_input_stream(fd, size, url, params):
         fle = util.localize(rest, disco_data=params._task.disco_data,
                             ddfs_data=params._task.ddfs_data)
         # print "FLOGLE: %s" % fle
-        otab = MarbleStream(fle)
+        otab = stream_cache.open(fle)
         rows = otab.number_rows
         frows = float(rows)
         rval = {'_': rows, }
@@ -36,7 +36,7 @@ def stat_input_stream(fd, size, url, params):
         raise e
     finally:
         if otab:
-            otab.close()
+            stream_cache.release(otab)
 
 
 class StatPipe(Job):
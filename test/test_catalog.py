@@ -0,0 +1,111 @@
+import unittest
+from hustle.core.catalog import Catalog
+
+
+class CommError(Exception):
+    def __init__(self, message, code):
+        super(CommError, self).__init__(message)
+        self.code = code
+
+
+class DDFS(object):
+    def __init__(self):
+        self.calls = []
+        self.tags = {'hustle:imps': [], 'hustle:imps:2014-01-01': [['a1', 'a2']],
+                     'hustle:imps:2014-01-02': [['b1'], ['c1']], 'hustle:pix': [['tag://hustle:imps:2014-01-01']]}
+
+    def list(self, prefix):
+        self.calls.append(('list', prefix))
+        return (tag for tag in sorted(self.tags) if tag.startswith(prefix))
+
+    def get(self, tag):
+        self.calls.append(('get', tag))
+        if tag not in self.tags:
+            raise CommError("unknown tag", 404)
+        return {'id': tag, 'urls': self.tags[tag], 'user-data': {'_fields_': '["+x"]'}}
+
+
+class TestCatalog(unittest.TestCase):
+    def test_cache(self):
+        ddfs = DDFS()
+        catalog = Catalog(ddfs, ttl=60)
+        tags = ['hustle:imps', 'hustle:imps:2014-01-01', 'hustle:imps:2014-01-02']
+        self.assertListEqual(catalog.list('hustle:imps'), tags)
+        self.assertListEqual(catalog.list('hustle:imps'), tags)
+        self.assertListEqual(catalog.blobs('hustle:imps:2014-01-02'), [['b1'], ['c1']])
+        self.assertListEqual(catalog.blobs('hustle:imps:2014-01-02'), [['b1'], ['c1']])
+        self.assertEqual(catalog.getattr('hustle:imps', '_fields_'), '["+x"]')
+        self.assertEqual(catalog.getattr('hustle:imps', '_fields_'), '["+x"]')
+        self.assertEqual(catalog.getattr('hustle:imps:2014-01-02', '_fields_'), '["+x"]')
+        self.assertListEqual(ddfs.calls, [('list', 'hustle:imps'), ('get', 'hustle:imps:2014-01-02'),
+                                          ('get', 'hustle:imps')])
+
+    def test_tag_references(self):
+        ddfs = DDFS()
+        catalog = Catalog(ddfs, ttl=60)
+        ddfs.tags['hustle:imps'] = [['tag://hustle:pix'], ['d1'], ['tag://hustle:imps:2014-01-02']]
+        self.assertListEqual(catalog.blobs('hustle:imps'), [['a1', 'a2'], ['d1'], ['b1'], ['c1']])
+        ddfs.tags['hustle:imps:2014-01-01'] = [['tag://hustle:pix']]
+        catalog.invalidate('hustle:imps:2014-01-01')
+        self.assertListEqual(catalog.blobs('hustle:pix'), [])
+        # missing tags that are referred to are skipped, like DDFS.blobs() does
+        ddfs.tags['hustle:pix'] = [['tag://hustle:gone'], ['e1']]
+        catalog.invalidate('hustle:pix')
+        self.assertListEqual(catalog.blobs('hustle:pix'), [['e1']])
+        self.assertRaises(CommError, catalog.blobs, 'hustle:gone')
+
+    def test_no_ttl(self):
+        ddfs = DDFS()
+        catalog = Catalog(ddfs, ttl=0)
+        catalog.attrs('hustle:imps')
+        catalog.attrs('hustle:imps')
+        catalog.prefetch(['hustle:pix', 'hustle:imps'])
+        self.assertListEqual(ddfs.calls, [('get', 'hustle:imps')] * 2)
+
+    def test_prefetch(self):
+        ddfs = DDFS()
+        catalog = Catalog(ddfs, ttl=60, threads=4)
+        catalog.blobs('hustle:imps')
+        tags = sorted(ddfs.tags)
+        catalog.prefetch(tags)
+        self.assertEqual(len(ddfs.calls), len(tags))
+        self.assertEqual(ddfs.calls.count(('get', 'hustle:imps')), 1)
+        for tag in tags:
+            catalog.blobs(tag)
+            self.assertEqual(catalog.getattr(tag, '_fields_'), '["+x"]')
+        self.assertEqual(len(ddfs.calls), len(tags))
+
+    def test_invalidate_during_fetch(self):
+        ddfs = DDFS()
+        catalog = Catalog(ddfs, ttl=60)
+        get = ddfs.get
+
+        def racing_get(tag):
+            # a write invalidates the tag while its old version is being fetched
+            rval = get(tag)
+            catalog.invalidate('hustle:imps')
+            return rval
+        ddfs.get = racing_get
+        catalog.blobs('hustle:imps:2014-01-02')
+        ddfs.get = get
+        ddfs.tags['hustle:imps:2014-01-02'] = [['d1']]
+        self.assertListEqual(catalog.blobs('hustle:imps:2014-01-02'), [['d1']])
+
+    def test_invalidate(self):
+        ddfs = DDFS()
+        catalog = Catalog(ddfs, ttl=60)
+        for prefix in ('hustle:', 'hustle:imps', 'hustle:pix'):
+            catalog.list(prefix)
+        for tag in ddfs.tags:
+            catalog.blobs(tag)
+        ddfs.tags['hustle:imps:2014-01-03'] = []
+        catalog.invalidate('hustle:imps')
+        del ddfs.calls[:]
+
+        self.assertIn('hustle:imps:2014-01-03', catalog.list('hustle:'))
+        self.assertIn('hustle:imps:2014-01-03', catalog.list('hustle:imps'))
+        catalog.list('hustle:pix')
+        catalog.attrs('hustle:pix')
+        catalog.attrs('hustle:imps:2014-01-01')
+        self.assertListEqual(ddfs.calls, [('list', 'hustle:'), ('list', 'hustle:imps'),
+                                          ('get', 'hustle:imps:2014-01-01')])
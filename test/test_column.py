@@ -113,6 +113,25 @@ class TestColumn(unittest.TestCase):
         c == "foo"
         c != "foo"
 
+    def test_check_range_query_for_ordered_trie(self):
+        c = Column(_NAME, None, index_indicator=1, partition=False,
+                   type_indicator=mdb.MDB_STR, compression_indicator=0,
+                   rtrie_indicator=mdb.MDB_UINT_16, ordered=True)
+        self.assertTrue(c.is_ordered)
+        c < "foo"
+        c <= "foo"
+        c > "foo"
+        c >= "foo"
+        c == "foo"
+        c != "foo"
+
+        c = Column(_NAME, None, index_indicator=1, partition=False,
+                   type_indicator=mdb.MDB_STR, compression_indicator=2,
+                   ordered=True)
+        self.assertFalse(c.is_ordered)
+        with self.assertRaises(TypeError):
+            c < "foo"
+
     def test_check_range_query_for_lz4(self):
         c = Column(_NAME, None, index_indicator=1, partition=False,
                    type_indicator=mdb.MDB_STR, compression_indicator=2,
@@ -4,7 +4,9 @@ import os
 import rtrie
 import mdb
 from pyebset import BitSet
-from hustle.core.marble import Marble, MarbleStream
+from hustle.core.marble import Marble, MarbleStream, MarbleStreamCache, BitmapCache, in_eq, in_in, \
+    in_ne, in_conditional, zone_match, BloomFilter, dump_blooms, load_blooms, bloom_columns, _remap_keys
+from hustle.core import marble as marble_module
 import clz4
 
 _FIELDS_RAW = ("id", "name", "artist", "date", "quantity", "genre", "rating")
@@ -311,6 +313,398 @@ class TestMarble(unittest.TestCase):
 
         stream.close()
 
+    def test_marble_stream_group_counts(self):
+        from collections import Counter
+        stream = MarbleStream(self.files["1986-01-03"])
+        albums = [a for a in self.albums if a[_PARTITIONS] == "1986-01-03"]
+        for col in ("genre", "rating", "name"):
+            self.assertDictEqual(dict(stream.group_counts(col)),
+                                 Counter(a[col] for a in albums))
+
+        where = stream.bit_ge("rating", 5)
+        self.assertDictEqual(dict(stream.group_counts("genre", where)),
+                             Counter(a["genre"] for a in albums if a["rating"] >= 5))
+        self.assertDictEqual(dict(stream.group_counts("rating", where)), {5: len(where)})
+        stream.close()
+
+    def test_marble_stream_fetch_batch(self):
+        stream = MarbleStream(self.files["1986-01-03"])
+        columns = list(_FIELDS_RAW) + ["_count"]
+        rids = list(stream.iter_all())
+        for col, values in zip(columns, stream.fetch_batch(columns, rids)):
+            self.assertListEqual(list(values), list(stream.mget(col, rids)))
+
+        rids = list(stream.bit_ge("rating", 5))
+        for col, values in zip(columns, stream.fetch_batch(columns, rids)):
+            self.assertListEqual(list(values), list(stream.mget(col, rids)))
+
+        # where a C long isn't 64 bits
+        vids, = stream.fetch_batch(["genre"], rids, decode=False)
+        marble_module._MGETEX_INTO = False
+        try:
+            for col, values in zip(columns, stream.fetch_batch(columns, rids)):
+                self.assertListEqual(list(values), list(stream.mget(col, rids)))
+            self.assertListEqual(stream.fetch_batch(["genre"], rids, decode=False), [list(vids)])
+        finally:
+            marble_module._MGETEX_INTO = True
+        stream.close()
+
+    def test_marble_stream_vid_cache(self):
+        stream = MarbleStream(self.files["1986-01-03"])
+        rids = list(stream.iter_all())
+        genres = list(stream.mget("genre", rids))
+        self.assertListEqual(genres, [a["genre"] for a in self.albums if a[_PARTITIONS] == "1986-01-03"])
+        # the same value object is returned for the same VID
+        again = list(stream.mget("genre", rids))
+        self.assertTrue(all(a is b for a, b in zip(genres, again)))
+        stream.close()
+
+    def test_marble_stream_vid_decoder(self):
+        stream = MarbleStream(self.files["1986-01-03"])
+        rids = list(stream.iter_all())
+        vids, = stream.fetch_batch(["genre"], rids, decode=False)
+        decode = stream.vid_decoder("genre")
+        genres = list(stream.mget("genre", rids))
+        stream.close()
+        self.assertListEqual([decode(vid) for vid in vids], genres)
+
+    def test_marble_stream_lazy_dbs(self):
+        stream = MarbleStream(self.files["1986-01-03"])
+        self.assertEqual(stream.marble._name, self.marble._name)
+        self.assertListEqual(sorted(dict.keys(stream.dbs)), ["_count", _PARTITIONS])
+        rids = list(stream.iter_all())
+        self.assertListEqual(list(stream.mget("artist", rids)),
+                             [a["artist"] for a in self.albums if a[_PARTITIONS] == "1986-01-03"])
+        self.assertIn("rating", stream.dbs)
+        self.assertListEqual(sorted(dict.keys(stream.dbs)), ["_count", "artist", _PARTITIONS])
+        self.assertRaises(KeyError, lambda: stream.dbs["nosuchcolumn"])
+        self.assertListEqual(sorted(name for name, _ in stream.dbs.iteritems()),
+                             sorted(self.marble._columns.keys() + ["_count"]))
+        stream.close()
+
+    def test_marble_stream_lazy_dbs_threads(self):
+        from threading import Thread
+        import time
+        stream = MarbleStream(self.files["1986-01-03"])
+        opened = []
+        open_column = stream.dbs._open_column
+
+        def slow_open(name, column):
+            opened.append(name)
+            time.sleep(0.01)
+            return open_column(name, column)
+        stream.dbs._open_column = slow_open
+        threads = [Thread(target=lambda: [stream.dbs[name] for name in _FIELDS_RAW]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # each column is opened once, by one of the threads
+        self.assertListEqual(sorted(opened), sorted(set(_FIELDS_RAW) - {_PARTITIONS}))
+        stream.close()
+
+    def test_marble_stream_cache(self):
+        cache = MarbleStreamCache(max_open=1)
+        old, new = self.files["1986-01-03"], self.files["1992-10-03"]
+        stream = cache.open(old)
+        self.assertIs(cache.open(old), stream)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.release(stream)
+        cache.release(stream)
+
+        # evicted while in use, so it stays open until released
+        stream = cache.open(old)
+        other = cache.open(new)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(stream.get("name", 1), "Pianist")
+        cache.release(stream)
+        cache.release(other)
+        self.assertIsNot(cache.open(old), stream)
+
+        # a replaced file is reopened
+        stream = cache.open(new)
+        cache.release(stream)
+        st = os.stat(new)
+        os.utime(new, (st.st_atime, st.st_mtime + 1))
+        self.assertIsNot(cache.open(new), stream)
+        self.assertEqual(cache.misses, 5)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_bitmap_cache(self):
+        from functools import partial
+        cache = BitmapCache()
+        stream = MarbleStream(self.files["1986-01-03"])
+        eq = partial(in_eq, col="rating", other=5)
+        bitmap = cache.get(stream, False, eq)
+        self.assertListEqual(list(bitmap), [1, 2, 3, 5])
+        self.assertIs(cache.get(stream, False, partial(in_eq, col="rating", other=5)), bitmap)
+        self.assertListEqual(list(cache.get(stream, True, eq)), [4, 6])
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        bitmap = cache.get(stream, False, partial(in_in, col="rating", other=[3, 4]))
+        self.assertIs(cache.get(stream, False, partial(in_in, col="rating", other=(4, 3))), bitmap)
+        self.assertEqual(len(cache), 3)
+        stream.close()
+
+        cache = BitmapCache(max_bytes=1)
+        stream = MarbleStream(self.files["1986-01-03"])
+        self.assertListEqual(list(cache.get(stream, False, eq)), [1, 2, 3, 5])
+        self.assertEqual(len(cache), 0)
+        stream.close()
+
+    def test_and_selectivity(self):
+        from functools import partial
+        stream = MarbleStream(self.files["1986-01-03"])
+        where = partial(in_conditional, op='and',
+                        l_expr=partial(in_eq, col="rating", other=5),
+                        r_expr=partial(in_conditional, op='and',
+                                       l_expr=partial(in_eq, col="genre", other="SoundTrack"),
+                                       r_expr=partial(in_ne, col="name", other="Pianist")))
+        self.assertListEqual(list(where(stream, False)), [2, 3, 5])
+        self.assertListEqual(list(where(stream, True)), [1, 4, 6])
+
+        # the broad leg goes last, and isn't evaluated once no row is left
+        calls = []
+
+        def everything(tablet, invert):
+            calls.append(invert)
+            return stream.bit_ge("rating", 0)
+
+        where = partial(in_conditional, op='and', l_expr=everything,
+                        r_expr=partial(in_eq, col="rating", other=1))
+        self.assertListEqual(list(where(stream, False)), [])
+        self.assertListEqual(calls, [])
+        where = partial(in_conditional, op='and', l_expr=everything,
+                        r_expr=partial(in_eq, col="rating", other=3))
+        self.assertListEqual(list(where(stream, False)), [6])
+        self.assertListEqual(calls, [False])
+        stream.close()
+
+    def test_zone_maps(self):
+        zones = Marble.zone_maps(self.files["1986-01-03"])
+        self.assertListEqual(sorted(zones), ["genre", "id", "rating"])
+        self.assertDictEqual(zones["id"], {"min": 1004, "max": 1009, "distinct": 6, "nulls": 0})
+        self.assertDictEqual(zones["rating"], {"min": 3, "max": 5, "distinct": 3, "nulls": 0})
+        self.assertDictEqual(zones["genre"], {"min": "SoundTrack", "max": "SoundTrack",
+                                              "distinct": 1, "nulls": 0})
+
+        rating, genre, id = self.marble.rating, self.marble.genre, self.marble.id
+        self.assertTrue(zone_match(zones, (rating == 4).f))
+        self.assertFalse(zone_match(zones, (rating == 6).f))
+        self.assertTrue(zone_match(zones, (~(rating == 6)).f))
+        self.assertFalse(zone_match(zones, (rating > 5).f))
+        self.assertTrue(zone_match(zones, (rating >= 5).f))
+        self.assertFalse(zone_match(zones, (rating < 3).f))
+        self.assertFalse(zone_match(zones, (id << [1000, 1003]).f))
+        self.assertTrue(zone_match(zones, (id << [1000, 1005]).f))
+        self.assertFalse(zone_match(zones, (genre == "R&R").f))
+        self.assertFalse(zone_match(zones, (genre != u"SoundTrack").f))
+        self.assertFalse(zone_match(zones, ((genre == "R&R") & (rating == 4)).f))
+        self.assertTrue(zone_match(zones, ((genre == "R&R") | (rating == 4)).f))
+        self.assertFalse(zone_match(zones, (~((genre == "SoundTrack") | (rating == 4))).f))
+        # can't be compared, so it may match
+        self.assertTrue(zone_match(zones, (rating == "4").f))
+        self.assertTrue(zone_match(zones, (self.marble.name == "x").f))
+
+    def test_zone_maps_not_utf8(self):
+        marble = Marble(name="Words", fields=("+%s", "+@4n"))
+        rows = [{'s': 'caf\xe9', 'n': 1}, {'s': 'tea', 'n': 2}]
+        n_inserted, files = marble._insert([rows], decoder=lambda row: row)
+        try:
+            self.assertEqual(n_inserted, 2)
+            file, = files.values()
+            zones = Marble.zone_maps(file)
+            self.assertListEqual(sorted(zones), ["n"])
+            stream = MarbleStream(file)
+            self.assertListEqual(list(stream.mget("s", [1, 2])), ['caf\xe9', 'tea'])
+            stream.close()
+        finally:
+            for file in files.itervalues():
+                os.unlink(file)
+
+    def test_marble_stream_index_aggregates(self):
+        stream = MarbleStream(self.files["1986-01-03"])
+        ratings = [a["rating"] for a in self.albums if a[_PARTITIONS] == "1986-01-03"]
+        self.assertEqual(stream.index_sum("rating"), (sum(ratings), len(ratings)))
+        self.assertEqual(stream.index_min("rating"), min(ratings))
+        self.assertEqual(stream.index_max("rating"), max(ratings))
+
+        where = stream.bit_lt("rating", 5)
+        ratings = [r for r in ratings if r < 5]
+        self.assertEqual(stream.index_sum("rating", where), (sum(ratings), len(ratings)))
+        self.assertEqual(stream.index_min("rating", where), min(ratings))
+        self.assertEqual(stream.index_max("rating", where), max(ratings))
+        self.assertIsNone(stream.index_max("rating", BitSet()))
+        stream.close()
+
+
+class TestBitSlicedIndex(unittest.TestCase):
+    def setUp(self):
+        self.values = [5, -3, 0, 17, 5, 250, -128, 99, 5, 42]
+        self.marble = Marble(name="Amounts",
+                             fields=("+@4id", "^#4amount", "^@1level"))
+        rows = [{'id': i, 'amount': v, 'level': abs(v) % 256}
+                for i, v in enumerate(self.values)]
+        _, self.files = self.marble._insert([(ujson.dumps(r) for r in rows)])
+        self.stream = MarbleStream(self.files.values()[0])
+
+    def tearDown(self):
+        self.stream.close()
+        for _, file in self.files.iteritems():
+            os.unlink(file)
+
+    def _rids(self, pred, col='amount'):
+        return [i + 1 for i, v in enumerate(self.values)
+                if pred(v if col == 'amount' else abs(v) % 256)]
+
+    def test_bsi_column(self):
+        column = self.marble._columns['amount']
+        self.assertTrue(column.is_bsi)
+        self.assertEqual(column.schema_string(), '^#4amount')
+        self.assertEqual(column.description(), 'bsi int32 amount')
+
+    def test_bsi_out_of_range(self):
+        marble = Marble(name="Amounts", fields=("+@4id", "^#1small", "+%2tag"))
+        rows = [{'id': 1, 'small': 7, 'tag': 'a'}, {'id': 2, 'small': 200, 'tag': 'b'},
+                {'id': 3, 'small': -129, 'tag': 'c'}, {'id': 4, 'small': -5, 'tag': 'd'}]
+        n_inserted, files = marble._insert([(ujson.dumps(r) for r in rows)])
+        stream = MarbleStream(files.values()[0])
+        try:
+            # the rows with values that don't fit aren't stored at all
+            self.assertEqual(n_inserted, 2)
+            self.assertListEqual(list(stream.iter_all()), [1, 2])
+            self.assertListEqual(list(stream.mget("id", [1, 2])), [1, 4])
+            self.assertListEqual(list(stream.mget("tag", [1, 2])), ['a', 'd'])
+            self.assertListEqual(list(stream.mget("small", [1, 2])), [7, -5])
+            self.assertListEqual(list(stream.bit_eq("tag", "b")), [])
+            self.assertListEqual(list(stream.bit_eq("id", 2)), [])
+        finally:
+            stream.close()
+            for file in files.itervalues():
+                os.unlink(file)
+
+    def test_bsi_ops(self):
+        for col in ('amount', 'level'):
+            for val in (-200, -128, -3, 0, 5, 6, 42, 250, 255, 1000):
+                self.assertListEqual(list(self.stream.bit_eq(col, val)),
+                                     self._rids(lambda v: v == val, col))
+                self.assertListEqual(list(self.stream.bit_ne(col, val)),
+                                     self._rids(lambda v: v != val, col))
+                self.assertListEqual(list(self.stream.bit_lt(col, val)),
+                                     self._rids(lambda v: v < val, col))
+                self.assertListEqual(list(self.stream.bit_le(col, val)),
+                                     self._rids(lambda v: v <= val, col))
+                self.assertListEqual(list(self.stream.bit_gt(col, val)),
+                                     self._rids(lambda v: v > val, col))
+                self.assertListEqual(list(self.stream.bit_ge(col, val)),
+                                     self._rids(lambda v: v >= val, col))
+
+        vals = [5, 17, 1000]
+        self.assertListEqual(list(self.stream.bit_eq_ex('amount', vals)),
+                             self._rids(lambda v: v in vals))
+        self.assertListEqual(list(self.stream.bit_ne_ex('amount', vals)),
+                             self._rids(lambda v: v not in vals))
+
+    def test_bsi_sum(self):
+        _, idb, _, _, _ = self.stream.dbs['amount']
+        where = self.stream.bit_gt('amount', 0)
+        expected = [v for v in self.values if v > 0]
+        self.assertEqual(idb.sum(self.stream.txn, where), (sum(expected), len(expected)))
+        where = self.stream.bit_lt('amount', 10)
+        expected = [v for v in self.values if v < 10]
+        self.assertEqual(idb.sum(self.stream.txn, where), (sum(expected), len(expected)))
+
+    def test_bsi_min_max(self):
+        for col in ('amount', 'level'):
+            values = [v if col == 'amount' else abs(v) % 256 for v in self.values]
+            self.assertEqual(self.stream.index_min(col), min(values))
+            self.assertEqual(self.stream.index_max(col), max(values))
+            self.assertEqual(self.stream.index_sum(col), (sum(values), len(values)))
+            for val in (-3, 5, 42):
+                where = self.stream.bit_gt(col, val)
+                expected = [v for v in values if v > val]
+                self.assertEqual(self.stream.index_min(col, where), min(expected))
+                self.assertEqual(self.stream.index_max(col, where), max(expected))
+        self.assertIsNone(self.stream.index_min('amount', BitSet()))
+
+
+class TestOrderedTrie(unittest.TestCase):
+    def setUp(self):
+        self.rows = [{'id': i, 'date': d, 'url': u, 'name': n} for i, (d, u, n) in enumerate([
+            ('2014-03-07', 'http://b.com', 'zed'),
+            ('2014-02-28', 'http://a.com', 'hello'),
+            ('2014-03-07', 'http://a.com/x', 'hell'),
+            ('2013-12-31', 'http://c.com', 'help'),
+            ('2014-03-01', 'http://b.com', ''),
+            ('2014-02-28', 'http://a.com', 'goodbye'),
+            ('2014-03-10', 'http://d.com', 'good')])]
+        self.marble = Marble(name="Visits",
+                             fields=("+@4id", "+<%2date", "+%4url", "+<%4name"))
+        _, self.files = self.marble._insert([(ujson.dumps(r) for r in self.rows)])
+        self.stream = MarbleStream(self.files.values()[0])
+
+    def tearDown(self):
+        self.stream.close()
+        for _, file in self.files.iteritems():
+            os.unlink(file)
+
+    def _rids(self, col, pred):
+        return [i + 1 for i, r in enumerate(self.rows) if pred(r[col])]
+
+    def test_remap_keys(self):
+        db = {1: 'a', 2: 'b', 3: 'c', 5: 'e', 6: 'f'}
+
+        class DB(object):
+            def items(self, txn):
+                return db.items()
+
+            def get(self, txn, key):
+                return db[key]
+
+            def put(self, txn, key, value):
+                db[key] = value
+
+            def delete(self, txn, key):
+                del db[key]
+        # a cycle 1 -> 2 -> 3 -> 1, a move of 5 to the free 4 and a key that stays
+        _remap_keys(None, DB(), [0, 2, 3, 1, 5, 4, 6])
+        self.assertDictEqual(db, {2: 'a', 3: 'b', 1: 'c', 4: 'e', 6: 'f'})
+
+    def test_ordered_column(self):
+        column = self.marble._columns['date']
+        self.assertTrue(column.is_ordered)
+        self.assertFalse(self.marble._columns['url'].is_ordered)
+        self.assertEqual(column.schema_string(), '+<%2date')
+        self.assertEqual(column.description(), 'index ordered trie16 date')
+        self.assertTrue(self.stream.vid_sorted)
+        self.assertTrue(self.stream.vid16_sorted)
+
+    def test_rewritten_values(self):
+        for col in ('date', 'url', 'name'):
+            self.assertListEqual(list(self.stream.mget(col, range(1, len(self.rows) + 1))),
+                                 [r[col] for r in self.rows])
+            for r in self.rows:
+                if not r[col]:
+                    continue
+                self.assertListEqual(list(self.stream.bit_eq(col, r[col])),
+                                     self._rids(col, lambda v: v == r[col]))
+
+    def test_ordered_ops(self):
+        for sorted_tries in (True, False):
+            self.stream.vid_sorted = self.stream.vid16_sorted = sorted_tries
+            for col, vals in (('date', ('2013', '2014-02-28', '2014-03-02', '2014-03-07', '2015')),
+                              ('name', ('', 'a', 'good', 'hel', 'hell', 'helm', 'zed', 'zz'))):
+                for val in vals:
+                    self.assertListEqual(list(self.stream.bit_lt(col, val)),
+                                         self._rids(col, lambda v: v < val))
+                    self.assertListEqual(list(self.stream.bit_le(col, val)),
+                                         self._rids(col, lambda v: v <= val))
+                    self.assertListEqual(list(self.stream.bit_gt(col, val)),
+                                         self._rids(col, lambda v: v > val))
+                    self.assertListEqual(list(self.stream.bit_ge(col, val)),
+                                         self._rids(col, lambda v: v >= val))
+
 
 class TestInsertPartitionFilter(unittest.TestCase):
     def test_partition_numbers(self):
@@ -341,3 +735,80 @@ class TestInsertPartitionFilter(unittest.TestCase):
 
         for date, file in self.files.iteritems():
             os.unlink(file)
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        words = ["token%d" % i for i in range(1000)]
+        for word in words:
+            bloom.add(word)
+        self.assertTrue(all(bloom.may_contain(w) for w in words))
+        self.assertTrue(bloom.may_contain(u"token7"))
+        misses = sum(1 for i in range(10000) if bloom.may_contain("other%d" % i))
+        self.assertLess(misses, 300)
+        # other types may always be there
+        self.assertTrue(bloom.may_contain(7))
+
+        loaded = BloomFilter.loads(bloom.dumps())
+        self.assertEqual((loaded.size, loaded.hashes, loaded.numeric), (bloom.size, bloom.hashes, False))
+        self.assertTrue(all(w in loaded for w in words))
+
+        numbers = BloomFilter(3, numeric=True)
+        for i in (1, 5, 1 << 40):
+            numbers.add(i)
+        self.assertTrue(all(i in numbers for i in (1, 5, 1 << 40)))
+        self.assertTrue(numbers.may_contain("2"))
+
+    def test_insert_bloom(self):
+        albums = [dict(zip(_FIELDS_RAW, album)) for album in _ALBUMS]
+        marble = Marble(name="Collections", fields=_FIELDS, partition=_PARTITIONS)
+        self.assertRaises(ValueError, marble._insert, [], bloom=("date", ))
+        # where clauses can't look values up in columns that aren't indexed
+        self.assertRaises(ValueError, marble._insert, [], bloom=("artist", ))
+        _, files = marble._insert([(ujson.dumps(l) for l in albums)], bloom=("id", "genre", "rating"))
+        try:
+            blooms = load_blooms(dump_blooms(Marble.bloom_filters(files["1986-01-03"])))
+            self.assertListEqual(sorted(blooms), ["genre", "id", "rating"])
+            self.assertTrue(blooms["rating"].may_contain(3))
+            self.assertTrue(blooms["id"].may_contain(1004))
+            self.assertTrue(blooms["genre"].may_contain("SoundTrack"))
+            self.assertFalse(Marble.bloom_filters(files["1992-10-03"])["genre"].may_contain("SoundTrack"))
+
+            zones = Marble.zone_maps(files["1986-01-03"])
+            genre, id = marble.genre, marble.id
+            self.assertTrue(zone_match(zones, (genre == "SoundTrack").f, blooms=blooms))
+            self.assertFalse(zone_match(zones, (genre == "Soundtrack").f, blooms=blooms))
+            self.assertTrue(zone_match(zones, (genre != "Soundtrack").f, blooms=blooms))
+            self.assertFalse(zone_match(zones, (genre << ["Jazz", "Pop"]).f, blooms=blooms))
+            self.assertTrue(zone_match(zones, (id << [1000, 1006]).f, blooms=blooms))
+        finally:
+            for file in files.itervalues():
+                os.unlink(file)
+
+    def test_insert_bloom_too_big(self):
+        albums = [dict(zip(_FIELDS_RAW, album)) for album in _ALBUMS]
+        marble = Marble(name="Collections", fields=_FIELDS, partition=_PARTITIONS)
+        saved = marble_module.BLOOM_MAX_BYTES
+        # room for the single genre of each date, and the 2 ratings of 1992-10-03, but not the 3 of 1986-01-03
+        marble_module.BLOOM_MAX_BYTES = BloomFilter.nbytes(2)
+        self.assertEqual(BloomFilter.capacity_for(BloomFilter.nbytes(2)), 2)
+        try:
+            _, files = marble._insert([(ujson.dumps(l) for l in albums)], bloom=("genre", "rating"))
+        finally:
+            marble_module.BLOOM_MAX_BYTES = saved
+        try:
+            self.assertListEqual(sorted(Marble.bloom_filters(files["1992-10-03"])), ["genre", "rating"])
+            self.assertListEqual(sorted(Marble.bloom_filters(files["1986-01-03"])), ["genre"])
+        finally:
+            for file in files.itervalues():
+                os.unlink(file)
+
+    def test_bloom_columns(self):
+        marble = Marble(name="Collections", fields=_FIELDS, partition=_PARTITIONS)
+        genre, id, rating = marble.genre, marble.id, marble.rating
+        self.assertSetEqual(bloom_columns((genre == "Pop").f), {"genre"})
+        self.assertSetEqual(bloom_columns(((id << [1, 2]) | (rating > 3)).f), {"id"})
+        self.assertSetEqual(bloom_columns((genre != "Pop").f), set())
+        self.assertSetEqual(bloom_columns((~(genre != "Pop") & (rating == 4)).f), {"genre", "rating"})
+        self.assertSetEqual(bloom_columns((~(genre == "Pop")).f), set())
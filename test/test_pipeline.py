@@ -1,8 +1,14 @@
 import unittest
 from hustle.core.column_fn import ip_ntoa
-from hustle.core.pipeline import SelectPipe, _get_sort_range
-from hustle.core.marble import Marble
+from hustle.core.pipeworker import HustleStage
+from hustle.core.pipeline import SelectPipe, _get_sort_range, _top_k, process_join, _broadcast_join,\
+    _aggregate, _aggregate_fast, process_group
+from hustle.core.marble import Marble, Column, dflt_f, dflt_gh, dflt_default, dflt_batch
 from operator import itemgetter
+from collections import defaultdict
+import os
+import sys
+import tempfile
 
 
 EMP_FIELDS = ("+@2id", "+$name", "+%2hire_date", "+@4salary", "+@2department_id")
@@ -19,6 +25,27 @@ def second_items(items):
     return [first(item) for item in items]
 
 
+class _Output(list):
+    def add(self, key, value):
+        self.append((tuple(key), value))
+
+
+class _Interface(object):
+    def __init__(self):
+        self.outputs = defaultdict(_Output)
+
+    def output(self, label):
+        return self.outputs[label]
+
+
+class _Task(object):
+    def __init__(self):
+        self.dir = tempfile.mkdtemp()
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+
 class TestPipeline(unittest.TestCase):
     def setUp(self):
         self.emp = Marble(name="employee",
@@ -125,6 +152,238 @@ class TestPipeline(unittest.TestCase):
         self.assertEqual('group_all', pipeline[3][0])
         self.assertEqual('order-reduce', pipeline[3][1].name)
 
+    def test_count_only(self):
+        from hustle import h_count, h_sum
+        wheres = [(self.emp.salary > 25000)]
+
+        pipe = SelectPipe('server', wheres=wheres, project=[h_count()])
+        self.assertTrue(pipe.pipeline[0][1].input_chain[1].keywords['count_only'])
+
+        pipe = SelectPipe('server', wheres=wheres, project=[h_count(), h_sum(self.emp.salary)])
+        self.assertFalse(pipe.pipeline[0][1].input_chain[1].keywords['count_only'])
+
+        pipe = SelectPipe('server', wheres=wheres, project=[self.emp.name, h_count()])
+        self.assertFalse(pipe.pipeline[0][1].input_chain[1].keywords['count_only'])
+
+    def test_index_group(self):
+        from hustle import h_count, h_sum
+        wheres = [(self.emp.salary > 25000)]
+
+        pipe = SelectPipe('server', wheres=wheres, project=[self.emp.name, h_count()])
+        self.assertTrue(pipe.pipeline[0][1].input_chain[1].keywords['index_group'])
+
+        pipe = SelectPipe('server', wheres=wheres, project=[self.emp.name, h_sum(self.emp.salary)])
+        self.assertFalse(pipe.pipeline[0][1].input_chain[1].keywords['index_group'])
+
+        pipe = SelectPipe('server', wheres=wheres, project=[self.emp.name, self.emp.id, h_count()])
+        self.assertFalse(pipe.pipeline[0][1].input_chain[1].keywords['index_group'])
+
+        pipe = SelectPipe('server', wheres=wheres, project=[self.emp.name], distinct=True)
+        self.assertTrue(pipe.pipeline[0][1].input_chain[1].keywords['index_group'])
+
+        pipe = SelectPipe('server', wheres=wheres, project=[self.emp.name])
+        self.assertFalse(pipe.pipeline[0][1].input_chain[1].keywords['index_group'])
+
+    def test_index_aggs(self):
+        from hustle import h_count, h_sum, h_avg, h_max
+        wheres = [(self.emp.salary > 25000)]
+
+        project = [h_sum(self.emp.salary), h_avg(self.emp.salary), h_max(self.emp.id), h_count()]
+        pipe = SelectPipe('server', wheres=wheres, project=project)
+        self.assertEqual(len(pipe.pipeline[0][1].input_chain[1].keywords['index_aggs']), 4)
+
+        pipe = SelectPipe('server', wheres=wheres, project=[h_max(self.emp.hire_date)])
+        self.assertFalse(pipe.pipeline[0][1].input_chain[1].keywords['index_aggs'])
+
+        pipe = SelectPipe('server', wheres=wheres, project=[self.emp.id, h_sum(self.emp.salary)])
+        self.assertFalse(pipe.pipeline[0][1].input_chain[1].keywords['index_aggs'])
+
+        # strings can't be summed
+        pipe = SelectPipe('server', wheres=wheres, project=[h_sum(self.emp.hire_date), h_avg(self.emp.name)])
+        self.assertFalse(pipe.pipeline[0][1].input_chain[1].keywords['index_aggs'])
+
+        # each table only has the columns of its own aggregations
+        pipe = SelectPipe('server', wheres=wheres + [self.dept],
+                          project=[h_max(self.emp.salary), h_max(self.dept.manager_id)])
+        self.assertFalse(pipe.pipeline[0][1].input_chain[1].keywords['index_aggs'])
+
+    def test_top_k(self):
+        rows = [((name, salary), ()) for name, salary in
+                [('a', 5), ('b', 9), ('c', 1), ('d', 9), ('e', 7)]]
+        self.assertListEqual(first_items(_top_k(rows, 2, (1, 0), False)), [('c', 1), ('a', 5)])
+        self.assertListEqual(first_items(_top_k(rows, 3, (1, 0), True)), [('d', 9), ('b', 9), ('e', 7)])
+        self.assertListEqual(first_items(_top_k(rows, 10, (0,), False)), sorted(first_items(rows)))
+
+        from hustle import h_sum
+        wheres = [(self.emp.salary > 25000)]
+        project = [self.emp.name, h_sum(self.emp.salary)]
+        pipe = SelectPipe('server', wheres=wheres, project=project,
+                          order_by=[project[1]], desc=True, limit=10)
+        self.assertEqual(pipe.pipeline[1][1].process.keywords['top_k'], 10)
+        self.assertEqual(pipe.pipeline[0][1].process.keywords['top_k'], 0)
+
+        pipe = SelectPipe('server', wheres=wheres, project=[self.emp.name],
+                          order_by=[self.emp.name], limit=10)
+        self.assertEqual(pipe.pipeline[0][1].process.keywords['top_k'], 10)
+
+        pipe = SelectPipe('server', wheres=wheres, project=[self.emp.name],
+                          order_by=[self.emp.name], limit=10, distinct=True)
+        self.assertEqual(pipe.pipeline[0][1].process.keywords['top_k'], 0)
+
+        # the rows may be dropped before they are ordered
+        pipe = SelectPipe('server', wheres=wheres, project=[self.emp.name],
+                          order_by=[self.emp.name], limit=10,
+                          pre_order_stage=[('group_label', HustleStage('filter', process=lambda *args: None))])
+        self.assertEqual(pipe.pipeline[0][1].process.keywords['top_k'], 0)
+
+    def test_hash_join(self):
+        # (where_index, join_column, name, building)
+        emps = [((0, d % 4, 'emp%d' % d, None), ()) for d in range(40)]
+        depts = [((1, d, None, 'building%d' % d), ()) for d in (0, 1, 1, 2, 5)]
+        join_args = dict(full_join=False, label_fn=lambda key: 0, ffuncs=(), ghfuncs=(),
+                         deffuncs=(), agg_fn=None)
+
+        interface = _Interface()
+        process_join(interface, None, 0, sorted(emps + depts, key=lambda (k, _): (k[1], k[0])),
+                     _Task(), **join_args)
+        expected = sorted(interface.outputs[0])
+        self.assertEqual(len(expected), 40)
+
+        for build in (0, 1):
+            for buffer_size in (1 << 20, 64):
+                task = _Task()
+                interface = _Interface()
+                process_join(interface, None, 0, depts + emps, task, hash_join=True, build=build,
+                             join_buffer_size=buffer_size, **join_args)
+                self.assertListEqual(sorted(interface.outputs[0]), expected)
+                self.assertListEqual(os.listdir(task.dir), [])
+
+        wheres = [(self.emp.salary > 25000), self.dept]
+        project = [self.emp.name, self.dept.building]
+        join = [self.dept.id, self.emp.department_id]
+        pipe = SelectPipe('server', wheres=wheres, project=project, join=join, hash_join=True, join_build=1)
+        self.assertEqual(pipe.pipeline[1][1].name, 'join')
+        self.assertEqual(pipe.pipeline[1][1].process.keywords['build'], 1)
+        self.assertFalse(pipe.pipeline[1][1].sort)
+
+    def test_broadcast_join(self):
+        # (join_column, name, building)
+        emps = [(d % 4, 'emp%d' % d, None) for d in range(40)]
+        depts = {0: [(0, None, 'building0')],
+                 1: [(1, None, 'building1'), (1, None, 'building1b')],
+                 2: [(2, None, 'building2')]}
+        joined = list(_broadcast_join(emps, depts))
+        self.assertEqual(len(joined), 40)
+        self.assertIn(['emp1', 'building1'], joined)
+        self.assertIn(['emp1', 'building1b'], joined)
+        self.assertIn(['emp2', 'building2'], joined)
+        self.assertFalse([r for r in joined if r[0] == 'emp3'])
+
+        wheres = [(self.emp.salary > 25000)]
+        project = [self.emp.name, self.dept.building]
+        pipe = SelectPipe('server', wheres=wheres, project=project, limit=10,
+                          broadcast=(self.emp.department_id, depts))
+        self.assertEqual(pipe.pipeline[1][1].name, 'order-combine')
+        stream = pipe.pipeline[0][1].input_chain[1].keywords
+        self.assertEqual(stream['broadcast'], depts)
+        self.assertFalse(stream['gen_where_index'])
+        self.assertEqual(stream['limit'], sys.maxint)
+        self.assertTupleEqual(('department_id', 'name', None), tuple(first_items(stream['key_names'][0])))
+
+    def test_semi_join(self):
+        wheres = [(self.emp.salary > 25000), self.dept]
+        project = [self.emp.name, self.dept.building]
+        join = [self.emp.department_id, self.dept.id]
+        pipe = SelectPipe('server', wheres=wheres, project=project, join=join,
+                          semi_join=(0, set([1, 2])))
+        stream = pipe.pipeline[0][1].input_chain[1].keywords
+        self.assertEqual(stream['semi_join'], (0, set([1, 2])))
+        self.assertTrue(stream['gen_where_index'])
+        self.assertEqual(pipe.pipeline[1][1].name, 'join')
+
+    def test_bounded_aggregation(self):
+        from hustle import h_sum, h_avg, h_count
+        project = [self.emp.name, h_sum(self.emp.salary), h_avg(self.emp.salary), h_count()]
+        ffuncs, gfuncs, hfuncs, dflts = zip(*[(c.f, c.g, c.h, c.default) if not isinstance(c, Column)
+                                               else (dflt_f, dflt_gh, dflt_gh, dflt_default)
+                                               for c in project])
+        rows = [(('emp%d' % (i % 7), i, i, 1), ()) for i in range(100)]
+        expected = dict(('emp%d' % e, [sum(range(e, 100, 7))] * 2 + [len(range(e, 100, 7))])
+                        for e in range(7))
+
+        # past the buffer, the restrict stage passes on partial aggregations
+        partials = list(_aggregate(rows, lambda group: 0, ffuncs, hfuncs, dflts, agg_buffer_size=1))
+        self.assertGreater(len(partials), 7)
+        merged = defaultdict(lambda: [0, 0, 0])
+        for _, (name, total, (avg_total, avg_count), count) in partials:
+            merged[name][0] += total
+            merged[name][1] += avg_total
+            merged[name][2] += count
+            self.assertEqual(avg_count, count)
+        self.assertDictEqual(dict(merged), expected)
+
+        # and the group stage spills groups to disk, then merges them
+        for buffer_size in (1 << 20, 1):
+            task = _Task()
+            interface = _Interface()
+            process_group(interface, None, 0, [((name, t, (t, c), c), ()) for _, (name, t, _, c) in partials],
+                          task, ffuncs, gfuncs, dflts, hfuncs=hfuncs, agg_buffer_size=buffer_size)
+            results = dict((name, [total, avg * count, count])
+                           for (name, total, avg, count), _ in interface.outputs[0])
+            self.assertDictEqual(results, expected)
+            self.assertListEqual(os.listdir(task.dir), [])
+
+    def test_batch_aggregation(self):
+        from hustle import h_sum, h_avg, h_count, h_min, h_max
+        aggs = [h_sum(self.emp.salary), h_avg(self.emp.salary), h_count(),
+                h_min(self.emp.salary), h_max(self.emp.salary)]
+        rows = [(('emp%d' % (i % 7), i, i, 1, i, i), ()) for i in range(3000)]
+
+        project = [self.emp.name] + aggs
+        ffuncs, hfuncs, dflts = zip(*[(c.f, c.h, c.default) if not isinstance(c, Column)
+                                      else (dflt_f, dflt_gh, dflt_default) for c in project])
+        bfuncs = [dflt_batch] + [c.batch for c in aggs]
+        expected = sorted(_aggregate(rows, lambda group: 0, ffuncs, hfuncs, dflts))
+        self.assertEqual(len(expected), 7)
+        self.assertListEqual(sorted(_aggregate(rows, lambda group: 0, ffuncs, hfuncs, dflts,
+                                               batchfuncs=bfuncs)), expected)
+
+        rows = [(record[1:], ()) for record, _ in rows]
+        ffuncs, hfuncs, dflts = zip(*[(c.f, c.h, c.default) for c in aggs])
+        bfuncs = [c.batch for c in aggs]
+        expected = list(_aggregate_fast(rows, 0, ffuncs, hfuncs, dflts))
+        self.assertListEqual(list(_aggregate_fast(rows, 0, ffuncs, hfuncs, dflts, batchfuncs=bfuncs)),
+                             expected)
+        self.assertEqual(expected[0][1][2], 3000)
+
+        wheres = [(self.emp.salary > 25000)]
+        pipe = SelectPipe('server', wheres=wheres, project=[self.emp.name] + aggs)
+        self.assertTrue(pipe.pipeline[0][1].process.keywords['agg_fn'].keywords['batchfuncs'])
+
+    def test_late_materialisation(self):
+        from hustle import h_sum
+        names = {1: 'building1', 2: 'building2', 3: 'building3'}
+        decoders = {0: names.get}
+        project = [self.dept.building, h_sum(self.dept.id)]
+        ffuncs, hfuncs, dflts = zip(*[(c.f, c.h, c.default) if not isinstance(c, Column)
+                                      else (dflt_f, dflt_gh, dflt_default) for c in project])
+        rows = [((i % 3 + 1, i), decoders) for i in range(30)]
+        expected = sorted(_aggregate([((names[vid], i), ()) for (vid, i), _ in rows],
+                                     lambda group: hash(group[0]), ffuncs, hfuncs, dflts))
+        self.assertListEqual(sorted(_aggregate(rows, lambda group: hash(group[0]), ffuncs, hfuncs, dflts,
+                                               late=True)), expected)
+        self.assertListEqual(sorted(_aggregate(rows, lambda group: hash(group[0]), ffuncs, hfuncs, dflts,
+                                               agg_buffer_size=1, late=True)),
+                             sorted(_aggregate([((names[vid], i), ()) for (vid, i), _ in rows],
+                                               lambda group: hash(group[0]), ffuncs, hfuncs, dflts,
+                                               agg_buffer_size=1)))
+
+        wheres = [self.dept]
+        pipe = SelectPipe('server', wheres=wheres, project=project)
+        self.assertTupleEqual(pipe.pipeline[0][1].input_chain[1].keywords['late_columns'], (0, ))
+        pipe = SelectPipe('server', wheres=wheres, project=[self.dept.building, self.dept.id])
+        self.assertTupleEqual(pipe.pipeline[0][1].input_chain[1].keywords['late_columns'], ())
+
     def test_column_aliases_project(self):
         wheres = [(self.emp.salary > 25000), self.dept]
         project = [self.emp.name, self.emp.salary, self.dept.building, self.dept.name]
@@ -1,21 +1,9 @@
 import unittest
-from hustle.core.pipeworker import sort_reader, disk_sort
-from StringIO import StringIO
+from hustle.core.pipeworker import disk_sort
 import os
 
 OUT_FILE = '/tmp/test_disk_sort'
 
-TEST_FILE = \
-    b"stuff\xff19\xffvalue1\x00" \
-    b"morestuff\xff29\xffvalue2\x00" \
-    b"reallylongkeyprobablylongerthanthebufferljkfdskjlkjjkjkjjjjjjjjjjjjjsfddfsfdsdfsdfsfdsfdsdfsfdsfdsdsffdsdfsdfsfdsdfsdfsdfsdfsfdsdsfdfsfdsfdsdsfdsffdsdfsdsfdsfdfsdfsfdssdfdfsdfsdfsdfsdfsfdsfdssdfdfs\xff15\xfffinalvalue\x00"\
-
-EXPECTED = [
-    (["stuff", "19"], "value1"),
-    (["morestuff", "29"], "value2"),
-    (["reallylongkeyprobablylongerthanthebufferljkfdskjlkjjkjkjjjjjjjjjjjjjsfddfsfdsdfsdfsfdsfdsdfsfdsfdsdsffdsdfsdfsfdsdfsdfsdfsdfsfdsdsfdfsfdsfdsdsfdsffdsdfsdsfdsfdfsdfsfdssdfdfsdfsdfsdfsdfsfdsfdssdfdfs", "15"], "finalvalue"),
-]
-
 RESPECTED = [
     (["stuff", 1900], 'value1'),
     (["morestuff", 9], 'value2'),
@@ -46,13 +34,6 @@ class TestPipeworker(unittest.TestCase):
         except:
             pass
 
-    def test_sort_reader(self):
-        for buf_size in [8, 16, 32, 64, 256, 8192]:
-            infile = StringIO(TEST_FILE)
-            for actual, expected in zip(sort_reader(infile, 'test', buf_size), EXPECTED):
-                self.assertListEqual(actual[0], expected[0])
-                self.assertEqual(actual[1], expected[1])
-
     def test_simple_disk_sort(self):
         self._clean_ds_tmp()
         actual = [(key, value) for key, value in disk_sort(RESPECTED, OUT_FILE, (0, 1))]
@@ -78,3 +59,19 @@ class TestPipeworker(unittest.TestCase):
         print "ACTUAL: ", actual
         self.assertEqual(actual[0][0][0], None)
 
+    def test_spilled_disk_sort(self):
+        self._clean_ds_tmp()
+        keys = [([i % 7, str(i), None if i % 5 else 'x' * i], i) for i in range(500)]
+        for desc in (False, True):
+            expected = sorted((k for k, _ in keys), key=lambda k: (k[0], k[1]), reverse=desc)
+            actual = [key for key, value in disk_sort(keys, OUT_FILE, (0, 1), sort_buffer_size=1024, desc=desc)]
+            # the same keys as the ones that aren't spilled, not the wrappers of the merge
+            self.assertListEqual(actual, expected)
+            self.assertTrue(all(type(k) is list for k in actual))
+            self.assertEqual(os.listdir('/tmp').count('test_disk_sort.0'), 0)
+
+    def test_binary_disk_sort(self):
+        self._clean_ds_tmp()
+        keys = [(['\xff\x00\n', 2], 'v'), (['\x00\xff', 1], 'v')]
+        actual = [key for key, value in disk_sort(keys, OUT_FILE, (1,), sort_buffer_size=1)]
+        self.assertListEqual(actual, [['\x00\xff', 1], ['\xff\x00\n', 2]])
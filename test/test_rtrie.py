@@ -44,6 +44,39 @@ class TestRTrie(unittest.TestCase):
         self.assertIsNone(rtrie.vid_for_value(nodeaddr, kidaddr, 'hel'))
         self.assertIsNone(rtrie.vid_for_value(nodeaddr, kidaddr, 'hells'))
 
+    def test_rtrie_values_for_vids(self):
+        from array import array
+        t = Trie()
+        for w in ('hello', 'hell', 'goodbye', 'hello'):
+            t.add(w)
+        nodes, kids, _ = t.serialize()
+        nodeaddr, _ = nodes.buffer_info()
+        kidaddr, _ = kids.buffer_info()
+
+        vids = array('l', [1, 2, 1, 3, 3, 1])
+        values = rtrie.values_for_vids(nodeaddr, kidaddr, vids)
+        self.assertListEqual(values, [rtrie.value_for_vid(nodeaddr, kidaddr, vid) for vid in vids])
+        self.assertListEqual(values, ['hello', 'hell', 'hello', 'goodbye', 'goodbye', 'hello'])
+        self.assertIs(values[0], values[2])
+        self.assertListEqual(rtrie.values_for_vids(nodeaddr, kidaddr, []), [])
+        self.assertRaises(TypeError, rtrie.values_for_vids, nodeaddr, kidaddr, 1)
+
+    def test_rtrie_sorted(self):
+        words = ['hello', 'hell', 'hellothere', 'good', 'goodbye', 'hellsink', 'a', 'zed', 'help', 'goo']
+        t = Trie()
+        old_vids = dict((w, t.add(w)) for w in words)
+        remap = t.sort()
+        self.assertEqual(remap[0], 0)
+
+        nodes, kids, size = t.serialize()
+        nodeaddr, _ = nodes.buffer_info()
+        kidaddr, _ = kids.buffer_info()
+        values = [rtrie.value_for_vid(nodeaddr, kidaddr, i) for i in range(size)]
+        self.assertListEqual(values, sorted(values))
+        for w in words:
+            self.assertEqual(rtrie.vid_for_value(nodeaddr, kidaddr, w), remap[old_vids[w]])
+            self.assertEqual(t.add(w), remap[old_vids[w]])
+
     def test_rtrie_in_mdb(self):
         t = Trie()
         self.assertEqual(t.add('hello'), 1)
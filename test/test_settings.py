@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+from hustle.core import settings
+from hustle.core.settings import Settings
+
+
+class Client(object):
+    def __init__(self, server):
+        self.server = server
+
+
+class TestSettings(unittest.TestCase):
+    def setUp(self):
+        self.saved = settings.DDFS, settings.Disco, dict(settings.overrides)
+        settings.DDFS = settings.Disco = Client
+        settings._clients.clear()
+        fd, self.path = tempfile.mkstemp(suffix='.yaml')
+        os.write(fd, 'server: alpha\n')
+        os.close(fd)
+
+    def tearDown(self):
+        settings.DDFS, settings.Disco, overrides = self.saved
+        settings.overrides.clear()
+        settings.overrides.update(overrides)
+        settings._clients.clear()
+        os.unlink(self.path)
+
+    def test_shared_clients(self):
+        a = Settings(settings_file=self.path, worker=None)
+        b = Settings(settings_file=self.path, worker=None, nest=True)
+        self.assertEqual(a['ddfs'].server, 'disco://alpha')
+        self.assertIs(a['ddfs'], b['ddfs'])
+        self.assertIs(a['server'], b['server'])
+        self.assertTrue(b['nest'])
+        self.assertFalse(a['nest'])
+
+        c = Settings(settings_file=self.path, worker=None, server='beta')
+        self.assertEqual(c['ddfs'].server, 'disco://beta')
+        self.assertIsNot(c['ddfs'], a['ddfs'])
+
+    def test_overrides(self):
+        a = Settings(settings_file=self.path, worker=None)
+        settings.overrides['server'] = 'gamma'
+        b = Settings(settings_file=self.path, worker=None)
+        self.assertEqual(b['ddfs'].server, 'disco://gamma')
+        del settings.overrides['server']
+        c = Settings(settings_file=self.path, worker=None)
+        self.assertIs(c['ddfs'], a['ddfs'])
+
+    def test_settings_file_changes(self):
+        a = Settings(settings_file=self.path, worker=None)
+        with open(self.path, 'w') as f:
+            f.write('server: delta\n')
+        st = os.stat(self.path)
+        os.utime(self.path, (st.st_atime, st.st_mtime + 1))
+        b = Settings(settings_file=self.path, worker=None)
+        self.assertEqual(a['ddfs'].server, 'disco://alpha')
+        self.assertEqual(b['ddfs'].server, 'disco://delta')
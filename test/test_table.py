@@ -13,8 +13,21 @@ class TestTable(unittest.TestCase):
         fields = Table.parse_column_specs(default_columns)
         self.assertListEqual(fields, default_fields)
 
+        bsi_columns = ['bsi int32 amount', 'bsi uint16 y']
+        bsi_fields = ['^#4amount', '^@2y']
+        fields = Table.parse_column_specs(bsi_columns)
+        self.assertListEqual(fields, bsi_fields)
+
+        ordered_columns = ['index ordered trie16 date', 'ordered x']
+        ordered_fields = ['+<%2date', '<x']
+        fields = Table.parse_column_specs(ordered_columns)
+        self.assertListEqual(fields, ordered_fields)
+
     def test_create_errors(self):
         self.assertRaises(ValueError, Table.parse_column_specs, ['wide wide index x'])
         self.assertRaises(ValueError, Table.parse_column_specs, ['index wide x'])
         self.assertRaises(ValueError, Table.parse_column_specs, ['index blah16 x'])
         self.assertRaises(ValueError, Table.parse_column_specs, ['uint24 x'])
+        self.assertRaises(ValueError, Table.parse_column_specs, ['bsi string x'])
+        self.assertRaises(ValueError, Table.parse_column_specs, ['wide bsi int32 x'])
+        self.assertRaises(ValueError, Table.parse_column_specs, ['ordered string x'])